@@ -46,10 +46,12 @@ INSTALLED_APPS = (
     'django.contrib.staticfiles',
     'address_books',
     'opbeat.contrib.django',
-    'cachalot',
 )
 
 MIDDLEWARE_CLASSES = (
+    'address_books.metrics.MetricsMiddleware',
+    'address_books.renderers.CompressionMiddleware',
+    'address_books.routers.ReplicaMiddleware',
     'opbeat.contrib.django.middleware.OpbeatAPMMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,12 +74,54 @@ OPBEAT = {
 REST_FRAMEWORK = {
     'PAGE_SIZE': 100,
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
-    )
+        'rest_framework.authentication.BasicAuthentication',
+        'address_books.authentication.CachedTokenAuthentication',
+    ),
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
 }
 
+# MessagePack is offered for Accept: application/msgpack when installed
+try:
+    import msgpack  # noqa
+except ImportError:
+    pass
+else:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] += (
+        'address_books.renderers.MessagePackRenderer',
+    )
+
+# Addresses allowed to read /metrics without logging in as a staff user,
+# e.g. the Prometheus server
+METRICS_ALLOWED_IPS = ()
+
+# Largest number of addresses or changes in one sync response, and seconds
+# after which sync tokens are rejected and their changes pruned
+SYNC_PAGE_SIZE = 1000
+SYNC_TOKEN_MAX_AGE = 30 * 24 * 3600
+
+# Seconds without progress after which a running background job is taken
+# to have lost its worker and is queued again
+JOB_TIMEOUT = 600
+
+# Seconds finished jobs and their exports are kept before prune_jobs
+# deletes them
+JOB_RETENTION = 7 * 24 * 3600
+
+# Cache for rendered list and detail responses, kept per user under the
+# versions of the address books they show
+RESPONSE_CACHE = 'default'
+RESPONSE_CACHE_TIMEOUT = 300
+
+# Cache shared by all processes for the users of API tokens, in addition to
+# each process' own TOKEN_CACHE_SIZE most recently used ones
+TOKEN_CACHE = 'default'
+TOKEN_CACHE_SIZE = 1000
+TOKEN_CACHE_TIMEOUT = 60
+
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
@@ -120,6 +164,24 @@ DATABASES = {
     }
 }
 
+# Read replicas of the default database, given as a comma separated list of
+# hosts in DATABASE_REPLICA_HOSTS. Safe requests read from one of them, and
+# clients are pinned to the primary for REPLICA_PIN_SECONDS after a write.
+# Any database can be listed in DATABASE_REPLICAS, e.g. a second SQLite file
+# kept as a copy of the first one.
+DATABASE_REPLICAS = []
+for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(','):
+    if host.strip():
+        alias = 'replica%s' % len(DATABASE_REPLICAS)
+        DATABASES[alias] = dict(DATABASES['default'], HOST=host.strip(),
+                                TEST={'MIRROR': 'default'})
+        DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['address_books.routers.ReplicaRouter']
+
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_CACHE = 'default'
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -140,3 +202,6 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR + '/static/'
+
+# Files of the background jobs
+MEDIA_ROOT = BASE_DIR + '/media/'
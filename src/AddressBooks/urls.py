@@ -7,16 +7,30 @@ from address_books.views import *
 
 urlpatterns = [
     url(r'^whoami/', get_current_user, name='whoami'),
+    url(r'^metrics$', metrics_view, name='metrics'),
     url(r'^api-token-auth/', obtain_auth_token, name='tokenauth'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^addressbooks/$', AddressBookListView.as_view(), name='addressbooks'),
+    url(r'^addressbooks/(?P<pk>\d+)/export$', AddressBookExportView.as_view(),
+        name='addressbookexport'),
     url(r'^addressbooks/(?P<pk>\d+)', AddressBookDetailView.as_view(),
         name='addressbook'),
     url(r'^groups/$', GroupListView.as_view(), name='groups'),
+    url(r'^groups/(?P<pk>\d+)/addresses/(?P<action>add|remove|move)$',
+        GroupAddressesView.as_view(), name='groupaddresses'),
     url(r'^groups/(?P<pk>\d+)', GroupDetailView.as_view(), name='group'),
     url(r'^addresses/$', AddressListView.as_view(), name='addresses'),
+    url(r'^addresses/import$', AddressImportView.as_view(),
+        name='addressimport'),
+    url(r'^addresses/batch$', AddressBatchView.as_view(),
+        name='addressbatch'),
     url(r'^addresses/(?P<pk>\d+)', AddressDetailView.as_view(),
         name='address'),
+    url(r'^sync/$', SyncView.as_view(), name='sync'),
+    url(r'^jobs/$', JobListView.as_view(), name='jobs'),
+    url(r'^jobs/(?P<pk>\d+)/output$', JobOutputView.as_view(),
+        name='joboutput'),
+    url(r'^jobs/(?P<pk>\d+)$', JobDetailView.as_view(), name='job'),
     url(r'users/$', UserListView.as_view(), name='users'),
     url(r'users/(?P<pk>\d+)', UserDetailView.as_view(), name='user'),
 ]
@@ -0,0 +1 @@
+default_app_config = 'address_books.apps.AddressBooksConfig'
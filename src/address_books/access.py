@@ -0,0 +1,51 @@
+"""
+Set-based access checks against the AddressBookAccess table.
+
+Each function takes a collection of ids and returns the subset the user can
+touch, in one query per `CHUNK_SIZE` ids, whatever the number of objects.
+"""
+from address_books.models import AddressBookAccess, Group, Membership
+
+
+CHUNK_SIZE = 500
+
+
+def _filter_ids(queryset, field, ids):
+    ids = list(set(ids))
+    allowed = set()
+    for start in range(0, len(ids), CHUNK_SIZE):
+        allowed.update(
+            queryset.filter(**{field + '__in': ids[start:start + CHUNK_SIZE]})
+            .values_list(field, flat=True)
+        )
+    return allowed
+
+
+def accessible_addressbook_ids(user, ids):
+    return _filter_ids(
+        AddressBookAccess.objects.filter(user=user), 'addressbook_id', ids
+    )
+
+
+def accessible_group_ids(user, ids):
+    return _filter_ids(Group.objects.visible_to(user), 'id', ids)
+
+
+def accessible_address_ids(user, ids):
+    """
+    Addresses are accessible when at least one of their groups belongs to a
+    visible address book.
+    """
+    return _filter_ids(
+        Membership.objects.filter(group__addressbook__access__user=user),
+        'address_id', ids
+    )
+
+
+def can_access_all(accessible, user, objects):
+    """
+    Whether user can touch every one of objects, checked with one of the
+    accessible_* functions above.
+    """
+    ids = set(obj.pk for obj in objects)
+    return accessible(user, ids) == ids
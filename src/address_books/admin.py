@@ -1,5 +1,5 @@
 from django.contrib import admin
-from address_books.models import Group, Address, AddressBook
+from address_books.models import Group, Address, AddressBook, Job
 
 
 class AddressAdmin(admin.ModelAdmin):
@@ -13,6 +13,13 @@ class GroupAdmin(admin.ModelAdmin):
 class AddressBookAdmin(admin.ModelAdmin):
     fields = ['name', 'owner', 'shared_with']
 
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'kind', 'status', 'progress', 'total',
+                    'created', 'finished']
+    list_filter = ['kind', 'status']
+
 admin.site.register(Address, AddressAdmin)
 admin.site.register(Group, GroupAdmin)
-admin.site.register(AddressBook, AddressBookAdmin)
\ No newline at end of file
+admin.site.register(AddressBook, AddressBookAdmin)
+admin.site.register(Job, JobAdmin)
\ No newline at end of file
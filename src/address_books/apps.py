@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class AddressBooksConfig(AppConfig):
+    name = 'address_books'
+    verbose_name = 'Address books'
+
+    def ready(self):
+        # Connects the signal handlers that invalidate cached tokens
+        from address_books import authentication  # noqa
@@ -0,0 +1,227 @@
+"""
+Token authentication that caches the user of every token.
+
+Users are loaded once with their permissions and kept in the cache named by
+TOKEN_CACHE, shared by all processes, and in a bounded in-process LRU that
+saves unpickling them on every request. The signal handlers below drop the
+shared entries when a token is deleted or a user, its groups or its
+permissions change. Every shared entry comes with a small stamp that is
+dropped along with it, and a generation that is replaced when an auth
+group or permission is deleted. Each request reads both, so a process only
+uses its LRU entry while they still match, and revocations apply to every
+process at once. Without TOKEN_CACHE nothing could tell other processes,
+so users are loaded on every request.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from copy import copy
+
+from django.conf import settings
+from django.contrib.auth.models import User, Group, Permission
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils.translation import ugettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from address_books.serializers import get_permission_codenames
+
+
+CACHE_PREFIX = 'address_books.auth.'
+
+GENERATION_KEY = CACHE_PREFIX + 'generation'
+
+
+class LRUCache(object):
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+_users = LRUCache(getattr(settings, 'TOKEN_CACHE_SIZE', 1000),
+                  getattr(settings, 'TOKEN_CACHE_TIMEOUT', 60))
+
+
+def shared_cache():
+    alias = getattr(settings, 'TOKEN_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def load_user(key):
+    """
+    Returns the active user of the token key with its permissions loaded,
+    or None.
+    """
+    try:
+        token = Token.objects.select_related('user').get(key=key)
+    except Token.DoesNotExist:
+        return None
+    user = token.user
+    if not user.is_active:
+        return None
+    # Fills the caches has_perm and the serializers read from
+    user.get_all_permissions()
+    get_permission_codenames(user)
+    return user
+
+
+def stamp_key(key):
+    return CACHE_PREFIX + 'stamp.' + key
+
+
+def user_key(key):
+    return CACHE_PREFIX + 'user.' + key
+
+
+def new_generation(cache):
+    generation = uuid.uuid4().hex
+    cache.set(GENERATION_KEY, generation, None)
+    return generation
+
+
+def get_user(key):
+    cache = shared_cache()
+    if cache is None:
+        return load_user(key)
+    values = cache.get_many([GENERATION_KEY, stamp_key(key)])
+    # A lost generation drops every entry, which is always safe
+    generation = values.get(GENERATION_KEY) or new_generation(cache)
+    stamp = values.get(stamp_key(key))
+    entry = None
+    if stamp is not None:
+        entry = _users.get(key)
+        if entry is None or entry[0] != (generation, stamp):
+            entry = cache.get(user_key(key))
+            if entry is not None and entry[0] == (generation, stamp):
+                _users.set(key, entry)
+    if entry is None or entry[0] != (generation, stamp):
+        user = load_user(key)
+        if user is None:
+            return None
+        entry = ((generation, uuid.uuid4().hex), user)
+        timeout = getattr(settings, 'TOKEN_CACHE_TIMEOUT', 60)
+        cache.set_many({stamp_key(key): entry[0][1], user_key(key): entry},
+                       timeout)
+        _users.set(key, entry)
+    # Requests get their own instance, so changes to it stay local
+    return copy(entry[1])
+
+
+def forget_tokens(keys):
+    keys = list(keys)
+    for key in keys:
+        _users.delete(key)
+    cache = shared_cache()
+    if cache is not None and keys:
+        cache.delete_many([stamp_key(key) for key in keys] +
+                          [user_key(key) for key in keys])
+
+
+def forget_users(users):
+    """
+    Drops the cached tokens of the users in the given queryset or list of
+    ids.
+    """
+    forget_tokens(
+        Token.objects.filter(user__in=users).values_list('key', flat=True)
+    )
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        if isinstance(key, bytes):
+            key = key.decode('latin-1')
+        user = get_user(key)
+        if user is None:
+            raise exceptions.AuthenticationFailed(
+                _('Invalid token or user inactive.')
+            )
+        return user, Token(key=key, user=user)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance=None, **kwargs):
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def forget_saved_user(sender, instance=None, created=False, **kwargs):
+    if not created:
+        forget_users([instance.id])
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=User.groups.through)
+def forget_user_permissions(sender, instance=None, action=None,
+                            reverse=False, pk_set=None, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            forget_users([instance.id])
+    elif action == 'pre_clear':
+        # pk_set is not given on clear, so remember which users are affected
+        instance._cleared_users = list(
+            instance.user_set.values_list('id', flat=True)
+        )
+    elif action == 'post_clear':
+        forget_users(instance._cleared_users)
+    elif action in ('post_add', 'post_remove'):
+        forget_users(pk_set)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def forget_group_permissions(sender, instance=None, action=None,
+                             reverse=False, pk_set=None, **kwargs):
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            forget_users(instance.user_set.all())
+    elif action == 'pre_clear':
+        instance._cleared_groups = list(
+            instance.group_set.values_list('id', flat=True)
+        )
+    elif action == 'post_clear':
+        forget_users(User.objects.filter(groups__in=instance._cleared_groups))
+    elif action in ('post_add', 'post_remove'):
+        forget_users(User.objects.filter(groups__in=pk_set))
+
+
+@receiver(post_delete, sender=Group)
+@receiver(post_delete, sender=Permission)
+def forget_all(sender, **kwargs):
+    # The members are gone by now, so drop everything
+    _users.clear()
+    cache = shared_cache()
+    if cache is not None:
+        new_generation(cache)
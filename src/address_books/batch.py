@@ -0,0 +1,230 @@
+"""
+Batches of address creates, updates and deletes applied in one transaction.
+
+The whole batch is validated before anything is written, with a fixed
+number of queries: the targets and their memberships, the groups, and the
+emails already taken. Then deletes, updates and creates are written with
+the set-based helpers from address_books.bulk, and the email index is
+brought up to date once all rows and memberships are written.
+"""
+from django.db import transaction
+
+from address_books.bulk import bulk_create_with_ids, add_memberships, \
+    remove_memberships, update_addresses, delete_addresses
+from address_books.models import Address, Group, AddressBookEmail, \
+    Membership, normalize_email, sync_addressbook_emails
+
+
+MAX_OPERATIONS = 1000
+
+PERMISSIONS = {
+    'create': 'address_books.add_address',
+    'update': 'address_books.change_address',
+    'delete': 'address_books.delete_address',
+}
+
+
+class AddressBatch(object):
+    """
+    Validates and applies a list of operations for a user. Each operation
+    is a dict with an `op` of create, update or delete, the `id` of the
+    address for update and delete, and `name`, `email` and `groups` for
+    create and update. Fields left out of an update keep their value.
+    """
+
+    def __init__(self, user, operations):
+        self.user = user
+        self.operations = operations
+        self.errors = {}
+
+    def required_permissions(self):
+        return set(
+            PERMISSIONS[operation['op']] for operation in self.operations
+            if isinstance(operation, dict) and operation.get('op') in
+            PERMISSIONS
+        )
+
+    def error(self, index, field, message):
+        self.errors.setdefault(index, {}).setdefault(field, []) \
+            .append(message)
+
+    def clean(self, index, operation):
+        if not isinstance(operation, dict):
+            self.error(index, 'non_field_errors', 'Expected an object.')
+            return
+        if operation.get('op') not in PERMISSIONS:
+            self.error(index, 'op', 'Must be create, update or delete.')
+            return
+        if operation['op'] != 'create':
+            try:
+                operation['id'] = int(operation.get('id'))
+            except (TypeError, ValueError):
+                self.error(index, 'id', 'A valid integer is required.')
+        if operation['op'] == 'delete':
+            # A delete only needs its id, and validate() would read the
+            # groups without them being checked
+            operation.pop('groups', None)
+            return
+        for field in ('name', 'email'):
+            if field not in operation and operation['op'] == 'update':
+                continue
+            value = operation.get(field)
+            value = value.strip() if isinstance(value, str) else ''
+            if not value:
+                self.error(index, field, 'This field is required.')
+            elif len(value) > 255:
+                self.error(index, field,
+                           'Ensure this field has no more than 255 '
+                           'characters.')
+            operation[field] = value
+        if 'groups' in operation or operation['op'] == 'create':
+            try:
+                operation['groups'] = set(
+                    int(group) for group in operation.get('groups') or ()
+                )
+            except (TypeError, ValueError):
+                self.error(index, 'groups', 'Invalid group set')
+            else:
+                if not operation['groups']:
+                    self.error(index, 'groups',
+                               'This list may not be empty.')
+
+    def validate(self):
+        """
+        Returns whether the whole batch is valid, filling self.errors with
+        the errors of each operation by index otherwise.
+        """
+        if len(self.operations) > MAX_OPERATIONS:
+            self.error(None, 'non_field_errors',
+                       'Ensure this list has no more than %s operations.'
+                       % MAX_OPERATIONS)
+            return False
+        for index, operation in enumerate(self.operations):
+            self.clean(index, operation)
+        if self.errors:
+            return False
+
+        targets = {}
+        for index, operation in enumerate(self.operations):
+            if operation['op'] == 'create':
+                continue
+            if operation['id'] in targets:
+                self.error(index, 'id',
+                           'Only one operation per address is allowed.')
+            targets[operation['id']] = index
+        self.addresses = Address.objects.visible_to(self.user) \
+            .in_bulk(list(targets))
+        for address_id, index in targets.items():
+            if address_id not in self.addresses:
+                self.error(index, 'id', 'Not found.')
+        self.current_groups = {}
+        for address_id, group_id, addressbook_id in \
+                Membership.objects.filter(address_id__in=list(targets)) \
+                .values_list('address_id', 'group_id',
+                             'group__addressbook_id'):
+            self.current_groups.setdefault(address_id, {})[group_id] = \
+                addressbook_id
+
+        wanted = set()
+        for operation in self.operations:
+            wanted.update(operation.get('groups', ()))
+        self.group_books = dict(
+            Group.objects.visible_to(self.user).filter(id__in=wanted)
+            .values_list('id', 'addressbook_id')
+        )
+        for index, operation in enumerate(self.operations):
+            if any(group not in self.group_books
+                   for group in operation.get('groups', ())):
+                self.error(index, 'groups', 'Invalid group set')
+        self.check_emails()
+        return not self.errors
+
+    def final_emails(self, operation):
+        """
+        Returns the (email, address book id) pairs the address of operation
+        ends up with.
+        """
+        if operation['op'] == 'create':
+            address = None
+        else:
+            address = self.addresses[operation['id']]
+        email = normalize_email(
+            operation['email'] if 'email' in operation else address.email
+        )
+        if 'groups' in operation:
+            books = [self.group_books[group]
+                     for group in operation['groups']]
+        else:
+            books = self.current_groups.get(address.id, {}).values()
+        return set((email, book) for book in books)
+
+    def check_emails(self):
+        seen = {}
+        for index, operation in enumerate(self.operations):
+            if operation['op'] == 'delete' or index in self.errors:
+                continue
+            for key in self.final_emails(operation):
+                if key in seen:
+                    self.error(index, 'non_field_errors',
+                               'Duplicate email address')
+                    break
+                seen[key] = index
+        # Rows of addresses in the batch are replaced by their final state
+        replaced = set(self.addresses)
+        for email, addressbook_id, address_id in \
+                AddressBookEmail.objects.filter(
+                    email__in=set(email for email, _ in seen),
+                    addressbook_id__in=set(book for _, book in seen)
+                ).values_list('email', 'addressbook_id', 'address_id'):
+            index = seen.get((email, addressbook_id))
+            if index is not None and address_id not in replaced:
+                self.error(index, 'non_field_errors',
+                           'Duplicate email address')
+
+    @transaction.atomic
+    def apply(self):
+        """
+        Writes a validated batch and returns the operations with the
+        resulting address of each create and update.
+        """
+        deletes = []
+        updates = []
+        creates = []
+        added = set()
+        removed = set()
+        for operation in self.operations:
+            if operation['op'] == 'delete':
+                deletes.append(operation['id'])
+                continue
+            if operation['op'] == 'create':
+                address = Address()
+                creates.append(address)
+            else:
+                address = self.addresses[operation['id']]
+                updates.append(address)
+            for field in ('name', 'email'):
+                if field in operation:
+                    setattr(address, field, operation[field])
+            address.normalized_email = normalize_email(address.email)
+            operation['address'] = address
+        delete_addresses(deletes)
+        # The email index is synced once everything is written, since an
+        # email may only be free once another row or membership changed
+        update_addresses(updates, sync_emails=False)
+        bulk_create_with_ids(Address, creates)
+        for operation in self.operations:
+            if 'groups' not in operation:
+                continue
+            address_id = operation['address'].id
+            current = set(self.current_groups.get(address_id, ()))
+            added.update((address_id, group)
+                         for group in operation['groups'] - current)
+            removed.update((address_id, group)
+                           for group in current - operation['groups'])
+        remove_memberships(removed, sync_emails=False)
+        add_memberships(added, sync_emails=False)
+        sync_addressbook_emails(
+            operation['address'].id for operation in self.operations
+            if operation['op'] != 'delete'
+        )
+        return self.operations
@@ -0,0 +1,9 @@
+"""
+Reproducible benchmarks for the API.
+
+generator fills the configured database with synthetic users, shared
+address books, groups and addresses; scenarios times every URL against it
+and collects latency percentiles and query counts, and encoding compares
+the payload size and encoding time of the renderers. They are driven by the
+benchmark_data and benchmark management commands.
+"""
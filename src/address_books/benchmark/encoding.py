@@ -0,0 +1,62 @@
+"""
+Payload size and encoding time of the API's renderers and compressions.
+
+A page of every list is fetched once as JSON, then rendered and compressed
+again with each available renderer and content coding.
+"""
+import json
+import time
+
+from django.core.urlresolvers import reverse
+from rest_framework.renderers import JSONRenderer
+
+from address_books import renderers
+
+
+def encoders():
+    encoders = [('json', JSONRenderer())]
+    if renderers.msgpack is not None:
+        encoders.append(('msgpack', renderers.MessagePackRenderer()))
+    return encoders
+
+
+def codings():
+    codings = [('identity', lambda content: content)]
+    for coding in renderers.PREFERENCE[::-1]:
+        if coding in renderers.COMPRESSORS:
+            codings.append((coding, renderers.COMPRESSORS[coding][0]))
+    return codings
+
+
+def measure(data, renderer, compress, iterations):
+    timings = []
+    for iteration in range(iterations):
+        start = time.perf_counter()
+        content = compress(renderer.render(data))
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'bytes': len(content),
+        'p50_ms': round(timings[len(timings) // 2], 3),
+        'max_ms': round(timings[-1], 3),
+    }
+
+
+def run(client, iterations=20, log=None):
+    """
+    Returns the size and encoding time of a page of each list for every
+    renderer and content coding, fetching the pages with client.
+    """
+    log = log or (lambda message: None)
+    results = {}
+    for name in ('addressbooks', 'groups', 'addresses'):
+        response = client.get(reverse(name), HTTP_ACCEPT='application/json')
+        data = json.loads(response.content.decode('utf-8'))
+        for encoder, renderer in encoders():
+            for coding, compress in codings():
+                key = '%s-%s-%s' % (name, encoder, coding)
+                results[key] = measure(data, renderer, compress, iterations)
+                log('%-28s %9d bytes  p50 %8.2f ms' % (
+                    key, results[key]['bytes'], results[key]['p50_ms']
+                ))
+    return results
@@ -0,0 +1,115 @@
+"""
+Synthetic data for the benchmarks, written with bulk inserts.
+"""
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User, Permission
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from address_books.bulk import bulk_create_with_ids, add_memberships
+from address_books.models import AddressBook, Group, Address, \
+    normalize_email, sync_addressbook_access, update_group_counts
+
+
+USERNAME_PREFIX = 'bench-'
+PASSWORD = 'bench'
+CHUNK_SIZE = 400
+
+
+def benchmark_users():
+    return User.objects.filter(username__startswith=USERNAME_PREFIX)
+
+
+def clear():
+    """
+    Deletes the data of a previous run, which all hangs off the benchmark
+    users.
+    """
+    users = benchmark_users()
+    Address.objects.filter(
+        groups__addressbook__owner__in=users
+    ).delete()
+    users.delete()
+
+
+def make_address(addressbook, number):
+    email = 'contact%s@book%s.example.com' % (number, addressbook.id)
+    return Address(name='Contact %s' % number, email=email,
+                   normalized_email=normalize_email(email))
+
+
+def generate(users=10, addressbooks=5, groups=10, addresses=1000, shared=2,
+             seed=0, log=None):
+    """
+    Creates `users` users that own `addressbooks` address books each, every
+    one shared with `shared` other users. Each book gets `groups` groups and
+    `addresses` addresses, all in one group and a fifth of them in a second
+    one. The first user gets every address_books permission and is the one
+    the scenarios run as.
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+
+    password = make_password(PASSWORD)
+    user_objects = bulk_create_with_ids(User, [
+        User(username='%s%s' % (USERNAME_PREFIX, x), password=password)
+        for x in range(users)
+    ])
+    Token.objects.create(user=user_objects[0])
+    user_objects[0].user_permissions.add(*Permission.objects.filter(
+        content_type__app_label='address_books'
+    ))
+    log('Created %s users' % users)
+
+    book_objects = bulk_create_with_ids(AddressBook, [
+        AddressBook(name='%s%s-%s' % (USERNAME_PREFIX, user.id, x),
+                    owner=user)
+        for user in user_objects for x in range(addressbooks)
+    ])
+    shares = []
+    for book in book_objects:
+        others = [user for user in user_objects if user.id != book.owner_id]
+        for user in rng.sample(others, min(shared, len(others))):
+            shares.append(AddressBook.shared_with.through(
+                addressbook_id=book.id, user_id=user.id
+            ))
+    AddressBook.shared_with.through.objects.bulk_create(shares)
+    sync_addressbook_access(book.id for book in book_objects)
+    log('Created %s address books' % len(book_objects))
+
+    group_objects = bulk_create_with_ids(Group, [
+        Group(name=str(x), addressbook=book)
+        for book in book_objects for x in range(groups)
+    ])
+    update_group_counts(book.id for book in book_objects)
+    book_groups = {}
+    for group in group_objects:
+        book_groups.setdefault(group.addressbook_id, []).append(group.id)
+    log('Created %s groups' % len(group_objects))
+
+    total = 0
+    for book in book_objects:
+        for start in range(0, addresses, CHUNK_SIZE):
+            with transaction.atomic():
+                chunk = bulk_create_with_ids(Address, [
+                    make_address(book, x)
+                    for x in range(start, min(start + CHUNK_SIZE, addresses))
+                ])
+                pairs = []
+                for address in chunk:
+                    in_groups = [rng.choice(book_groups[book.id])]
+                    if rng.random() < 0.2:
+                        in_groups.append(rng.choice(book_groups[book.id]))
+                    pairs.extend((address.id, group) for group in in_groups)
+                add_memberships(pairs)
+            total += len(chunk)
+        log('Created %s addresses' % total)
+
+    return {
+        'users': users,
+        'addressbooks': len(book_objects),
+        'groups': len(group_objects),
+        'addresses': total,
+    }
@@ -0,0 +1,283 @@
+"""
+Timed requests against every URL of the API.
+
+Each scenario builds its request from the iteration number, so mutating
+scenarios can use fresh names and objects, and cleans up after itself
+outside the timed section. Requests go through the full middleware stack
+with APIClient. The job scenarios time the endpoints, not the jobs; the
+job detail and output scenarios read an export run once up front.
+"""
+import time
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIClient
+
+from address_books import jobs, membership, sync
+from address_books.benchmark import encoding
+from address_books.benchmark.generator import benchmark_users, PASSWORD
+from address_books.models import AddressBook, Group, Address, Change, Job
+
+
+class Scenario(object):
+    def __init__(self, name, method, build, cleanup=None, format='json',
+                 settings=None):
+        """
+        build(iteration) returns the path and data of a request, and
+        cleanup(response) undoes its effects. settings are overridden
+        while the requests are made.
+        """
+        self.name = name
+        self.method = method
+        self.build = build
+        self.cleanup = cleanup
+        self.format = format
+        self.settings = settings or {}
+
+
+def get(name, path):
+    return Scenario(name, 'get', lambda iteration: (path, None))
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    index = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def build_scenarios(user):
+    """
+    Returns the scenarios for user, who must own at least one address book
+    with two groups and an address, as created by the generator.
+    """
+    addressbook = AddressBook.objects.filter(owner=user).order_by('id')[0]
+    group, target = addressbook.groups.order_by('id')[:2]
+    address = group.addresses.order_by('id')[0]
+    not_in_target = set(
+        group.addresses.exclude(groups=target).values_list('id', flat=True)
+    )
+    prefix = 'scenario-'
+    sync_token = sync.make_token(
+        Change.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    )
+    export = jobs.queue_export(user, addressbook.id, 'csv')
+    # Works through the queue as run_jobs would, up to and past the export
+    job = jobs.claim()
+    while job is not None:
+        jobs.run(job)
+        job = jobs.claim()
+
+    def delete_created(model):
+        def cleanup(response):
+            model.objects.filter(id=response.data['id']).delete()
+        return cleanup
+
+    def create_addressbook(iteration):
+        return AddressBook.objects.create(
+            name='%s%s-%s' % (prefix, user.id, iteration), owner=user
+        )
+
+    def create_address(iteration):
+        address = Address.objects.create(
+            name='Deleted', email='%s%s@example.com' % (prefix, iteration)
+        )
+        address.groups.add(group)
+        return address
+
+    def import_file(iteration):
+        lines = ['name,email,groups'] + [
+            'Imported %s,%simport%s-%s@example.com,%s'
+            % (x, prefix, iteration, x, group.id)
+            for x in range(100)
+        ]
+        upload = SimpleUploadedFile('import.csv',
+                                    '\n'.join(lines).encode('utf-8'))
+        return reverse('addressimport'), {'file': upload}
+
+    def delete_imported(response):
+        Address.objects.filter(email__startswith=prefix).delete()
+
+    return [
+        get('whoami', reverse('whoami')),
+        Scenario('metrics', 'get',
+                 lambda iteration: (reverse('metrics'), None),
+                 settings={'METRICS_ALLOWED_IPS': ['127.0.0.1']}),
+        Scenario('tokenauth', 'post', lambda iteration: (
+            reverse('tokenauth'),
+            {'username': user.username, 'password': PASSWORD}
+        )),
+        get('admin-login', reverse('admin:login')),
+        get('addressbooks-list', reverse('addressbooks')),
+        get('addressbooks-list-cursor',
+            reverse('addressbooks') + '?pagination=cursor'),
+        Scenario('addressbooks-create', 'post', lambda iteration: (
+            reverse('addressbooks'),
+            {'name': '%s%s' % (prefix, iteration), 'owner': user.id}
+        ), cleanup=delete_created(AddressBook)),
+        get('addressbook-detail',
+            reverse('addressbook', args=[addressbook.id])),
+        Scenario('addressbook-update', 'put', lambda iteration: (
+            reverse('addressbook', args=[addressbook.id]),
+            {'name': addressbook.name, 'owner': user.id,
+             'groups': list(addressbook.groups.values_list('id', flat=True))}
+        )),
+        Scenario('addressbook-delete', 'delete', lambda iteration: (
+            reverse('addressbook', args=[create_addressbook(iteration).id]),
+            None
+        )),
+        get('addressbook-export',
+            reverse('addressbookexport', args=[addressbook.id])),
+        get('groups-list', reverse('groups')),
+        get('groups-list-addressbook',
+            reverse('groups') + '?addressbook=%s' % addressbook.id),
+        Scenario('groups-create', 'post', lambda iteration: (
+            reverse('groups'),
+            {'name': '%s%s' % (prefix, iteration),
+             'addressbook': addressbook.id}
+        ), cleanup=delete_created(Group)),
+        get('group-detail', reverse('group', args=[group.id])),
+        Scenario('group-update', 'put', lambda iteration: (
+            reverse('group', args=[group.id]),
+            {'name': group.name, 'addressbook': addressbook.id,
+             'addresses': list(group.addresses.values_list('id', flat=True))}
+        )),
+        Scenario('group-addresses-add', 'post', lambda iteration: (
+            reverse('groupaddresses', args=[target.id, 'add']),
+            {'group': group.id}
+        ), cleanup=lambda response: membership.remove_addresses(
+            target, not_in_target
+        )),
+        Scenario('group-addresses-remove', 'post', lambda iteration: (
+            reverse('groupaddresses', args=[group.id, 'remove']),
+            {'addresses': sorted(not_in_target)}
+        ), cleanup=lambda response: membership.add_addresses(
+            group, not_in_target
+        )),
+        Scenario('group-addresses-move', 'post', lambda iteration: (
+            reverse('groupaddresses', args=[group.id, 'move']),
+            {'to': target.id, 'addresses': sorted(not_in_target)}
+        ), cleanup=lambda response: membership.move_addresses(
+            target, group, not_in_target
+        )),
+        Scenario('group-delete', 'delete', lambda iteration: (
+            reverse('group', args=[Group.objects.create(
+                name='%s%s' % (prefix, iteration), addressbook=addressbook
+            ).id]),
+            None
+        )),
+        get('addresses-list', reverse('addresses')),
+        get('addresses-list-cursor',
+            reverse('addresses') + '?pagination=cursor'),
+        get('addresses-list-group',
+            reverse('addresses') + '?group=%s' % group.id),
+        get('addresses-search', reverse('addresses') + '?q=contact1'),
+        Scenario('addresses-create', 'post', lambda iteration: (
+            reverse('addresses'),
+            {'name': 'Created', 'groups': [group.id],
+             'email': '%s%s@example.com' % (prefix, iteration)}
+        ), cleanup=delete_created(Address)),
+        get('address-detail', reverse('address', args=[address.id])),
+        Scenario('address-update', 'put', lambda iteration: (
+            reverse('address', args=[address.id]),
+            {'name': address.name, 'email': address.email,
+             'groups': list(address.groups.values_list('id', flat=True))}
+        )),
+        Scenario('address-delete', 'delete', lambda iteration: (
+            reverse('address', args=[create_address(iteration).id]), None
+        )),
+        Scenario('address-import', 'post', import_file,
+                 cleanup=delete_imported, format='multipart'),
+        Scenario('address-batch', 'post', lambda iteration: (
+            reverse('addressbatch'), [
+                {'op': 'create', 'name': 'Batch %s' % x, 'groups': [group.id],
+                 'email': '%sbatch%s-%s@example.com' % (prefix, iteration, x)}
+                for x in range(100)
+            ]
+        ), cleanup=delete_imported),
+        get('sync', reverse('sync')),
+        Scenario('sync-token', 'get', lambda iteration: (
+            reverse('sync'), {'token': sync_token}
+        )),
+        get('jobs-list', reverse('jobs')),
+        Scenario('jobs-create', 'post', lambda iteration: (
+            reverse('jobs'), {'kind': 'export', 'addressbook': addressbook.id}
+        ), cleanup=delete_created(Job)),
+        get('job-detail', reverse('job', args=[export.id])),
+        get('job-output', reverse('joboutput', args=[export.id])),
+        get('users-list', reverse('users')),
+        get('user-detail', reverse('user', args=[user.id])),
+    ]
+
+
+def run_scenario(client, scenario, iterations, warmup=1):
+    timings = []
+    query_counts = []
+    statuses = set()
+    for iteration in range(warmup + iterations):
+        path, data = scenario.build(iteration)
+        method = getattr(client, scenario.method)
+        with override_settings(**scenario.settings), \
+                CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = method(path, data, format=scenario.format)
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    pass
+            elapsed = time.perf_counter() - start
+        if scenario.cleanup is not None and response.status_code < 300:
+            scenario.cleanup(response)
+        if iteration >= warmup:
+            timings.append(elapsed * 1000)
+            query_counts.append(len(queries))
+            statuses.add(response.status_code)
+    timings.sort()
+    return {
+        'iterations': iterations,
+        'status': sorted(statuses),
+        'queries': max(query_counts),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p90_ms': round(percentile(timings, 90), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(timings[-1], 3),
+    }
+
+
+def run(iterations=20, warmup=1, names=None, log=None):
+    """
+    Runs the scenarios whose name starts with one of names (all of them by
+    default) as the first benchmark user and returns their results.
+    """
+    log = log or (lambda message: None)
+    user = benchmark_users().order_by('id')[0]
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token ' + user.auth_token.key)
+    results = {}
+    for scenario in build_scenarios(user):
+        if names and not any(scenario.name.startswith(name)
+                             for name in names):
+            continue
+        results[scenario.name] = run_scenario(client, scenario, iterations,
+                                              warmup)
+        log('%-28s p50 %8.2f ms  p99 %8.2f ms  %4s queries' % (
+            scenario.name, results[scenario.name]['p50_ms'],
+            results[scenario.name]['p99_ms'],
+            results[scenario.name]['queries']
+        ))
+    encodings = encoding.run(client, iterations=iterations, log=log)
+    return {
+        'database': connection.vendor,
+        'data': {
+            'users': benchmark_users().count(),
+            'addressbooks': AddressBook.objects.count(),
+            'groups': Group.objects.count(),
+            'addresses': Address.objects.count(),
+        },
+        'scenarios': results,
+        'encoding': encodings,
+    }
@@ -0,0 +1,173 @@
+"""
+Set-based write helpers for addresses and group memberships.
+
+These bypass the per-instance save() and m2m_changed signals, so anything
+that is maintained from those signals has to be kept up to date here too.
+The writers take sync_emails=False for callers that sync the email index
+themselves after several writes.
+"""
+from django.db import connections, router, transaction
+from django.db.models import Case, When, Value, CharField
+
+from address_books.models import Address, AddressBookEmail, Group, \
+    Membership, Change, change_counts, count_groups, group_changed, \
+    memberships_changed, record_changes, update_address_counts
+
+
+def bulk_create_with_ids(model, objs, batch_size=None):
+    """
+    Like bulk_create, but also sets the primary key of every object so the
+    caller can insert related rows afterwards.
+
+    On PostgreSQL the ids are reserved from the table's sequence up front.
+    Elsewhere the rows are inserted inside a transaction and the trailing ids
+    are read back, which relies on the backend serialising writers (SQLite
+    holds its write lock until the transaction ends).
+    """
+    if not objs:
+        return objs
+    using = router.db_for_write(model)
+    connection = connections[using]
+    manager = model._default_manager.db_manager(using)
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                'FROM generate_series(1, %s)',
+                [model._meta.db_table, model._meta.pk.column, len(objs)]
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        for obj, pk in zip(objs, ids):
+            obj.pk = pk
+        manager.bulk_create(objs, batch_size=batch_size)
+    else:
+        with transaction.atomic(using=using):
+            manager.bulk_create(objs, batch_size=batch_size)
+            ids = list(
+                manager.order_by('-pk')
+                .values_list('pk', flat=True)[:len(objs)]
+            )
+        for obj, pk in zip(objs, reversed(ids)):
+            obj.pk = pk
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+    return objs
+
+
+def add_memberships(pairs, sync_emails=True):
+    """
+    Inserts (address_id, group_id) pairs into the Address.groups table.
+    Pairs that already exist are skipped.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return set()
+    existing = set(
+        Membership.objects.filter(
+            address_id__in=set(address_id for address_id, _ in pairs),
+            group_id__in=set(group_id for _, group_id in pairs)
+        ).values_list('address_id', 'group_id')
+    )
+    new = pairs - existing
+    Membership.objects.bulk_create([
+        Membership(address_id=address_id, group_id=group_id)
+        for address_id, group_id in new
+    ])
+    change_counts(Group, 'address_count',
+                  count_groups(group_id for _, group_id in new))
+    memberships_changed(
+        (address_id for address_id, _ in new),
+        (group_id for _, group_id in new),
+        sync_emails=sync_emails
+    )
+    return new
+
+
+def remove_memberships(pairs, sync_emails=True):
+    """
+    Deletes (address_id, group_id) pairs from the Address.groups table and
+    returns the ones that existed.
+    """
+    pairs = set(pairs)
+    if not pairs:
+        return set()
+    rows = dict(
+        ((address_id, group_id), pk) for pk, address_id, group_id in
+        Membership.objects.filter(
+            address_id__in=set(address_id for address_id, _ in pairs),
+            group_id__in=set(group_id for _, group_id in pairs)
+        ).values_list('id', 'address_id', 'group_id')
+        if (address_id, group_id) in pairs
+    )
+    Membership.objects.filter(id__in=rows.values()).delete()
+    change_counts(Group, 'address_count',
+                  count_groups((group_id for _, group_id in rows), -1))
+    memberships_changed(
+        (address_id for address_id, _ in rows),
+        (group_id for _, group_id in rows),
+        sync_emails=sync_emails
+    )
+    return set(rows)
+
+
+def update_addresses(addresses, chunk_size=100, sync_emails=True):
+    """
+    Saves the name and email of addresses with one UPDATE per chunk.
+    """
+    addresses = list(addresses)
+    for start in range(0, len(addresses), chunk_size):
+        chunk = addresses[start:start + chunk_size]
+        values = {}
+        for field in ('name', 'email', 'normalized_email'):
+            values[field] = Case(*[
+                When(id=address.id, then=Value(getattr(address, field)))
+                for address in chunk
+            ], output_field=CharField())
+        Address.objects.filter(
+            id__in=[address.id for address in chunk]
+        ).update(**values)
+    memberships_changed((address.id for address in addresses), [],
+                        sync_emails=sync_emails)
+
+
+def update_group(group, previous_addressbook_id, sync_emails=True):
+    """
+    Saves the name and address book of group with an UPDATE, for callers
+    that sync the email index themselves once the memberships are written.
+    """
+    Group.objects.filter(id=group.id).update(
+        name=group.name, addressbook=group.addressbook_id
+    )
+    group_changed(group, previous_addressbook_id, sync_emails=sync_emails)
+
+
+def delete_addresses(address_ids):
+    """
+    Deletes addresses with their memberships and emails in a fixed number of
+    queries, without loading them.
+    """
+    address_ids = set(address_ids)
+    if not address_ids:
+        return
+    memberships = Membership.objects.filter(address_id__in=address_ids)
+    pairs = set(memberships.values_list(
+        'address_id', 'group_id', 'group__addressbook_id'
+    ))
+    memberships.delete()
+    addresses = Address.objects.filter(id__in=address_ids)
+    # Address has delete signal handlers, so a plain delete() would load
+    # and signal every address. Their related rows are gone by now.
+    AddressBookEmail.objects.filter(address_id__in=address_ids).delete()
+    addresses._raw_delete(addresses.db)
+    change_counts(Group, 'address_count',
+                  count_groups((group_id for _, group_id, _ in pairs), -1))
+    update_address_counts(
+        [], set(addressbook_id for _, _, addressbook_id in pairs)
+    )
+    record_changes(Change.GROUP, set(
+        (group_id, addressbook_id) for _, group_id, addressbook_id in pairs
+    ))
+    record_changes(Change.ADDRESS, set(
+        (address_id, addressbook_id) for address_id, _, addressbook_id in pairs
+    ))
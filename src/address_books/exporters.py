@@ -0,0 +1,139 @@
+"""
+Streaming export of a whole address book as CSV, vCard or NDJSON.
+
+The exporters are generators of text chunks meant for a
+StreamingHttpResponse. Addresses are read in keyset-paginated chunks, so
+neither the queryset nor the response is ever held in memory at once. An
+optional progress callback is given the number of addresses written after
+every chunk.
+"""
+import csv
+import json
+
+from address_books.models import Address, Membership
+
+
+CHUNK_SIZE = 1000
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'vcard': 'text/vcard; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+EXTENSIONS = {
+    'csv': 'csv',
+    'vcard': 'vcf',
+    'ndjson': 'ndjson',
+}
+
+
+def iterate_in_chunks(queryset, chunk_size=CHUNK_SIZE):
+    """
+    Yields lists of objects from queryset ordered by primary key, fetching
+    each chunk with a `pk > last seen` range scan instead of an OFFSET.
+    """
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def addressbook_addresses(addressbook, chunk_size=CHUNK_SIZE,
+                          progress=None):
+    """
+    Yields (address, group ids) for every address of addressbook. Only the
+    groups that belong to addressbook are listed.
+    """
+    count = 0
+    memberships = Membership.objects.filter(group__addressbook=addressbook)
+    addresses = Address.objects.filter(
+        id__in=memberships.values('address_id')
+    ).only('id', 'name', 'email')
+    for chunk in iterate_in_chunks(addresses, chunk_size):
+        groups = {}
+        for address_id, group_id in memberships.filter(
+                address_id__in=[address.id for address in chunk]
+        ).order_by('group_id').values_list('address_id', 'group_id'):
+            groups.setdefault(address_id, []).append(group_id)
+        for address in chunk:
+            yield address, groups.get(address.id, [])
+        count += len(chunk)
+        if progress is not None:
+            progress(count)
+
+
+class Echo(object):
+    """
+    File-like object that hands back what is written to it, so csv.writer
+    can format a single row at a time.
+    """
+
+    def write(self, value):
+        return value
+
+
+def export_csv(addressbook, progress=None):
+    writer = csv.writer(Echo())
+    yield writer.writerow(['id', 'name', 'email', 'groups'])
+    for address, groups in addressbook_addresses(addressbook,
+                                                 progress=progress):
+        yield writer.writerow([
+            address.id, address.name, address.email,
+            ';'.join(str(group) for group in groups)
+        ])
+
+
+def escape_vcard(value):
+    return (
+        value.replace('\\', '\\\\').replace(',', '\\,')
+        .replace(';', '\\;').replace('\n', '\\n')
+    )
+
+
+def export_vcard(addressbook, progress=None):
+    group_names = dict(addressbook.groups.values_list('id', 'name'))
+    for address, groups in addressbook_addresses(addressbook,
+                                                 progress=progress):
+        lines = [
+            'BEGIN:VCARD',
+            'VERSION:3.0',
+            'FN:' + escape_vcard(address.name),
+            'EMAIL:' + escape_vcard(address.email),
+        ]
+        if groups:
+            lines.append('CATEGORIES:' + ','.join(
+                escape_vcard(group_names[group]) for group in groups
+            ))
+        lines.append('END:VCARD')
+        yield '\r\n'.join(lines) + '\r\n'
+
+
+def export_ndjson(addressbook, progress=None):
+    yield json.dumps({
+        'type': 'addressbook', 'id': addressbook.id, 'name': addressbook.name
+    }) + '\n'
+    for group_id, name in addressbook.groups.order_by('id').values_list(
+            'id', 'name'):
+        yield json.dumps({
+            'type': 'group', 'id': group_id, 'name': name
+        }) + '\n'
+    for address, groups in addressbook_addresses(addressbook,
+                                                 progress=progress):
+        yield json.dumps({
+            'type': 'address', 'id': address.id, 'name': address.name,
+            'email': address.email, 'groups': groups
+        }) + '\n'
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'vcard': export_vcard,
+    'ndjson': export_ndjson,
+}
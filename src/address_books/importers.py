@@ -0,0 +1,307 @@
+"""
+Streaming address import from CSV, vCard and NDJSON uploads.
+
+Rows are read lazily from the upload, validated and written in chunks, so
+memory use and query count depend on the chunk size rather than on the
+size of the file.
+"""
+import codecs
+import csv
+import json
+import re
+from itertools import islice
+
+from django.db import transaction
+
+from address_books.bulk import bulk_create_with_ids, add_memberships
+from address_books.models import Address, Group, AddressBookEmail, \
+    normalize_email
+
+
+CHUNK_SIZE = 500
+
+FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'vcard': ('.vcf', '.vcard', 'text/vcard', 'text/x-vcard'),
+    'ndjson': ('.ndjson', '.jsonl', 'application/x-ndjson',
+               'application/jsonl'),
+}
+
+
+def detect_format(upload):
+    name = (upload.name or '').lower()
+    content_type = (upload.content_type or '').lower()
+    for format, markers in FORMATS.items():
+        for marker in markers:
+            if name.endswith(marker) or content_type == marker:
+                return format
+    return None
+
+
+def split_groups(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [group for group in re.split(r'[;,\s]+', value or '') if group]
+
+
+def read_csv(lines):
+    """
+    Reads rows with a header line. Recognised columns are name, email and
+    groups, the latter holding group ids separated by semicolons.
+    """
+    for row in csv.DictReader(lines):
+        yield {
+            'name': row.get('name'),
+            'email': row.get('email'),
+            'groups': split_groups(row.get('groups')),
+        }
+
+
+def read_ndjson(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield {'errors': {'non_field_errors': ['Invalid JSON']}}
+            continue
+        if not isinstance(row, dict):
+            yield {'errors': {'non_field_errors': ['Expected an object']}}
+            continue
+        yield {
+            'name': row.get('name'),
+            'email': row.get('email'),
+            'groups': split_groups(row.get('groups')),
+        }
+
+
+def unfold_vcard_lines(lines):
+    """
+    Joins folded vCard lines, which continue on the next line after a
+    leading space or tab.
+    """
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def read_vcard(lines):
+    """
+    Reads one address per vCard from its FN (or N) and first EMAIL.
+    """
+    card = None
+    for line in unfold_vcard_lines(lines):
+        key, _, value = line.partition(':')
+        key = key.split(';')[0].upper()
+        if key == 'BEGIN' and value.upper() == 'VCARD':
+            card = {'name': None, 'email': None, 'groups': []}
+        elif card is None:
+            continue
+        elif key == 'END':
+            yield card
+            card = None
+        elif key == 'FN':
+            card['name'] = value
+        elif key == 'N' and not card['name']:
+            parts = [part for part in value.split(';')[:2] if part]
+            card['name'] = ' '.join(reversed(parts))
+        elif key == 'EMAIL' and not card['email']:
+            card['email'] = value
+
+
+READERS = {
+    'csv': read_csv,
+    'vcard': read_vcard,
+    'ndjson': read_ndjson,
+}
+
+
+def stop_at_read_error(rows):
+    """
+    Yields rows until the file cannot be read any further, then an error
+    row in place of the unreadable one. Chunks before it are already saved,
+    so the import reports them instead of failing as a whole.
+    """
+    rows = iter(rows)
+    while True:
+        try:
+            row = next(rows)
+        except StopIteration:
+            return
+        except UnicodeDecodeError:
+            yield {'errors': {
+                'non_field_errors': ['The file is not UTF-8 encoded']
+            }}
+            return
+        except csv.Error as e:
+            yield {'errors': {'non_field_errors': ['Invalid CSV: %s' % e]}}
+            return
+        yield row
+
+
+class AddressImporter(object):
+    """
+    Validates and inserts imported rows for a user.
+
+    Each row gets the groups listed in it plus default_groups. Every chunk
+    costs a fixed number of queries: one to resolve unseen group ids, one for
+    duplicate emails, and the bulk inserts.
+    """
+
+    def __init__(self, user, default_groups=(), chunk_size=CHUNK_SIZE):
+        self.user = user
+        self.default_groups = list(default_groups)
+        self.chunk_size = chunk_size
+        self.group_books = {}
+        self.seen_emails = set()
+        self.created = 0
+        self.errors = []
+
+    def run(self, rows, progress=None):
+        """
+        Imports rows and returns the report. progress is called with the
+        number of rows read after every chunk.
+        """
+        rows = stop_at_read_error(rows)
+        row_number = 1
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            self.import_chunk(list(enumerate(chunk, row_number)))
+            row_number += len(chunk)
+            if progress is not None:
+                progress(row_number - 1)
+        self.errors.sort(key=lambda error: error['row'])
+        return {'created': self.created, 'errors': self.errors}
+
+    def import_chunk(self, chunk):
+        valid = []
+        for row_number, row in chunk:
+            errors = self.clean_row(row)
+            if errors:
+                self.errors.append({'row': row_number, 'errors': errors})
+            else:
+                valid.append((row_number, row))
+        self.resolve_groups(row for _, row in valid)
+        valid = [
+            (row_number, row) for row_number, row in valid
+            if self.check_groups(row_number, row)
+        ]
+        existing = self.existing_emails(row for _, row in valid)
+        addresses = []
+        for row_number, row in valid:
+            keys = set(
+                (normalize_email(row['email']), self.group_books[group])
+                for group in row['groups']
+            )
+            if keys & (existing | self.seen_emails):
+                self.errors.append({
+                    'row': row_number,
+                    'errors': {'non_field_errors': ['Duplicate email address']}
+                })
+                continue
+            self.seen_emails.update(keys)
+            address = Address(name=row['name'], email=row['email'],
+                              normalized_email=normalize_email(row['email']))
+            addresses.append((address, row['groups']))
+        if addresses:
+            self.save(addresses)
+
+    def clean_row(self, row):
+        if 'errors' in row:
+            return row['errors']
+        errors = {}
+        for field in ('name', 'email'):
+            value = (row.get(field) or '').strip()
+            if not value:
+                errors[field] = ['This field is required.']
+            elif len(value) > 255:
+                errors[field] = [
+                    'Ensure this field has no more than 255 characters.'
+                ]
+            row[field] = value
+        try:
+            row['groups'] = sorted(set(
+                int(group) for group in row['groups'] + self.default_groups
+            ))
+        except (TypeError, ValueError):
+            errors['groups'] = ['Invalid group set']
+        else:
+            if not row['groups']:
+                errors['groups'] = ['This list may not be empty.']
+        return errors
+
+    def resolve_groups(self, rows):
+        unseen = set()
+        for row in rows:
+            unseen.update(
+                group for group in row['groups']
+                if group not in self.group_books
+            )
+        if not unseen:
+            return
+        visible = dict(
+            Group.objects.visible_to(self.user).filter(id__in=unseen)
+            .values_list('id', 'addressbook_id')
+        )
+        for group in unseen:
+            self.group_books[group] = visible.get(group)
+
+    def check_groups(self, row_number, row):
+        if any(self.group_books[group] is None for group in row['groups']):
+            self.errors.append({
+                'row': row_number, 'errors': {'groups': ['Invalid group set']}
+            })
+            return False
+        return True
+
+    def existing_emails(self, rows):
+        """
+        Returns the (email, address book id) pairs already taken by any of
+        the rows, in a single query.
+        """
+        emails = set()
+        books = set()
+        for row in rows:
+            emails.add(normalize_email(row['email']))
+            books.update(self.group_books[group] for group in row['groups'])
+        if not emails:
+            return set()
+        return set(
+            AddressBookEmail.objects.filter(
+                email__in=emails, addressbook_id__in=books
+            ).values_list('email', 'addressbook_id')
+        )
+
+    @transaction.atomic
+    def save(self, addresses):
+        bulk_create_with_ids(Address, [address for address, _ in addresses])
+        add_memberships(
+            (address.id, group)
+            for address, groups in addresses for group in groups
+        )
+        self.created += len(addresses)
+
+
+def import_addresses(user, upload, format=None, default_groups=()):
+    """
+    Imports the addresses in an uploaded file and returns a report with the
+    number of created addresses and the errors of every rejected row.
+    """
+    format = format or detect_format(upload)
+    if format not in READERS:
+        raise ValueError('Unsupported import format')
+    lines = codecs.iterdecode(upload, 'utf-8-sig')
+    importer = AddressImporter(user, default_groups)
+    return importer.run(READERS[format](lines))
@@ -0,0 +1,248 @@
+"""
+Background imports, exports and deletes.
+
+The views store a Job row and answer right away; the run_jobs command
+claims pending jobs and runs them outside the request cycle. The database
+is the queue: a job is claimed by an UPDATE that only succeeds while it is
+still pending, so several workers never run the same job. Progress is
+written after every chunk, and the result, output or error when the job
+ends. Uploaded files and exports go through file storage and are streamed,
+never held in memory as a whole. The upload is deleted when the job ends,
+the export along with its job, and prune_jobs() deletes the jobs that
+finished more than JOB_RETENTION seconds ago.
+
+Every progress report moves the job's heartbeat. A running job whose
+heartbeat is older than JOB_TIMEOUT seconds lost its worker and is queued
+again, or failed once it was claimed MAX_ATTEMPTS times. Claims are
+counted, and only the worker of the latest one may still write to the job.
+"""
+import codecs
+import json
+import logging
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from address_books import membership
+from address_books.access import accessible_address_ids
+from address_books.bulk import delete_addresses
+from address_books.exporters import EXPORTERS, EXTENSIONS
+from address_books.importers import READERS, AddressImporter, detect_format
+from address_books.models import AddressBook, Job
+
+
+logger = logging.getLogger(__name__)
+
+PERMISSIONS = {
+    Job.IMPORT: 'address_books.add_address',
+    Job.EXPORT: None,
+    Job.DELETE: 'address_books.delete_address',
+}
+
+# Claims of a job before it is failed instead of queued again
+MAX_ATTEMPTS = 3
+
+
+class Reclaimed(Exception):
+    """
+    Raised in a worker whose job was queued again after its heartbeat
+    timed out.
+    """
+
+
+def timeout():
+    return getattr(settings, 'JOB_TIMEOUT', 600)
+
+
+def retention():
+    return getattr(settings, 'JOB_RETENTION', 7 * 24 * 3600)
+
+
+def enqueue(user, kind, input=None, **arguments):
+    job = Job(user=user, kind=kind, arguments=json.dumps(arguments))
+    if input is not None:
+        job.input.save(input.name, input, save=False)
+    job.save()
+    return job
+
+
+def queue_import(user, upload, format=None, groups=()):
+    """
+    Queues the import of an uploaded file. Raises ValueError with the name
+    of the offending field.
+    """
+    format = format or detect_format(upload)
+    if format not in READERS:
+        raise ValueError('file', 'Unsupported import format')
+    return enqueue(user, Job.IMPORT, upload, format=format,
+                   groups=list(groups))
+
+
+def queue_export(user, addressbook, format):
+    if format not in EXPORTERS:
+        raise ValueError('type', 'Unsupported export format')
+    try:
+        addressbook = int(addressbook)
+    except (TypeError, ValueError):
+        raise ValueError('addressbook', 'Invalid address book')
+    if not AddressBook.objects.visible_to(user).filter(
+            id=addressbook).exists():
+        raise ValueError('addressbook', 'Invalid address book')
+    return enqueue(user, Job.EXPORT, addressbook=addressbook, format=format)
+
+
+def queue_delete(user, data):
+    """
+    Queues the deletion of the addresses listed in `addresses`, or of those
+    matching the `group` and `q` filters, as selected now.
+    """
+    addresses = membership.select_addresses(user, data)
+    return enqueue(user, Job.DELETE, addresses=sorted(addresses))
+
+
+def claimed(job):
+    """
+    Returns a queryset of job as long as it is still claimed by the worker
+    that was handed it.
+    """
+    return Job.objects.filter(id=job.id, status=Job.RUNNING,
+                              attempts=job.attempts)
+
+
+def report(job, progress, total=None):
+    job.progress = progress
+    if total is not None:
+        job.total = total
+    if not claimed(job).update(progress=job.progress, total=job.total,
+                               heartbeat=timezone.now()):
+        raise Reclaimed('Job %s was claimed again' % job.id)
+
+
+def run_import(job, format, groups=()):
+    importer = AddressImporter(job.user, groups)
+    with job.input.storage.open(job.input.name, 'rb') as input:
+        rows = READERS[format](codecs.iterdecode(input, 'utf-8-sig'))
+        return importer.run(rows, lambda count: report(job, count))
+
+
+def run_export(job, addressbook, format):
+    addressbook = AddressBook.objects.visible_to(job.user).get(
+        id=addressbook
+    )
+    report(job, 0, addressbook.address_count)
+    with tempfile.TemporaryFile() as output:
+        # Progress counts addresses, not the header and group lines
+        for item in EXPORTERS[format](
+                addressbook, progress=lambda count: report(job, count)):
+            output.write(item.encode('utf-8'))
+        report(job, job.progress, job.progress)
+        job.output.save('%s.%s' % (job.id, EXTENSIONS[format]),
+                        File(output), save=False)
+    return {'format': format}
+
+
+def run_delete(job, addresses):
+    # Addresses the user lost access to since the job was queued are kept
+    address_ids = accessible_address_ids(job.user, addresses)
+    report(job, 0, len(address_ids))
+    deleted = 0
+    for chunk in membership.chunks(address_ids):
+        with transaction.atomic():
+            delete_addresses(chunk)
+        deleted += len(chunk)
+        report(job, deleted)
+    return {'deleted': deleted}
+
+
+RUNNERS = {
+    Job.IMPORT: run_import,
+    Job.EXPORT: run_export,
+    Job.DELETE: run_delete,
+}
+
+
+def reclaim():
+    """
+    Queues the running jobs whose worker stopped again, or fails them if
+    they ran out of attempts.
+    """
+    now = timezone.now()
+    # The heartbeat is checked by the UPDATE itself, so a worker reporting
+    # at the same time keeps its job
+    stale = Job.objects.filter(
+        status=Job.RUNNING, heartbeat__lt=now - timedelta(seconds=timeout())
+    )
+    for job_id in stale.filter(attempts__gte=MAX_ATTEMPTS) \
+            .values_list('id', flat=True):
+        if stale.filter(id=job_id).update(
+                status=Job.FAILED, finished=now,
+                error='The worker running the job stopped'):
+            logger.error('Job %s failed, its worker stopped', job_id)
+    for job_id in stale.values_list('id', flat=True):
+        if stale.filter(id=job_id).update(status=Job.PENDING):
+            logger.warning('Job %s queued again, its worker stopped', job_id)
+
+
+def claim():
+    """
+    Marks the oldest pending job as running and returns it, or None if
+    there is nothing to do.
+    """
+    reclaim()
+    while True:
+        job_id = Job.objects.filter(status=Job.PENDING).order_by('id') \
+            .values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        now = timezone.now()
+        # Another worker may have claimed it since
+        if Job.objects.filter(id=job_id, status=Job.PENDING).update(
+                status=Job.RUNNING, started=now, heartbeat=now,
+                attempts=F('attempts') + 1):
+            return Job.objects.select_related('user').get(id=job_id)
+
+
+def run(job):
+    try:
+        result = RUNNERS[job.kind](job, **json.loads(job.arguments))
+    except Reclaimed:
+        logger.warning('Job %s was claimed again, stopping', job.id)
+        return job
+    except Exception as e:
+        logger.exception('Job %s failed', job.id)
+        job.status = Job.FAILED
+        job.error = str(e)
+    else:
+        job.status = Job.DONE
+        job.result = json.dumps(result)
+    job.finished = timezone.now()
+    if not claimed(job).update(status=job.status, result=job.result,
+                               input='', output=job.output.name,
+                               error=job.error, finished=job.finished):
+        logger.warning('Job %s was claimed again, dropping its result',
+                       job.id)
+        if job.output:
+            job.output.delete(save=False)
+        return job
+    # The upload is not needed anymore
+    if job.input:
+        job.input.delete(save=False)
+    return job
+
+
+def prune_jobs():
+    """
+    Deletes the jobs that finished longer than JOB_RETENTION seconds ago,
+    with their files, and returns how many were deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=retention())
+    old = Job.objects.filter(status__in=[Job.DONE, Job.FAILED],
+                             finished__lt=cutoff)
+    count = old.count()
+    old.delete()
+    return count
@@ -0,0 +1,30 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_test_environment
+
+from address_books.benchmark import scenarios
+
+
+class Command(BaseCommand):
+    help = ('Times every API URL against the data created by benchmark_data '
+            'and writes the results as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--warmup', type=int, default=1)
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            help='Only run scenarios starting with this name')
+
+    def handle(self, *args, **options):
+        # Lets the test client's host through ALLOWED_HOSTS
+        setup_test_environment()
+        results = scenarios.run(
+            iterations=options['iterations'], warmup=options['warmup'],
+            names=options['scenarios'], log=self.stdout.write
+        )
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+            output.write('\n')
+        self.stdout.write('Results written to %s' % options['output'])
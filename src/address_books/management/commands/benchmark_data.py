@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from address_books.benchmark import generator
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with synthetic data for the benchmarks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10)
+        parser.add_argument('--addressbooks', type=int, default=5,
+                            help='Address books owned by each user')
+        parser.add_argument('--groups', type=int, default=10,
+                            help='Groups in each address book')
+        parser.add_argument('--addresses', type=int, default=1000,
+                            help='Addresses in each address book')
+        parser.add_argument('--shared', type=int, default=2,
+                            help='Users each address book is shared with')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete the data of a previous run first')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            generator.clear()
+        generator.generate(
+            users=options['users'], addressbooks=options['addressbooks'],
+            groups=options['groups'], addresses=options['addresses'],
+            shared=options['shared'], seed=options['seed'],
+            log=self.stdout.write
+        )
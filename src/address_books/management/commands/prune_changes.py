@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from address_books.sync import prune_changes
+
+
+class Command(BaseCommand):
+    help = ('Deletes the logged changes that are older than any valid sync '
+            'token. Meant to be run periodically.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Deleted %s changes' % prune_changes())
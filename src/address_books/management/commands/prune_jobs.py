@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from address_books.jobs import prune_jobs
+
+
+class Command(BaseCommand):
+    help = ('Deletes the background jobs, and their files, that finished '
+            'more than JOB_RETENTION seconds ago. Meant to be run '
+            'periodically.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Deleted %s jobs' % prune_jobs())
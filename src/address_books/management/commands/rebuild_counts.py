@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from address_books.models import AddressBook, Group, update_group_counts, \
+    update_address_counts
+
+
+class Command(BaseCommand):
+    help = ('Recounts the groups and addresses of every address book and '
+            'the addresses of every group.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def chunks(self, queryset, chunk_size):
+        ids = list(queryset.order_by('id').values_list('id', flat=True))
+        for start in range(0, len(ids), chunk_size):
+            yield ids[start:start + chunk_size]
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        for chunk in self.chunks(Group.objects.all(), chunk_size):
+            with transaction.atomic():
+                update_address_counts(chunk, [])
+        for chunk in self.chunks(AddressBook.objects.all(), chunk_size):
+            with transaction.atomic():
+                update_group_counts(chunk)
+                update_address_counts([], chunk)
+        self.stdout.write('Counts rebuilt for %s address books and %s groups'
+                          % (AddressBook.objects.count(),
+                             Group.objects.count()))
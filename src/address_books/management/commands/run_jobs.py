@@ -0,0 +1,46 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+
+from address_books import jobs
+
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Runs the queued background jobs, waiting for new ones until '
+            'stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Stop when no job is left')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between checks for new jobs')
+
+    def handle(self, *args, **options):
+        while True:
+            # As between requests, so a connection the database dropped is
+            # opened again instead of failing every job after it
+            close_old_connections()
+            try:
+                job = jobs.claim()
+            except DatabaseError:
+                logger.exception('Could not claim a job')
+                time.sleep(options['interval'])
+                continue
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+                continue
+            self.stdout.write('Running %s job %s' % (job.kind, job.id))
+            try:
+                job = jobs.run(job)
+            except DatabaseError:
+                # The job is claimed again once its heartbeat times out
+                logger.exception('Could not save job %s', job.id)
+                continue
+            self.stdout.write('Job %s %s' % (job.id, job.status))
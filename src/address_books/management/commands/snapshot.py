@@ -0,0 +1,46 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from address_books import snapshots
+
+
+class Command(BaseCommand):
+    help = ('Dumps the address books, groups, addresses and their relations '
+            'to a directory with one file per table, or loads such a dump. '
+            'Uses COPY on PostgreSQL and batched inserts elsewhere.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['dump', 'load'])
+        parser.add_argument('directory')
+        parser.add_argument('--format', choices=snapshots.FORMATS,
+                            default='csv',
+                            help='binary is only available on PostgreSQL')
+        parser.add_argument('--owner',
+                            help='Only dump the address books of this user')
+        parser.add_argument('--truncate', action='store_true',
+                            help='Delete all existing rows before loading')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        owner = None
+        if options['owner']:
+            try:
+                owner = User.objects.get(username=options['owner'])
+            except User.DoesNotExist:
+                raise CommandError('No user named %s' % options['owner'])
+        try:
+            if options['action'] == 'dump':
+                snapshots.dump(
+                    options['directory'], owner=owner,
+                    format=options['format'], using=options['database'],
+                    log=self.stdout.write
+                )
+            else:
+                snapshots.load(
+                    options['directory'], format=options['format'],
+                    truncate=options['truncate'],
+                    using=options['database'], log=self.stdout.write
+                )
+        except ValueError as e:
+            raise CommandError(str(e))
@@ -0,0 +1,137 @@
+"""
+Adding, removing and moving many addresses in and out of a group.
+
+Addresses are selected by id or with the filters of the address list, and
+only their ids are read. The membership rows are then written in chunks
+with the set-based helpers from address_books.bulk.
+"""
+from django.db import transaction
+
+from address_books.access import accessible_address_ids, \
+    accessible_group_ids
+from address_books.bulk import add_memberships, remove_memberships
+from address_books.models import Address, AddressBookEmail, Membership
+
+
+CHUNK_SIZE = 500
+
+
+def chunks(ids, chunk_size=CHUNK_SIZE):
+    ids = sorted(ids)
+    for start in range(0, len(ids), chunk_size):
+        yield ids[start:start + chunk_size]
+
+
+def select_addresses(user, data):
+    """
+    Returns the ids of the addresses listed in `addresses`, or of those
+    matching the `group` and `q` filters. Raises ValueError with the name
+    of the offending field.
+    """
+    if data.get('addresses') is not None:
+        try:
+            ids = set(int(pk) for pk in data['addresses'])
+        except (TypeError, ValueError):
+            raise ValueError('addresses', 'Invalid address set')
+        if accessible_address_ids(user, ids) != ids:
+            raise ValueError('addresses', 'Invalid address set')
+        return ids
+    group = data.get('group')
+    query = data.get('q')
+    if group is None and not query:
+        raise ValueError('addresses',
+                         'Either addresses, group or q is required.')
+    queryset = Address.objects.visible_to(user)
+    if group is not None:
+        try:
+            group = int(group)
+        except (TypeError, ValueError):
+            raise ValueError('group', 'Invalid group')
+        if not accessible_group_ids(user, [group]):
+            raise ValueError('group', 'Invalid group')
+        queryset = queryset.filter(groups__id=group)
+    if query:
+        # Only the filter is wanted, not the ranking
+        queryset = queryset.search(query).order_by()
+    return set(queryset.values_list('id', flat=True))
+
+
+def in_group(group, address_ids):
+    """
+    Returns the ids among address_ids of the addresses in group.
+    """
+    members = set()
+    for chunk in chunks(address_ids):
+        members.update(
+            Membership.objects.filter(group_id=group.id, address_id__in=chunk)
+            .values_list('address_id', flat=True)
+        )
+    return members
+
+
+def duplicate_emails(addressbook_id, address_ids):
+    """
+    Returns the ids of the addresses whose email is already taken in the
+    address book by another address, or by another one of address_ids.
+    """
+    duplicates = set()
+    owners = {}
+    for chunk in chunks(address_ids):
+        emails = dict(
+            Address.objects.filter(id__in=chunk)
+            .values_list('id', 'normalized_email')
+        )
+        for address_id, email in emails.items():
+            if owners.setdefault(email, address_id) != address_id:
+                duplicates.add(address_id)
+        for email, address_id in AddressBookEmail.objects.filter(
+                addressbook_id=addressbook_id,
+                email__in=set(emails.values())
+        ).values_list('email', 'address_id'):
+            if address_id not in address_ids:
+                duplicates.update(
+                    pk for pk, pk_email in emails.items() if pk_email == email
+                )
+    return duplicates
+
+
+@transaction.atomic
+def add_addresses(group, address_ids):
+    """
+    Adds the addresses to group and returns how many were not in it yet.
+    """
+    added = 0
+    for chunk in chunks(address_ids):
+        added += len(add_memberships(
+            (address_id, group.id) for address_id in chunk
+        ))
+    return added
+
+
+@transaction.atomic
+def remove_addresses(group, address_ids):
+    """
+    Removes the addresses from group and returns how many were in it.
+    """
+    removed = 0
+    for chunk in chunks(address_ids):
+        removed += len(remove_memberships(
+            (address_id, group.id) for address_id in chunk
+        ))
+    return removed
+
+
+@transaction.atomic
+def move_addresses(group, target, address_ids):
+    """
+    Moves the addresses of group among address_ids to target and returns
+    how many were moved.
+    """
+    moved = 0
+    for chunk in chunks(address_ids):
+        removed = remove_memberships(
+            (address_id, group.id) for address_id in chunk
+        )
+        add_memberships((address_id, target.id) for address_id, _ in removed)
+        moved += len(removed)
+    return moved
@@ -0,0 +1,215 @@
+"""
+In-process request metrics, exposed in the Prometheus text format.
+
+MetricsMiddleware records the latency, SQL query count and SQL time of
+every request under its URL name, and serializers report the time they
+spend in to_representation through serializer_timer. Each worker process
+keeps its own totals. They are served to staff users and to the addresses
+listed in METRICS_ALLOWED_IPS.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.permissions import BasePermission
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+_lock = threading.Lock()
+_local = threading.local()
+_stats = {}
+
+
+class URLStats(object):
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.latency = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+
+    def copy(self):
+        copy = URLStats()
+        copy.__dict__.update(self.__dict__)
+        copy.buckets = list(self.buckets)
+        return copy
+
+    def add(self, latency, queries, query_time, serializer_time):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.buckets[index] += 1
+        self.count += 1
+        self.latency += latency
+        self.queries += queries
+        self.query_time += query_time
+        self.serializer_time += serializer_time
+
+
+def record(url_name, latency, queries, query_time, serializer_time):
+    with _lock:
+        stats = _stats.get(url_name)
+        if stats is None:
+            stats = _stats[url_name] = URLStats()
+        stats.add(latency, queries, query_time, serializer_time)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+@contextmanager
+def serializer_timer():
+    """
+    Adds the time spent in the block to the current request's serializer
+    time. Nested blocks are only counted once.
+    """
+    if getattr(_local, 'timing', False):
+        yield
+        return
+    _local.timing = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _local.timing = False
+        _local.serializer_time = (
+            getattr(_local, 'serializer_time', 0.0)
+            + time.perf_counter() - start
+        )
+
+
+class QueryCountingCursor(object):
+    """
+    Wraps a database cursor to add the queries it runs and their time to
+    the current request's totals, without keeping the SQL like the debug
+    cursor does.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def measure(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            if getattr(_local, 'counting', False):
+                _local.queries += 1
+                _local.query_time += time.perf_counter() - start
+
+    def execute(self, sql, params=None):
+        return self.measure(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.measure(self.cursor.executemany, sql, param_list)
+
+
+def count_queries(connection):
+    """
+    Makes the cursors of connection count their queries. Does nothing if
+    they already do.
+    """
+    if getattr(connection, '_metrics_counting', False):
+        return
+    cursor = connection.cursor
+    connection.cursor = lambda: QueryCountingCursor(cursor())
+    connection._metrics_counting = True
+
+
+class MetricsMiddleware(object):
+    """
+    Should come first in MIDDLEWARE_CLASSES so the latency covers the
+    other middleware too.
+    """
+
+    def process_request(self, request):
+        request._metrics_start = time.perf_counter()
+        for connection in connections.all():
+            count_queries(connection)
+        _local.counting = True
+        _local.queries = 0
+        _local.query_time = 0.0
+        _local.serializer_time = 0.0
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_metrics_start'):
+            return response
+        latency = time.perf_counter() - request._metrics_start
+        _local.counting = False
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.url_name if match is not None else None
+        record(url_name or 'unresolved', latency, _local.queries,
+               _local.query_time, getattr(_local, 'serializer_time', 0.0))
+        return response
+
+
+def _label(url_name):
+    return url_name.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def render():
+    with _lock:
+        stats = sorted(
+            (url_name, url_stats.copy())
+            for url_name, url_stats in _stats.items()
+        )
+    lines = [
+        '# HELP addressbooks_request_duration_seconds Request latency.',
+        '# TYPE addressbooks_request_duration_seconds histogram',
+    ]
+    for url_name, url_stats in stats:
+        label = 'url_name="%s"' % _label(url_name)
+        for bound, count in zip(LATENCY_BUCKETS, url_stats.buckets):
+            lines.append(
+                'addressbooks_request_duration_seconds_bucket{%s,le="%s"} %s'
+                % (label, bound, count)
+            )
+        lines.append(
+            'addressbooks_request_duration_seconds_bucket{%s,le="+Inf"} %s'
+            % (label, url_stats.count)
+        )
+        lines.append('addressbooks_request_duration_seconds_sum{%s} %r'
+                     % (label, url_stats.latency))
+        lines.append('addressbooks_request_duration_seconds_count{%s} %s'
+                     % (label, url_stats.count))
+    for name, attribute, help_text in (
+            ('addressbooks_sql_queries_total', 'queries',
+             'SQL queries run.'),
+            ('addressbooks_sql_duration_seconds_total', 'query_time',
+             'Time spent in SQL queries.'),
+            ('addressbooks_serializer_duration_seconds_total',
+             'serializer_time', 'Time spent serializing responses.')):
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for url_name, url_stats in stats:
+            lines.append('%s{url_name="%s"} %r' % (
+                name, _label(url_name), getattr(url_stats, attribute)
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+class CanReadMetrics(BasePermission):
+    def has_permission(self, request, view):
+        allowed = getattr(settings, 'METRICS_ALLOWED_IPS', ())
+        if request.META.get('REMOTE_ADDR') in allowed:
+            return True
+        return request.user is not None and request.user.is_staff
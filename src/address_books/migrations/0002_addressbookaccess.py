@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+def populate_access(apps, schema_editor):
+    AddressBook = apps.get_model('address_books', 'AddressBook')
+    AddressBookAccess = apps.get_model('address_books', 'AddressBookAccess')
+    rows = set(AddressBook.objects.values_list('owner_id', 'id'))
+    rows.update(
+        AddressBook.shared_with.through.objects
+        .values_list('user_id', 'addressbook_id')
+    )
+    AddressBookAccess.objects.bulk_create([
+        AddressBookAccess(user_id=user_id, addressbook_id=addressbook_id)
+        for user_id, addressbook_id in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('address_books', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressBookAccess',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='addressbook',
+            options={'permissions': (('share_addressbook', 'Can share address books'),)},
+        ),
+        migrations.AlterModelOptions(
+            name='permissiondummy',
+            options={'permissions': (('assign_permissions', 'Can assign permissions'),)},
+        ),
+        migrations.AlterField(
+            model_name='addressbook',
+            name='name',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AddField(
+            model_name='addressbookaccess',
+            name='addressbook',
+            field=models.ForeignKey(related_name='access', to='address_books.AddressBook'),
+        ),
+        migrations.AddField(
+            model_name='addressbookaccess',
+            name='user',
+            field=models.ForeignKey(related_name='address_book_access', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='addressbookaccess',
+            unique_together=set([('user', 'addressbook')]),
+        ),
+        migrations.RunPython(populate_access, migrations.RunPython.noop),
+    ]
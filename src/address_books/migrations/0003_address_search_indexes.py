@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+INDEXED_COLUMNS = ('name', 'email')
+
+
+def create_search_indexes(apps, schema_editor):
+    # The case-insensitive lookups compare UPPER("column"::text) on
+    # PostgreSQL, so the trigram indexes are built on that expression.
+    # SQLite gets plain NOCASE indexes, which serve the prefix matches.
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for column in INDEXED_COLUMNS:
+            schema_editor.execute(
+                'CREATE INDEX address_books_address_%s_trgm '
+                'ON address_books_address '
+                'USING gin (UPPER("%s"::text) gin_trgm_ops)'
+                % (column, column)
+            )
+    elif vendor == 'sqlite':
+        for column in INDEXED_COLUMNS:
+            schema_editor.execute(
+                'CREATE INDEX address_books_address_%s_nocase '
+                'ON address_books_address ("%s" COLLATE NOCASE)'
+                % (column, column)
+            )
+
+
+def drop_search_indexes(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    suffix = {'postgresql': 'trgm', 'sqlite': 'nocase'}.get(vendor)
+    if suffix is None:
+        return
+    for column in INDEXED_COLUMNS:
+        schema_editor.execute(
+            'DROP INDEX IF EXISTS address_books_address_%s_%s'
+            % (column, suffix)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0002_addressbookaccess'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
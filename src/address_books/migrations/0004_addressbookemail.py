@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import models, migrations
+from django.db.models import F, Func
+from django.db.models.functions import Lower
+
+
+CHUNK_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def populate_emails(apps, schema_editor):
+    Address = apps.get_model('address_books', 'Address')
+    AddressBookEmail = apps.get_model('address_books', 'AddressBookEmail')
+    Membership = Address.groups.through
+
+    # The SQL spelling of models.normalize_email()
+    Address.objects.update(
+        normalized_email=Lower(Func(F('email'), function='TRIM'))
+    )
+
+    # Addresses are indexed in id order, so the oldest address keeps its
+    # email and any later duplicate in the same address book is reported.
+    taken = {}
+    rows = []
+    duplicates = []
+    memberships = Membership.objects.order_by('address_id').values_list(
+        'address_id', 'group__addressbook_id', 'address__normalized_email'
+    ).distinct()
+    for address_id, addressbook_id, email in memberships.iterator():
+        owner = taken.setdefault((addressbook_id, email), address_id)
+        if owner == address_id:
+            rows.append((addressbook_id, email, address_id))
+        else:
+            duplicates.append((address_id, owner, addressbook_id, email))
+    AddressBookEmail.objects.bulk_create([
+        AddressBookEmail(addressbook_id=addressbook_id, email=email,
+                         address_id=address_id)
+        for addressbook_id, email, address_id in rows
+    ], batch_size=CHUNK_SIZE)
+    for address_id, owner, addressbook_id, email in duplicates:
+        logger.warning(
+            'Address %s duplicates address %s in address book %s (%s)',
+            address_id, owner, addressbook_id, email
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0003_address_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='normalized_email',
+            field=models.CharField(default='', max_length=255, editable=False, db_index=True),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='AddressBookEmail',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('email', models.CharField(max_length=255)),
+                ('address', models.ForeignKey(related_name='addressbook_emails', to='address_books.Address')),
+                ('addressbook', models.ForeignKey(related_name='emails', to='address_books.AddressBook')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='addressbookemail',
+            unique_together=set([('addressbook', 'email')]),
+        ),
+        migrations.RunPython(populate_emails, migrations.RunPython.noop),
+    ]
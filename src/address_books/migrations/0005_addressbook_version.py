@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0004_addressbookemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='addressbook',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0005_addressbook_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('kind', models.CharField(max_length=16, choices=[('addressbook', 'Address book'), ('group', 'Group'), ('address', 'Address'), ('access', 'Access')])),
+                ('object_id', models.PositiveIntegerField()),
+                ('addressbook_id', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='change',
+            index_together=set([('addressbook_id', 'id'), ('kind', 'object_id')]),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def populate_counts(apps, schema_editor):
+    AddressBook = apps.get_model('address_books', 'AddressBook')
+    Group = apps.get_model('address_books', 'Group')
+    Membership = apps.get_model('address_books', 'Address').groups.through
+    quote_name = schema_editor.connection.ops.quote_name
+    tables = {
+        'addressbook': quote_name(AddressBook._meta.db_table),
+        'group': quote_name(Group._meta.db_table),
+        'membership': quote_name(Membership._meta.db_table),
+    }
+    schema_editor.execute(
+        'UPDATE %(group)s SET address_count = ('
+        'SELECT COUNT(*) FROM %(membership)s '
+        'WHERE %(membership)s.group_id = %(group)s.id)' % tables
+    )
+    schema_editor.execute(
+        'UPDATE %(addressbook)s SET group_count = ('
+        'SELECT COUNT(*) FROM %(group)s '
+        'WHERE %(group)s.addressbook_id = %(addressbook)s.id)' % tables
+    )
+    schema_editor.execute(
+        'UPDATE %(addressbook)s SET address_count = ('
+        'SELECT COUNT(DISTINCT %(membership)s.address_id) '
+        'FROM %(membership)s INNER JOIN %(group)s '
+        'ON %(membership)s.group_id = %(group)s.id '
+        'WHERE %(group)s.addressbook_id = %(addressbook)s.id)' % tables
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0006_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='addressbook',
+            name='address_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='addressbook',
+            name='group_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='group',
+            name='address_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import models, migrations
+
+
+FILE_FIELDS = ('input', 'output')
+
+
+def move_to_storage(apps, schema_editor):
+    """
+    Writes the text of the input and output columns to files and keeps
+    their names in the columns instead.
+    """
+    Job = apps.get_model('address_books', 'Job')
+    for field in FILE_FIELDS:
+        jobs = Job.objects.exclude(**{field: ''}).values_list('id', field)
+        for job_id, text in jobs.iterator():
+            name = default_storage.save(
+                'jobs/%s/%s' % (field, job_id),
+                ContentFile(text.encode('utf-8'))
+            )
+            Job.objects.filter(id=job_id).update(**{field: name})
+
+
+def move_from_storage(apps, schema_editor):
+    Job = apps.get_model('address_books', 'Job')
+    for field in FILE_FIELDS:
+        jobs = Job.objects.exclude(**{field: ''}).values_list('id', field)
+        for job_id, name in jobs.iterator():
+            with default_storage.open(name, 'rb') as file:
+                text = file.read().decode('utf-8')
+            Job.objects.filter(id=job_id).update(**{field: text})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0009_change_created'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_to_storage, move_from_storage),
+        migrations.AlterField(
+            model_name='job',
+            name='input',
+            field=models.FileField(upload_to='jobs/input', blank=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='output',
+            field=models.FileField(upload_to='jobs/output', blank=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='heartbeat',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
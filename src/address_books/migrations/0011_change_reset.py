@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_books', '0010_job_files'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='change',
+            name='kind',
+            field=models.CharField(max_length=16, choices=[('addressbook', 'Address book'), ('group', 'Group'), ('address', 'Address'), ('access', 'Access'), ('reset', 'Reset')]),
+        ),
+    ]
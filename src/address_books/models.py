@@ -1,16 +1,52 @@
 from django.contrib.auth.models import User, AbstractBaseUser
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import Q, F, Case, When, Value, IntegerField, Count
+from django.db.models.signals import pre_save, post_save, m2m_changed, \
+    pre_delete, post_delete
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
 
-class AddressBook(models.Model):
+class CountersMixin(object):
+    """
+    Leaves the counter_fields, counts and versions, out of the UPDATE of
+    save(). They are only changed with F() updates, which a save() of an
+    instance loaded before would undo otherwise.
+    """
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+            ]
+        super(CountersMixin, self).save(*args, **kwargs)
+
+
+class AddressBookQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        return self.filter(access__user=user)
+
+
+class AddressBook(CountersMixin, models.Model):
     name = models.CharField(max_length=255, unique=True)
     owner = models.ForeignKey(User, related_name='owned_address_books_set')
     shared_with = models.ManyToManyField(
         User, related_name='shared_address_books_set', blank=True
     )
+    # Increased on every change to the book, its sharing, groups, addresses
+    # or memberships. Used to build ETags.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # group_count is kept up to date with change_counts on group saves and
+    # deletes, address_count by update_address_counts
+    group_count = models.PositiveIntegerField(default=0, editable=False)
+    address_count = models.PositiveIntegerField(default=0, editable=False)
+
+    counter_fields = ('version', 'group_count', 'address_count')
+
+    objects = AddressBookQuerySet.as_manager()
 
     def __str__(self):
         return self.name
@@ -22,26 +58,191 @@ class AddressBook(models.Model):
         )
 
 
-class Group(models.Model):
+class AddressBookAccess(models.Model):
+    """
+    One row per user that can see an address book, either as its owner or
+    through shared_with. Kept up to date by sync_addressbook_access so the
+    views can filter on a single indexed join instead of OR-ing both
+    relations and de-duplicating the result.
+    """
+    user = models.ForeignKey(User, related_name='address_book_access')
+    addressbook = models.ForeignKey(AddressBook, related_name='access')
+
+    class Meta:
+        unique_together = ('user', 'addressbook')
+
+
+class GroupQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        return self.filter(addressbook__access__user=user)
+
+
+class Group(CountersMixin, models.Model):
     name = models.CharField(max_length=255)
     addressbook = models.ForeignKey(AddressBook, related_name='groups')
+    # Kept up to date with change_counts by the membership writers
+    address_count = models.PositiveIntegerField(default=0, editable=False)
+
+    counter_fields = ('address_count',)
+
+    objects = GroupQuerySet.as_manager()
 
     def __str__(self):
         return str(self.addressbook) + ' > ' + self.name
 
 
+class AddressQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        # A semi-join on the membership table, so an address that belongs to
+        # several visible groups is still returned once without DISTINCT.
+        memberships = Address.groups.through.objects.filter(
+            group__addressbook__access__user=user
+        )
+        return self.filter(id__in=memberships.values('address_id'))
+
+    def search(self, query):
+        """
+        Addresses whose name or email contains query, ignoring case. Exact
+        email matches come first, then prefix matches, then the rest. The
+        lookups are served by the trigram indexes from migration 0003.
+        """
+        return self.filter(
+            Q(name__icontains=query) | Q(email__icontains=query)
+        ).annotate(search_rank=Case(
+            When(email__iexact=query, then=Value(0)),
+            When(Q(name__istartswith=query) | Q(email__istartswith=query),
+                 then=Value(1)),
+            default=Value(2),
+            output_field=IntegerField()
+        )).order_by('search_rank', 'id')
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
 class Address(models.Model):
     name = models.CharField(max_length=255)
     email = models.CharField(max_length=255)
+    normalized_email = models.CharField(max_length=255, editable=False,
+                                        db_index=True)
     groups = models.ManyToManyField(Group, related_name='addresses')
 
+    objects = AddressQuerySet.as_manager()
+
     def __str__(self):
         return self.name + ' (' + self.email + ')'
 
+    def save(self, *args, **kwargs):
+        self.normalized_email = normalize_email(self.email)
+        super(Address, self).save(*args, **kwargs)
+
     class Meta:
         verbose_name_plural = 'Addresses'
 
 
+Membership = Address.groups.through
+
+
+class AddressBookEmail(models.Model):
+    """
+    One row per address and address book it belongs to, holding the
+    normalized email. The unique constraint allows each email only once per
+    address book, and duplicate checks become a single index probe. Kept up
+    to date by sync_addressbook_emails.
+    """
+    addressbook = models.ForeignKey(AddressBook, related_name='emails')
+    address = models.ForeignKey(Address, related_name='addressbook_emails')
+    email = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ('addressbook', 'email')
+
+
+class Change(models.Model):
+    """
+    Log of changes to address books, groups and addresses, one row per
+    changed object and address book it appears in. ACCESS rows record a
+    user (object_id) gaining or losing access to an address book. RESET
+    rows mark the loads of snapshots, which write rows without logging
+    them and void the sync tokens issued before. The ids are plain
+    integers so the log outlives the objects, and the log's own ids order
+    the changes for the sync endpoint. Rows older than the sync tokens
+    that may still read them are removed by prune_changes.
+    """
+    ADDRESSBOOK = 'addressbook'
+    GROUP = 'group'
+    ADDRESS = 'address'
+    ACCESS = 'access'
+    RESET = 'reset'
+    KINDS = (
+        (ADDRESSBOOK, 'Address book'),
+        (GROUP, 'Group'),
+        (ADDRESS, 'Address'),
+        (ACCESS, 'Access'),
+        (RESET, 'Reset'),
+    )
+
+    kind = models.CharField(max_length=16, choices=KINDS)
+    object_id = models.PositiveIntegerField()
+    addressbook_id = models.PositiveIntegerField()
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        index_together = (('addressbook_id', 'id'), ('kind', 'object_id'))
+
+
+class Job(models.Model):
+    """
+    An address book operation run in the background by the run_jobs
+    command, for imports, exports and deletes too large for a request.
+    arguments and result hold JSON, input the uploaded file of an import and
+    output the file written by an export, both in file storage. The input
+    is deleted when the job ends, the output along with the job. Workers
+    claim pending jobs in id order and report their progress as they go,
+    which also moves the heartbeat; attempts counts the claims.
+    """
+    IMPORT = 'import'
+    EXPORT = 'export'
+    DELETE = 'delete'
+    KINDS = (
+        (IMPORT, 'Import'),
+        (EXPORT, 'Export'),
+        (DELETE, 'Delete'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(User, related_name='jobs')
+    kind = models.CharField(max_length=16, choices=KINDS)
+    status = models.CharField(max_length=16, choices=STATUSES,
+                              default=PENDING)
+    arguments = models.TextField(default='{}')
+    input = models.FileField(upload_to='jobs/input', blank=True)
+    progress = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(null=True)
+    result = models.TextField(blank=True)
+    output = models.FileField(upload_to='jobs/output', blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    heartbeat = models.DateTimeField(null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    finished = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('status', 'id'),)
+
+
 class PermissionDummy(models.Model):
     class Meta:
         permissions = (
@@ -52,4 +253,392 @@ class PermissionDummy(models.Model):
 @receiver(post_save, sender=User)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
-        Token.objects.create(user=instance)
\ No newline at end of file
+        Token.objects.create(user=instance)
+
+
+def sync_addressbook_access(addressbook_ids):
+    """
+    Brings the AddressBookAccess rows of the given address books in line
+    with their current owner and shared_with.
+    """
+    addressbook_ids = set(addressbook_ids)
+    if not addressbook_ids:
+        return
+    wanted = set(
+        (user_id, addressbook_id) for addressbook_id, user_id in
+        AddressBook.objects.filter(id__in=addressbook_ids)
+        .values_list('id', 'owner_id')
+    )
+    wanted.update(
+        (user_id, addressbook_id) for addressbook_id, user_id in
+        AddressBook.shared_with.through.objects
+        .filter(addressbook_id__in=addressbook_ids)
+        .values_list('addressbook_id', 'user_id')
+    )
+    existing = set(
+        AddressBookAccess.objects.filter(addressbook_id__in=addressbook_ids)
+        .values_list('user_id', 'addressbook_id')
+    )
+    for user_id, addressbook_id in existing - wanted:
+        AddressBookAccess.objects.filter(
+            user_id=user_id, addressbook_id=addressbook_id
+        ).delete()
+    AddressBookAccess.objects.bulk_create([
+        AddressBookAccess(user_id=user_id, addressbook_id=addressbook_id)
+        for user_id, addressbook_id in wanted - existing
+    ])
+    record_access_changes(wanted ^ existing)
+
+
+def record_access_changes(pairs):
+    """
+    Logs that each user in the (user id, address book id) pairs gained or
+    lost access to the address book.
+    """
+    Change.objects.bulk_create([
+        Change(kind=Change.ACCESS, object_id=user_id,
+               addressbook_id=addressbook_id)
+        for user_id, addressbook_id in pairs
+    ])
+
+
+@receiver(post_save, sender=AddressBook)
+def update_owner_access(sender, instance=None, **kwargs):
+    sync_addressbook_access([instance.id])
+    record_changes(Change.ADDRESSBOOK, [(instance.id, instance.id)])
+
+
+@receiver(pre_delete, sender=AddressBook)
+def remove_addressbook_access(sender, instance=None, **kwargs):
+    # The access rows go with the book, so log the loss of access now
+    record_access_changes(
+        instance.access.values_list('user_id', 'addressbook_id')
+    )
+
+
+@receiver(m2m_changed, sender=AddressBook.shared_with.through)
+def update_shared_access(sender, instance=None, action=None, reverse=False,
+                         pk_set=None, **kwargs):
+    if reverse and action == 'pre_clear':
+        # pk_set is not given on clear, so remember which books are affected
+        instance._cleared_address_books = list(
+            instance.shared_address_books_set.values_list('id', flat=True)
+        )
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        addressbook_ids = [instance.id]
+    elif action == 'post_clear':
+        addressbook_ids = instance._cleared_address_books
+    else:
+        addressbook_ids = pk_set
+    sync_addressbook_access(addressbook_ids)
+    record_changes(Change.ADDRESSBOOK,
+                   [(pk, pk) for pk in addressbook_ids])
+
+
+@receiver(pre_delete, sender=User)
+def touch_shared_addressbooks(sender, instance=None, **kwargs):
+    # The shared_with rows go with the user without an m2m_changed signal,
+    # so the books shared with it have to change version now
+    addressbook_ids = list(
+        instance.shared_address_books_set.values_list('id', flat=True)
+    )
+    record_changes(Change.ADDRESSBOOK,
+                   [(pk, pk) for pk in addressbook_ids])
+
+
+def sync_addressbook_emails(address_ids, chunk_size=500):
+    """
+    Brings the AddressBookEmail rows of the given addresses in line with
+    their current groups and email. The stale rows of every chunk are
+    deleted before any row is inserted, so an email can move to another
+    address of the same call.
+    """
+    address_ids = list(set(address_ids))
+    missing = []
+    for start in range(0, len(address_ids), chunk_size):
+        chunk = address_ids[start:start + chunk_size]
+        wanted = dict(
+            ((addressbook_id, address_id), email)
+            for address_id, addressbook_id, email in
+            Membership.objects.filter(address_id__in=chunk).values_list(
+                'address_id', 'group__addressbook_id',
+                'address__normalized_email'
+            )
+        )
+        stale = []
+        for pk, addressbook_id, address_id, email in \
+                AddressBookEmail.objects.filter(address_id__in=chunk) \
+                .values_list('id', 'addressbook_id', 'address_id', 'email'):
+            if wanted.get((addressbook_id, address_id)) == email:
+                del wanted[(addressbook_id, address_id)]
+            else:
+                stale.append(pk)
+        if stale:
+            AddressBookEmail.objects.filter(id__in=stale).delete()
+        missing.extend(
+            AddressBookEmail(addressbook_id=addressbook_id,
+                             address_id=address_id, email=email)
+            for (addressbook_id, address_id), email in wanted.items()
+        )
+    AddressBookEmail.objects.bulk_create(missing, batch_size=chunk_size)
+
+
+def touch_addressbooks(addressbook_ids):
+    """
+    Increases the version of the given address books, which may also be a
+    values() queryset of ids.
+    """
+    AddressBook.objects.filter(id__in=addressbook_ids).update(
+        version=F('version') + 1
+    )
+
+
+def set_counts(queryset, field, counts):
+    """
+    Sets field of every object in queryset to its count in the (id, count)
+    pairs, or to 0 if it has none, with a single UPDATE.
+    """
+    counts = dict(counts)
+    if not counts:
+        queryset.update(**{field: 0})
+        return
+    queryset.update(**{field: Case(*[
+        When(id=pk, then=Value(count)) for pk, count in counts.items()
+    ], default=Value(0), output_field=IntegerField())})
+
+
+def change_counts(model, field, deltas):
+    """
+    Adds the deltas, a dict of object id to change, to field with one
+    UPDATE per distinct change. The database does the addition, so
+    concurrent writers do not overwrite each other's counts.
+    """
+    ids_by_delta = {}
+    for pk, delta in deltas.items():
+        if pk is not None and delta:
+            ids_by_delta.setdefault(delta, []).append(pk)
+    for delta, ids in ids_by_delta.items():
+        model.objects.filter(id__in=ids).update(**{field: F(field) + delta})
+
+
+def count_groups(group_ids, sign=1):
+    """
+    Returns the deltas for change_counts of one membership added to, or
+    with sign=-1 removed from, each group in group_ids per occurrence.
+    """
+    deltas = {}
+    for group_id in group_ids:
+        deltas[group_id] = deltas.get(group_id, 0) + sign
+    return deltas
+
+
+def update_group_counts(addressbook_ids):
+    """
+    Recounts the groups of the given address books.
+    """
+    addressbook_ids = set(addressbook_ids) - {None}
+    if not addressbook_ids:
+        return
+    set_counts(
+        AddressBook.objects.filter(id__in=addressbook_ids), 'group_count',
+        Group.objects.filter(addressbook_id__in=addressbook_ids)
+        .values('addressbook_id').annotate(count=Count('id'))
+        .values_list('addressbook_id', 'count')
+    )
+
+
+def update_address_counts(group_ids, addressbook_ids):
+    """
+    Recounts the addresses of the given groups and address books. An
+    address in several groups of a book counts once for the book, which
+    cannot be counted incrementally, so the books are locked first: writers
+    of the same book recount one after the other and the last one sees
+    every committed membership.
+    """
+    group_ids = set(group_ids) - {None}
+    addressbook_ids = set(addressbook_ids) - {None}
+    if group_ids:
+        set_counts(
+            Group.objects.filter(id__in=group_ids), 'address_count',
+            Membership.objects.filter(group_id__in=group_ids)
+            .values('group_id').annotate(count=Count('id'))
+            .values_list('group_id', 'count')
+        )
+    if addressbook_ids:
+        with transaction.atomic():
+            list(AddressBook.objects.select_for_update()
+                 .filter(id__in=addressbook_ids).order_by('id')
+                 .values_list('id', flat=True))
+            set_counts(
+                AddressBook.objects.filter(id__in=addressbook_ids),
+                'address_count',
+                Membership.objects.filter(
+                    group__addressbook_id__in=addressbook_ids
+                ).values('group__addressbook_id')
+                .annotate(count=Count('address_id', distinct=True))
+                .values_list('group__addressbook_id', 'count')
+            )
+
+
+def record_changes(kind, pairs):
+    """
+    Logs a change of the given kind for each (object id, address book id) in
+    pairs and increases the versions of the address books.
+    """
+    pairs = set(
+        (object_id, addressbook_id) for object_id, addressbook_id in pairs
+        if addressbook_id is not None
+    )
+    Change.objects.bulk_create([
+        Change(kind=kind, object_id=object_id, addressbook_id=addressbook_id)
+        for object_id, addressbook_id in pairs
+    ])
+    touch_addressbooks(set(addressbook_id for _, addressbook_id in pairs))
+
+
+def memberships_changed(address_ids, group_ids, addressbook_ids=(),
+                        sync_emails=True):
+    """
+    Keeps the derived data up to date after rows for address_ids and
+    group_ids were added to or removed from the membership table.
+    addressbook_ids lists further books the addresses were removed from,
+    for groups that have been moved or deleted. Callers that write more
+    rows afterwards can pass sync_emails=False and call
+    sync_addressbook_emails() once they are done. The address counts of
+    the groups are left to the callers, who know what was added or removed.
+    """
+    address_ids = set(address_ids)
+    if sync_emails:
+        sync_addressbook_emails(address_ids)
+    groups = set(
+        Group.objects.filter(id__in=set(group_ids))
+        .values_list('id', 'addressbook_id')
+    )
+    record_changes(Change.GROUP, groups)
+    # Addresses are listed with all their groups, so they change in every
+    # book they are in as well as in the books they were added to or
+    # removed from
+    addressbook_ids = set(addressbook_ids)
+    addressbook_ids.update(addressbook_id for _, addressbook_id in groups)
+    update_address_counts([], addressbook_ids)
+    record_changes(Change.ADDRESS, set(
+        (address_id, addressbook_id) for address_id in address_ids
+        for addressbook_id in addressbook_ids
+    ) | set(
+        Membership.objects.filter(address_id__in=address_ids)
+        .values_list('address_id', 'group__addressbook_id')
+    ))
+
+
+@receiver(post_save, sender=Address)
+def update_address(sender, instance=None, created=False, **kwargs):
+    if not created:
+        memberships_changed([instance.id], [])
+
+
+@receiver(pre_delete, sender=Address)
+def remember_address_groups(sender, instance=None, **kwargs):
+    instance._deleted_groups = list(
+        Membership.objects.filter(address_id=instance.id)
+        .values_list('group_id', 'group__addressbook_id')
+    )
+
+
+@receiver(post_delete, sender=Address)
+def update_deleted_address(sender, instance=None, **kwargs):
+    groups = getattr(instance, '_deleted_groups', [])
+    change_counts(Group, 'address_count',
+                  count_groups((group_id for group_id, _ in groups), -1))
+    update_address_counts(
+        [], (addressbook_id for _, addressbook_id in groups)
+    )
+    record_changes(Change.GROUP, groups)
+    record_changes(Change.ADDRESS, [
+        (instance.id, addressbook_id) for _, addressbook_id in groups
+    ])
+
+
+@receiver(m2m_changed, sender=Membership)
+def update_memberships(sender, instance=None, action=None, reverse=False,
+                       pk_set=None, **kwargs):
+    if action in ('pre_clear', 'pre_remove'):
+        # pk_set is not given on clear, and lists ids that may not be
+        # members on remove, so remember what is actually removed
+        related = instance.addresses if reverse else instance.groups
+        if action == 'pre_remove':
+            related = related.filter(id__in=pk_set)
+        instance._removed_memberships = list(
+            related.values_list('id', flat=True)
+        )
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    sign = 1
+    if action != 'post_add':
+        pk_set = instance._removed_memberships
+        sign = -1
+    if reverse:
+        change_counts(Group, 'address_count',
+                      {instance.id: sign * len(pk_set)})
+        memberships_changed(pk_set, [instance.id])
+    else:
+        change_counts(Group, 'address_count', count_groups(pk_set, sign))
+        memberships_changed([instance.id], pk_set)
+
+
+@receiver(pre_save, sender=Group)
+def remember_group_addressbook(sender, instance=None, **kwargs):
+    instance._previous_addressbook_id = None
+    if instance.pk is not None:
+        instance._previous_addressbook_id = Group.objects.filter(
+            pk=instance.pk
+        ).values_list('addressbook_id', flat=True).first()
+
+
+def group_changed(group, previous, sync_emails=True):
+    """
+    Keeps the derived data up to date after group was saved, previous
+    being the id of its address book before or None for a new group.
+    """
+    if previous is not None and previous != group.addressbook_id:
+        # Moving a group to another address book moves its addresses too
+        memberships_changed(
+            group.addresses.values_list('id', flat=True), [group.id],
+            [previous], sync_emails=sync_emails
+        )
+    if previous != group.addressbook_id:
+        deltas = {group.addressbook_id: 1}
+        if previous is not None:
+            deltas[previous] = -1
+        change_counts(AddressBook, 'group_count', deltas)
+    record_changes(Change.GROUP, [(group.id, group.addressbook_id),
+                                  (group.id, previous)])
+
+
+@receiver(post_save, sender=Group)
+def update_group(sender, instance=None, created=False, **kwargs):
+    group_changed(instance, instance._previous_addressbook_id)
+
+
+@receiver(pre_delete, sender=Group)
+def remember_group_addresses(sender, instance=None, **kwargs):
+    instance._deleted_addresses = list(
+        instance.addresses.values_list('id', flat=True)
+    )
+
+
+@receiver(post_delete, sender=Group)
+def update_deleted_group(sender, instance=None, **kwargs):
+    memberships_changed(getattr(instance, '_deleted_addresses', []), [],
+                        [instance.addressbook_id])
+    change_counts(AddressBook, 'group_count', {instance.addressbook_id: -1})
+    record_changes(Change.GROUP, [(instance.id, instance.addressbook_id)])
+
+
+@receiver(post_delete, sender=Job)
+def delete_job_files(sender, instance=None, **kwargs):
+    for file in (instance.input, instance.output):
+        if file:
+            file.delete(save=False)
@@ -0,0 +1,55 @@
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination, \
+    PageNumberPagination
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the primary key. Every page is a `id > position`
+    range scan and no count query is run, so deep pages cost the same as
+    the first one.
+    """
+    ordering = ('id',)
+
+    def _get_position_from_instance(self, instance, ordering):
+        # Rows of ValuesListSerializer.values() start with the primary key
+        if isinstance(instance, tuple):
+            return str(instance[0])
+        return super(IdCursorPagination, self)._get_position_from_instance(
+            instance, ordering
+        )
+
+
+class OptionalCursorPagination(BasePagination):
+    """
+    Page number pagination unless the client opts in to cursor pagination
+    with `?pagination=cursor`, or follows a link that carries a cursor.
+    Cursors only follow the primary key, so querysets with an ordering of
+    their own, such as search results, cannot be paginated with them.
+    """
+    cursor_pagination_class = IdCursorPagination
+    page_number_pagination_class = PageNumberPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (request.query_params.get('pagination') == 'cursor'
+                or 'cursor' in request.query_params):
+            ordering = tuple(queryset.query.order_by)
+            if ordering and ordering != self.cursor_pagination_class.ordering:
+                raise ValidationError({'pagination': [
+                    'Cursor pagination is not available for this ordering.'
+                ]})
+            self.paginator = self.cursor_pagination_class()
+        else:
+            self.paginator = self.page_number_pagination_class()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+    @property
+    def display_page_controls(self):
+        paginator = getattr(self, 'paginator', None)
+        return paginator is not None and paginator.display_page_controls
+
+    def to_html(self):
+        return self.paginator.to_html()
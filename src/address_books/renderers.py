@@ -0,0 +1,119 @@
+"""
+MessagePack rendering and Accept-Encoding based response compression.
+
+MessagePack needs the optional msgpack package and brotli the optional
+brotli package; without them only JSON and gzip are offered.
+"""
+import re
+
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        # Dates, decimals and the like are encoded as for JSON
+        return msgpack.packb(data, use_bin_type=True,
+                             default=JSONEncoder().default)
+
+
+def brotli_sequence(sequence):
+    compressor = brotli.Compressor()
+    for item in sequence:
+        data = compressor.process(item)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+COMPRESSORS = {
+    'gzip': (compress_string, compress_sequence),
+}
+if brotli is not None:
+    COMPRESSORS['br'] = (brotli.compress, brotli_sequence)
+
+# Preferred first when the client accepts several with the same quality
+PREFERENCE = ('br', 'gzip')
+
+re_coding = re.compile(r'^\s*([a-z*]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*$')
+
+
+def choose_encoding(accept_encoding):
+    """
+    Returns the supported content coding the client prefers according to
+    an Accept-Encoding header, or None.
+    """
+    qualities = {}
+    for part in accept_encoding.lower().split(','):
+        match = re_coding.match(part)
+        if match is None:
+            continue
+        try:
+            quality = float(match.group(2) or 1)
+        except ValueError:
+            continue
+        qualities[match.group(1)] = quality
+    best = None
+    for coding in PREFERENCE:
+        if coding not in COMPRESSORS:
+            continue
+        quality = qualities.get(coding, qualities.get('*', 0))
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (coding, quality)
+    return best[0] if best is not None else None
+
+
+class CompressionMiddleware(object):
+    """
+    Like django.middleware.gzip.GZipMiddleware, but also offers brotli and
+    honours the quality values of Accept-Encoding. Streaming responses are
+    compressed chunk by chunk as they are sent.
+    """
+    min_length = 200
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        coding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is None:
+            return response
+        compress, compress_stream = COMPRESSORS[coding]
+        if response.streaming:
+            response.streaming_content = compress_stream(
+                response.streaming_content
+            )
+            del response['Content-Length']
+        elif response.status_code != 304:
+            if len(response.content) < self.min_length:
+                return response
+            content = compress(response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response['Content-Length'] = str(len(content))
+        # A 304 gets the ETag of the compressed 200 it stands for
+        if response.status_code != 304:
+            response['Content-Encoding'] = coding
+        if response.has_header('ETag'):
+            response['ETag'] = re.sub('"$', ';%s"' % coding, response['ETag'])
+        return response
@@ -0,0 +1,100 @@
+"""
+Read replica routing.
+
+ReplicaMiddleware lets the safe requests (GET, HEAD, OPTIONS) read from one
+of the DATABASE_REPLICAS, picked once per request. Everything else,
+including reads made while handling a write and management commands,
+uses the primary. After a write the client is pinned to the primary for
+REPLICA_PIN_SECONDS, so it reads its own writes while the replicas catch
+up. Clients are told apart by their Authorization header or session
+cookie, and the pins are kept in the cache named by REPLICA_PIN_CACHE so
+every process sees them. A write that changes the session, like a login,
+pins the new session key as well.
+"""
+import hashlib
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+
+CACHE_PREFIX = 'address_books.pin.'
+
+_local = threading.local()
+
+
+def get_replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', ()))
+
+
+def pin_cache():
+    return caches[getattr(settings, 'REPLICA_PIN_CACHE', 'default')]
+
+
+def pin_key(credentials):
+    return CACHE_PREFIX + hashlib.md5(credentials.encode('utf-8')).hexdigest()
+
+
+def client_key(request):
+    """
+    Returns the cache key of the client making request, or None for
+    anonymous clients.
+    """
+    credentials = request.META.get('HTTP_AUTHORIZATION') or \
+        request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return pin_key(credentials)
+
+
+def session_pin_key(request):
+    """
+    Returns the cache key of the session the client sends from now on,
+    which a login has just changed, or None without a session.
+    """
+    session = getattr(request, 'session', None)
+    session_key = session.session_key if session is not None else None
+    if not session_key:
+        return None
+    return pin_key(session_key)
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return getattr(_local, 'replica', None) or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model=None, **hints):
+        return db not in get_replicas()
+
+
+class ReplicaMiddleware(object):
+    def process_request(self, request):
+        _local.replica = None
+        replicas = get_replicas()
+        if request.method not in SAFE_METHODS or not replicas:
+            return
+        key = client_key(request)
+        if key is None or pin_cache().get(key) is None:
+            _local.replica = random.choice(replicas)
+
+    def process_response(self, request, response):
+        _local.replica = None
+        if request.method not in SAFE_METHODS:
+            keys = set([client_key(request), session_pin_key(request)])
+            keys.discard(None)
+            if keys:
+                pin_cache().set_many(
+                    dict.fromkeys(keys, True),
+                    getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+                )
+        return response
@@ -1,11 +1,42 @@
+import json
+from collections import OrderedDict
+
 from django.contrib.auth.models import User, Permission
+from django.db import transaction
+from django.db.models import Prefetch
 from rest_framework import serializers
-from rest_framework.fields import CharField, SerializerMethodField, BooleanField
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.reverse import reverse
+from rest_framework.fields import CharField, SerializerMethodField, \
+    BooleanField, IntegerField
 from rest_framework.relations import PrimaryKeyRelatedField, ManyRelatedField, \
     RelatedField
-from rest_framework.serializers import ModelSerializer
+from rest_framework.serializers import ModelSerializer, ListSerializer
+from rest_framework.utils.serializer_helpers import ReturnList
+
+from address_books import membership
+from address_books.access import accessible_addressbook_ids, \
+    accessible_group_ids, accessible_address_ids, can_access_all
+from address_books.bulk import add_memberships, remove_memberships, \
+    update_addresses, update_group
+from address_books.metrics import serializer_timer
+from address_books.models import AddressBook, Group, Address, \
+    AddressBookEmail, Job, normalize_email, sync_addressbook_emails
+
+
+def set_memberships(pairs, wanted_pairs):
+    """
+    Replaces the (address id, group id) pairs with wanted_pairs, leaving
+    the email index to the caller.
+    """
+    pairs = set(pairs)
+    wanted_pairs = set(wanted_pairs)
+    remove_memberships(pairs - wanted_pairs, sync_emails=False)
+    add_memberships(wanted_pairs - pairs, sync_emails=False)
 
-from address_books.models import AddressBook, Group, Address
+
+def forget_prefetched(instance, name):
+    getattr(instance, '_prefetched_objects_cache', {}).pop(name, None)
 
 
 class FilterRelatedMixin(object):
@@ -16,6 +47,9 @@ class FilterRelatedMixin(object):
 
     def __init__(self, *args, **kwargs):
         super(FilterRelatedMixin, self).__init__(*args, **kwargs)
+        # Read-only serializers, like expanded ones, never validate ids
+        if self.read_only:
+            return
         for name in self.fields:
             field = self.fields[name]
             if isinstance(field, ManyRelatedField):
@@ -30,7 +64,192 @@ class FilterRelatedMixin(object):
                     field.queryset = func(field.queryset)
 
 
-class AddressBookSerializer(FilterRelatedMixin, ModelSerializer):
+def requested_fields(request):
+    """
+    Returns the field names listed in the `fields` query parameter of a
+    read request, e.g. `?fields=id,email`, or None.
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    value = request.query_params.get('fields')
+    if not value:
+        return None
+    return set(name.strip() for name in value.split(',') if name.strip())
+
+
+def requested_expansions(request):
+    """
+    Returns the relation paths listed in the `expand` query parameter of a
+    read request, e.g. `?expand=groups,groups.addresses`.
+    """
+    if request is None or request.method not in SAFE_METHODS:
+        return set()
+    value = request.query_params.get('expand', '')
+    return set(path.strip() for path in value.split(',') if path.strip())
+
+
+class ExpandMixin(object):
+    """
+    Inlines the objects of the relations listed in `expand`, given as an
+    argument or as the query parameter, instead of their ids. `expandable`
+    maps the relations that allow it to a function returning their
+    serializer class, and dotted paths expand the inlined objects in turn.
+    """
+    expandable = {}
+
+    def __init__(self, *args, **kwargs):
+        expand = kwargs.pop('expand', None)
+        super(ExpandMixin, self).__init__(*args, **kwargs)
+        if expand is None:
+            expand = requested_expansions(self.context.get('request'))
+        nested = {}
+        for path in expand:
+            name, _, rest = path.partition('.')
+            nested.setdefault(name, [])
+            if rest:
+                nested[name].append(rest)
+        for name, paths in nested.items():
+            if name in self.expandable and name in self.fields:
+                self.fields[name] = self.expandable[name]()(
+                    many=True, read_only=True, expand=paths
+                )
+
+
+def related_fields(serializer):
+    """
+    Returns the names of the fields of serializer that list related
+    objects, by id or expanded.
+    """
+    return [
+        name for name, field in serializer.fields.items()
+        if isinstance(field, (ManyRelatedField, ListSerializer))
+    ]
+
+
+class SparseFieldsMixin(object):
+    """
+    Drops the fields that are not listed in the `fields` query parameter.
+    Unknown names are ignored.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        names = requested_fields(self.context.get('request'))
+        if names is not None:
+            for name in list(self.fields):
+                if name not in names:
+                    self.fields.pop(name)
+
+
+def serializer_columns(serializer):
+    """
+    Returns the names of the concrete model fields serializer reads, for
+    QuerySet.only().
+    """
+    opts = serializer.Meta.model._meta
+    concrete = set(field.name for field in opts.concrete_fields)
+    return [
+        field.source for field in serializer.fields.values()
+        if field.source in concrete
+    ]
+
+
+class TimedSerializerMixin(object):
+    """
+    Reports the time spent serializing to the request metrics.
+    """
+
+    def to_representation(self, instance):
+        with serializer_timer():
+            return super(TimedSerializerMixin, self).to_representation(
+                instance
+            )
+
+
+class ValuesListSerializer(object):
+    """
+    Read-only stand-in for `serializer_class(rows, many=True)` when every
+    field of the serializer is a column, a foreign key or a many-to-many
+    relation listed by primary key. The rows come from values() and the
+    related ids from one query per many-to-many field, so no model or field
+    instances are built per row. The data equals that of the serializer,
+    with related ids in primary key order as PrefetchMixin fetches them.
+    """
+    many = True
+
+    # Fields whose representation of the column value is the value itself
+    PLAIN_FIELDS = (CharField, IntegerField)
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.model = serializer.Meta.model
+        self.fields = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            if isinstance(field, ManyRelatedField) and isinstance(
+                    field.child_relation, PrimaryKeyRelatedField):
+                kind = 'many'
+            elif isinstance(field, PrimaryKeyRelatedField):
+                kind = 'related'
+            elif type(field) in self.PLAIN_FIELDS:
+                kind = 'plain'
+            else:
+                kind = None
+            self.fields.append((field.field_name, field.source, kind))
+
+    @property
+    def supported(self):
+        return all(kind is not None for _, _, kind in self.fields)
+
+    def values(self, queryset):
+        """
+        Returns queryset as rows for data(), with the primary key first.
+        """
+        columns = ['pk']
+        for _, source, kind in self.fields:
+            if kind == 'related':
+                columns.append(
+                    self.model._meta.get_field(source).attname
+                )
+            elif kind == 'plain':
+                columns.append(source)
+        # Annotations used for ordering have to be selected on Django 1.8
+        columns.extend(queryset.query.annotations)
+        return queryset.prefetch_related(None).values_list(*columns)
+
+    def related_ids(self, source, pks):
+        related = OrderedDict((pk, []) for pk in pks)
+        for pk, related_pk in self.model._default_manager.filter(
+                pk__in=pks).order_by(source).values_list('pk', source):
+            if related_pk is not None:
+                related[pk].append(related_pk)
+        return related
+
+    def data(self, rows):
+        with serializer_timer():
+            pks = [row[0] for row in rows]
+            many = dict(
+                (source, self.related_ids(source, pks))
+                for _, source, kind in self.fields if kind == 'many'
+            )
+            data = []
+            for row in rows:
+                item = OrderedDict()
+                column = 1
+                for name, source, kind in self.fields:
+                    if kind == 'many':
+                        item[name] = many[source][row[0]]
+                    else:
+                        item[name] = row[column]
+                        column += 1
+                data.append(item)
+            return ReturnList(data, serializer=self)
+
+
+class AddressBookSerializer(TimedSerializerMixin, ExpandMixin,
+                            FilterRelatedMixin, SparseFieldsMixin,
+                            ModelSerializer):
     name = CharField()
     groups = PrimaryKeyRelatedField(
         queryset=Group.objects.all(), many=True, required=False
@@ -40,12 +259,11 @@ class AddressBookSerializer(FilterRelatedMixin, ModelSerializer):
         queryset=User.objects.all(), many=True, required=False
     )
 
+    expandable = {'groups': lambda: GroupSerializer}
+
     def filter_groups(self, queryset):
         user = self.context['request'].user
-        return (
-            queryset.filter(addressbook__shared_with__id=user.id)
-            | queryset.filter(addressbook__owner__id=user.id)
-        )
+        return queryset.visible_to(user)
 
     def validate_name(self, value):
         q = AddressBook.objects.filter(name=value) 
@@ -57,10 +275,8 @@ class AddressBookSerializer(FilterRelatedMixin, ModelSerializer):
 
     def validate_groups(self, value):
         user = self.context['request'].user
-        for group in value:
-            if (user not in group.addressbook.shared_with.all()
-                    and user != group.addressbook.owner):
-                raise serializers.ValidationError("Invalid group set")
+        if not can_access_all(accessible_group_ids, user, value):
+            raise serializers.ValidationError("Invalid group set")
         return value
 
     def validate_shared_with(self, value):
@@ -76,102 +292,199 @@ class AddressBookSerializer(FilterRelatedMixin, ModelSerializer):
         return value
 
     class Meta:
-        fields = ['id', 'name', 'groups', 'owner', 'shared_with']
+        fields = ['id', 'name', 'groups', 'owner', 'shared_with',
+                  'group_count', 'address_count']
         model = AddressBook
 
 
-class GroupSerializer(FilterRelatedMixin, ModelSerializer):
+class GroupSerializer(TimedSerializerMixin, ExpandMixin,
+                      FilterRelatedMixin, SparseFieldsMixin,
+                      ModelSerializer):
     name = CharField()
     addressbook = PrimaryKeyRelatedField(queryset=AddressBook.objects.all())
     addresses = PrimaryKeyRelatedField(queryset=Address.objects.all(),
                                        many=True, required=False)
 
+    expandable = {'addresses': lambda: AddressSerializer}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def validate(self, attrs):
-        q = Group.objects.filter(
-                name=attrs['name'], addressbook=attrs['addressbook']
-        )
+        # Partial updates fall back to the values of the instance
+        name = attrs.get('name', getattr(self.instance, 'name', None))
+        addressbook = attrs.get('addressbook',
+                                getattr(self.instance, 'addressbook', None))
+        q = Group.objects.filter(name=name, addressbook=addressbook)
         if self.instance is not None:
             q = q.exclude(id=self.instance.id)
         if q.exists():
             raise serializers.ValidationError("Duplicate group name")
+        # The emails of the final addresses must be free in the final book
+        if 'addresses' in attrs:
+            address_ids = set(address.id for address in attrs['addresses'])
+        elif self.instance is not None \
+                and self.instance.addressbook_id != addressbook.id:
+            address_ids = set(
+                self.instance.addresses.values_list('id', flat=True)
+            )
+        else:
+            address_ids = set()
+        if membership.duplicate_emails(addressbook.id, address_ids):
+            raise serializers.ValidationError("Duplicate email address")
         return attrs
 
+    def update(self, instance, validated_data):
+        # The email index is synced once the group and its memberships are
+        # written, as the old addresses are indexed in the new book for a
+        # moment otherwise
+        addresses = validated_data.pop('addresses', None)
+        previous = instance.addressbook_id
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        with transaction.atomic():
+            update_group(instance, previous, sync_emails=False)
+            address_ids = set(
+                instance.addresses.values_list('id', flat=True)
+            )
+            if addresses is not None:
+                set_memberships(
+                    ((address_id, instance.id) for address_id in address_ids),
+                    ((address.id, instance.id) for address in addresses)
+                )
+                address_ids.update(address.id for address in addresses)
+            sync_addressbook_emails(address_ids)
+        forget_prefetched(instance, 'addresses')
+        return instance
+
     def validate_addressbook(self, value):
         user = self.context['request'].user
-        if user not in value.shared_with.all() and user != value.owner:
+        if not can_access_all(accessible_addressbook_ids, user, [value]):
             raise serializers.ValidationError("Invalid address book")
         return value
 
     def validate_addresses(self, value):
         user = self.context['request'].user
-        for address in value:
-            if (user not in address.group.addressbook.shared_with.all()
-                    and user != address.group.addressbook.owner):
-                raise serializers.ValidationError("Invalid addresses")
+        if not can_access_all(accessible_address_ids, user, value):
+            raise serializers.ValidationError("Invalid addresses")
         return value
 
     def filter_addressbook(self, queryset):
         user = self.context['request'].user
-        return queryset.filter(shared_with__id=user.id) | queryset.filter(
-            owner__id=user.id)
+        return queryset.visible_to(user)
 
     def filter_addresses(self, queryset):
         user = self.context['request'].user
-        return (queryset.filter(groups__addressbook__shared_with__id=user.id)
-                | queryset.filter(groups__addressbook__owner__id=user.id)) 
+        return queryset.visible_to(user)
 
     class Meta:
-        fields = ['id', 'name', 'addressbook', 'addresses']
+        fields = ['id', 'name', 'addressbook', 'addresses', 'address_count']
         model = Group
 
 
-class AddressSerializer(FilterRelatedMixin, ModelSerializer):
+class AddressSerializer(TimedSerializerMixin, ExpandMixin,
+                        FilterRelatedMixin, SparseFieldsMixin,
+                        ModelSerializer):
     name = CharField()
     email = CharField()
     groups = PrimaryKeyRelatedField(queryset=Group.objects.all(), many=True)
 
     def validate(self, data):
+        # Partial updates fall back to the values of the instance
+        if 'email' in data:
+            email = data['email']
+        else:
+            email = self.instance.email
+        if 'groups' in data:
+            groups = data['groups']
+        else:
+            groups = self.instance.groups.all()
         # Check that the email is not a duplicate
-        q = Address.objects.filter(
-            email=data['email'], groups__addressbook__groups__in=data['groups']
+        q = AddressBookEmail.objects.filter(
+            email=normalize_email(email),
+            addressbook_id__in=set(group.addressbook_id for group in groups)
         )
-        q = q.exclude(id=self.instance.id) if self.instance is not None else q
+        q = q.exclude(address_id=self.instance.id) \
+            if self.instance is not None else q
         if q.exists():
             raise serializers.ValidationError("Duplicate email address")
         return data
 
-    def validate_group(self, value):
+    def update(self, instance, validated_data):
+        # The email index is synced once the address and its memberships
+        # are written, as the old email is indexed in the new books for a
+        # moment otherwise
+        groups = validated_data.pop('groups', None)
+        for name, value in validated_data.items():
+            setattr(instance, name, value)
+        instance.normalized_email = normalize_email(instance.email)
+        with transaction.atomic():
+            update_addresses([instance], sync_emails=False)
+            if groups is not None:
+                set_memberships(
+                    ((instance.id, group_id) for group_id in
+                     instance.groups.values_list('id', flat=True)),
+                    ((instance.id, group.id) for group in groups)
+                )
+            sync_addressbook_emails([instance.id])
+        forget_prefetched(instance, 'groups')
+        return instance
+
+    def validate_groups(self, value):
         user = self.context['request'].user
-        for group in value:
-            if (user not in group.addressbook.shared_with.all()
-                    and user != group.addressbook.owner):
-                raise serializers.ValidationError("Invalid group set")
+        if not can_access_all(accessible_group_ids, user, value):
+            raise serializers.ValidationError("Invalid group set")
         return value
 
-    def filter_group(self, queryset):
+    def filter_groups(self, queryset):
         user = self.context['request'].user
-        return (queryset.filter(addressbook__shared_with__id=user.id)
-                | queryset.filter(addressbook__owner__id=user.id))
+        return queryset.visible_to(user)
 
     class Meta:
         fields = ['id', 'name', 'email', 'groups']
         model = Address
 
 
+def get_permission_codenames(user):
+    """
+    Returns the codenames of the address_books permissions assigned directly
+    to user. Uses the list prefetched with PERMISSIONS_PREFETCH when the
+    queryset provides it, otherwise runs a single query. The result is cached
+    on the instance so every PermissionField of a user shares it.
+    """
+    codenames = getattr(user, '_permission_codenames', None)
+    if codenames is None:
+        permissions = getattr(user, 'address_books_permissions', None)
+        if permissions is None:
+            permissions = user.user_permissions.filter(
+                content_type__app_label='address_books'
+            )
+        codenames = frozenset(p.codename for p in permissions)
+        user._permission_codenames = codenames
+    return codenames
+
+
+def clear_permission_codenames(user):
+    user.__dict__.pop('_permission_codenames', None)
+    user.__dict__.pop('address_books_permissions', None)
+
+
+PERMISSIONS_PREFETCH = Prefetch(
+    'user_permissions',
+    queryset=Permission.objects.filter(
+        content_type__app_label='address_books'
+    ),
+    to_attr='address_books_permissions'
+)
+
+
 class PermissionField(serializers.Field):
     def __init__(self, *args, **kwargs):
         self.permission = kwargs.pop('permission')
         super().__init__(*args, source='*', **kwargs)
 
     def get_attribute(self, instance):
-        perm = Permission.objects.get(
-            codename=self.permission,
-            content_type__app_label='address_books'
-        )
-        return perm in instance.user_permissions.all()
+        return self.permission in get_permission_codenames(instance)
 
     def to_representation(self, data):
         return data
@@ -180,7 +493,8 @@ class PermissionField(serializers.Field):
         return {self.permission: data.lower() == 'true'}
 
 
-class UserSerializer(ModelSerializer):
+class UserSerializer(TimedSerializerMixin, SparseFieldsMixin,
+                     ModelSerializer):
     can_add_addressbook = PermissionField(permission='add_addressbook')
     can_change_addressbook = PermissionField(permission='change_addressbook')
     can_delete_addressbook = PermissionField(permission='delete_addressbook')
@@ -208,12 +522,11 @@ class UserSerializer(ModelSerializer):
                         "You do not have permission to assign permissions"
                     )
         user = super().create(validated_data)
-        for permission, value in permissions.items():
-            permission = Permission.objects.get(
-                codename=permission, content_type__app_label='addressbooks'
-            )
-            if value:
-                user.user_permissions.add(permission)
+        permission_ids = self.get_permission_ids()
+        user.user_permissions.add(*[
+            permission_ids[permission]
+            for permission, value in permissions.items() if value
+        ])
 
         return user
 
@@ -225,17 +538,32 @@ class UserSerializer(ModelSerializer):
                     field.permission
                 )
         user = super().update(instance, validated_data)
-        for permission, value in permissions.items():
-            permission = Permission.objects.get(
-                codename=permission, content_type__app_label='addressbooks'
-            )
-            if value:
-                user.user_permissions.add(permission)
-            else:
-                user.user_permissions.remove(permission)
+        permission_ids = self.get_permission_ids()
+        user.user_permissions.add(*[
+            permission_ids[permission]
+            for permission, value in permissions.items() if value
+        ])
+        user.user_permissions.remove(*[
+            permission_ids[permission]
+            for permission, value in permissions.items() if not value
+        ])
+        clear_permission_codenames(user)
 
         return user
 
+    def get_permission_ids(self):
+        """
+        Maps the codenames of the address_books permissions to their ids,
+        loaded once per serializer.
+        """
+        if not hasattr(self, '_permission_ids'):
+            self._permission_ids = dict(
+                Permission.objects.filter(
+                    content_type__app_label='address_books'
+                ).values_list('codename', 'id')
+            )
+        return self._permission_ids
+
     class Meta:
         fields = ['id', 'username', 'email', 'can_add_addressbook',
                   'can_change_addressbook', 'can_delete_addressbook',
@@ -243,3 +571,30 @@ class UserSerializer(ModelSerializer):
                   'can_add_address', 'can_change_address', 'can_delete_address',
                   'can_assign_permissions', 'can_share_addressbook']
         model = User
+
+
+class JobSerializer(TimedSerializerMixin, ModelSerializer):
+    arguments = SerializerMethodField()
+    result = SerializerMethodField()
+    output = SerializerMethodField()
+
+    def get_arguments(self, job):
+        return json.loads(job.arguments)
+
+    def get_result(self, job):
+        return json.loads(job.result) if job.result else None
+
+    def get_output(self, job):
+        """
+        Links to the file written by a finished export.
+        """
+        if job.kind != Job.EXPORT or job.status != Job.DONE:
+            return None
+        return reverse('joboutput', args=[job.id],
+                       request=self.context.get('request'))
+
+    class Meta:
+        fields = ['id', 'kind', 'status', 'arguments', 'progress', 'total',
+                  'result', 'output', 'error', 'created', 'started',
+                  'finished']
+        model = Job
@@ -0,0 +1,257 @@
+"""
+Delta sync of the address books, groups and addresses a user can see.
+
+A sync token holds the id of the last Change the client has seen. Objects
+with a logged change after it are sent again if the user can still see
+them, and listed as deleted otherwise. Address books the user gained
+access to are sent in full, since the client has never seen their content.
+Deleting an address book deletes its groups on the client, and addresses
+left without any group are to be dropped as well.
+
+Change ids are handed out when a row is inserted, not when its transaction
+commits, so a change can become visible after a higher id was already
+sent. The ids missing below a token's position are kept in the token as
+gaps and looked up again by the next syncs, until they are GAP_TIMEOUT
+seconds old; no transaction is expected to stay open that long.
+
+Responses hold at most `limit` addresses for a full sync and `limit` logged
+changes for a delta. While `more` is true the client is to sync again with
+the returned token right away. Tokens older than SYNC_TOKEN_MAX_AGE are
+rejected, the client then syncs in full, and prune_changes() removes the
+changes no valid token can ask for anymore. Tokens issued before a RESET
+change are rejected as well, since a snapshot was loaded without logging
+what it changed.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q, Max
+from django.utils import timezone
+
+from address_books.models import AddressBook, Group, Address, Membership, \
+    Change
+from address_books.serializers import AddressBookSerializer, \
+    GroupSerializer, AddressSerializer
+
+
+TOKEN_SALT = 'address_books.sync'
+
+# Seconds during which a missing change id may still be committed
+GAP_TIMEOUT = 300
+
+# Gaps kept in a token, the most recently found ones win
+MAX_GAPS = 100
+
+# Ids below the position of a full sync checked for gaps
+GAP_SCAN = 1000
+
+
+def page_size():
+    return getattr(settings, 'SYNC_PAGE_SIZE', 1000)
+
+
+def max_age():
+    return getattr(settings, 'SYNC_TOKEN_MAX_AGE', 30 * 24 * 3600)
+
+
+def make_token(change_id, issued=None, gaps=(), after=None):
+    """
+    Returns a token for the changes after change_id. issued is the time
+    the position was read at, gaps the [first id, last id, time found]
+    ranges of missing ids below it, and after the last address id sent by
+    an unfinished full sync.
+    """
+    state = {'id': change_id, 'time': issued or time.time(),
+             'gaps': [list(gap) for gap in gaps]}
+    if after is not None:
+        state['after'] = after
+    return signing.dumps(state, salt=TOKEN_SALT, compress=True)
+
+
+def read_token(token):
+    """
+    Returns the state in token, raising ValueError if it was not issued by
+    make_token or is too old.
+    """
+    try:
+        state = signing.loads(token, salt=TOKEN_SALT)
+        state = {
+            'id': int(state['id']),
+            'time': float(state['time']),
+            'gaps': [[int(first), int(last), float(found)]
+                     for first, last, found in state['gaps']],
+            'after': None if state.get('after') is None
+            else int(state['after']),
+        }
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        raise ValueError('Invalid sync token')
+    if state['time'] < time.time() - max_age():
+        raise ValueError('Expired sync token')
+    return state
+
+
+def missing_ranges(first, last, present, found):
+    """
+    Returns the [first id, last id, found] ranges of the ids from first to
+    last that are not in present.
+    """
+    ranges = []
+    previous = first - 1
+    for pk in sorted(pk for pk in present if first <= pk <= last) + \
+            [last + 1]:
+        if pk > previous + 1:
+            ranges.append([previous + 1, pk - 1, found])
+        previous = pk
+    return ranges
+
+
+def gaps_query(gaps):
+    query = Q(pk__in=[])
+    for first, last, _ in gaps:
+        query |= Q(id__range=(first, last))
+    return query
+
+
+def fill_gaps(gaps, now):
+    """
+    Returns the ids of the changes committed in gaps since they were found,
+    and the gaps left, without those that timed out.
+    """
+    gaps = [gap for gap in gaps if gap[2] > now - GAP_TIMEOUT]
+    if not gaps:
+        return [], []
+    filled = list(
+        Change.objects.filter(gaps_query(gaps)).values_list('id', flat=True)
+    )
+    left = []
+    for first, last, found in gaps:
+        left.extend(missing_ranges(first, last, filled, found))
+    return filled, left
+
+
+def changed_ids(changes, kind):
+    return set(changes.filter(kind=kind).values_list('object_id', flat=True))
+
+
+def sync(user, token=None, context=None, limit=None):
+    """
+    Returns the changes visible to user since token, or everything visible
+    if no token is given, along with the token for the next sync and
+    whether more changes are waiting.
+    """
+    limit = limit or page_size()
+    now = time.time()
+    # Read the position first, so changes made while the response is built
+    # are sent again next time instead of being missed
+    last_id = Change.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+    if token is None:
+        scanned = Change.objects.filter(
+            id__gt=last_id - GAP_SCAN, id__lte=last_id
+        ).values_list('id', flat=True)
+        state = {
+            'id': last_id, 'time': now, 'after': 0,
+            'gaps': missing_ranges(max(last_id - GAP_SCAN + 1, 1), last_id,
+                                   scanned, now),
+        }
+    else:
+        state = read_token(token)
+        # A reset committed late may fall in a gap of the token
+        if Change.objects.filter(
+                Q(id__gt=state['id']) | gaps_query(state['gaps']),
+                kind=Change.RESET).exists():
+            raise ValueError('Expired sync token')
+    visible = set(
+        AddressBook.objects.visible_to(user).values_list('id', flat=True)
+    )
+    addressbooks = AddressBook.objects.filter(id__in=visible)
+    groups = Group.objects.filter(addressbook_id__in=visible)
+    addresses = Address.objects.visible_to(user)
+    deleted = {'addressbooks': [], 'groups': [], 'addresses': []}
+
+    if state['after'] is not None:
+        # A full sync, in pages of addresses. Books and groups come first.
+        if state['after']:
+            addressbooks = addressbooks.none()
+            groups = groups.none()
+        addresses = list(
+            addresses.filter(id__gt=state['after']).order_by('id')
+            .prefetch_related('groups')[:limit + 1]
+        )
+        more = len(addresses) > limit
+        addresses = addresses[:limit]
+        next_token = make_token(
+            state['id'], state['time'], state['gaps'],
+            addresses[-1].id if more else None
+        )
+    else:
+        since = state['id']
+        ids = list(
+            Change.objects.filter(id__gt=since, id__lte=last_id)
+            .order_by('id').values_list('id', flat=True)[:limit + 1]
+        )
+        more = len(ids) > limit
+        position = ids[limit - 1] if more else last_id
+        filled, gaps = fill_gaps(state['gaps'], now)
+        gaps.extend(missing_ranges(since + 1, position, ids, now))
+        next_token = make_token(position, state['time'] if more else now,
+                                gaps[-MAX_GAPS:])
+        changes = Change.objects.filter(
+            Q(id__gt=since, id__lte=position) | Q(id__in=filled)
+        )
+        access = set(
+            changes.filter(kind=Change.ACCESS, object_id=user.id)
+            .values_list('addressbook_id', flat=True)
+        )
+        gained = access & visible
+        changes = changes.filter(addressbook_id__in=visible - gained)
+        group_ids = changed_ids(changes, Change.GROUP)
+        address_ids = changed_ids(changes, Change.ADDRESS)
+        addressbooks = addressbooks.filter(
+            id__in=changed_ids(changes, Change.ADDRESSBOOK) | gained
+        )
+        groups = groups.filter(
+            Q(id__in=group_ids) | Q(addressbook_id__in=gained)
+        )
+        addresses = list(addresses.filter(
+            Q(id__in=address_ids) | Q(id__in=Membership.objects.filter(
+                group__addressbook_id__in=gained
+            ).values('address_id'))
+        ).order_by('id').prefetch_related('groups'))
+    addressbooks = list(addressbooks.order_by('id')
+                        .prefetch_related('groups', 'shared_with'))
+    groups = list(groups.order_by('id').prefetch_related('addresses'))
+    if state['after'] is None:
+        deleted['addressbooks'] = sorted(access - visible)
+        deleted['groups'] = sorted(
+            group_ids - set(group.id for group in groups)
+        )
+        deleted['addresses'] = sorted(
+            address_ids - set(address.id for address in addresses)
+        )
+
+    return {
+        'token': next_token,
+        'more': more,
+        'addressbooks': AddressBookSerializer(
+            addressbooks, many=True, context=context
+        ).data,
+        'groups': GroupSerializer(groups, many=True, context=context).data,
+        'addresses': AddressSerializer(
+            addresses, many=True, context=context
+        ).data,
+        'deleted': deleted,
+    }
+
+
+def prune_changes():
+    """
+    Deletes the changes older than any valid sync token may ask for and
+    returns how many were deleted.
+    """
+    cutoff = timezone.now() - timedelta(seconds=max_age() + GAP_TIMEOUT)
+    old = Change.objects.filter(created__lt=cutoff)
+    count = old.count()
+    old.delete()
+    return count
@@ -1,11 +1,39 @@
-from django.contrib.auth.models import User, Permission
+from django.conf import settings
+from django.contrib.auth.models import User, Permission, \
+    Group as AuthGroup
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import caches
+from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse
-from django.test import TestCase
+from django.db import connection, connections, transaction, \
+    IntegrityError, OperationalError
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
-from address_books.models import AddressBook, Group, Address
+from address_books.access import accessible_address_ids, \
+    accessible_group_ids
+from address_books import authentication, jobs, metrics, renderers, \
+    routers, views
+from address_books.benchmark import generator, scenarios
+from address_books.bulk import delete_addresses
+from address_books.models import AddressBook, Group, Address, \
+    AddressBookEmail, AddressBookAccess, Change, Job, sync_addressbook_emails
+from address_books.pagination import IdCursorPagination
+from address_books.serializers import ValuesListSerializer
+import gzip
+import io
 import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import timedelta
+from unittest import mock
 
 
 class AddressBookTests(APITestCase):
@@ -108,6 +136,26 @@ class AddressBookTests(APITestCase):
         response = self.client.get(url)
         self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_shared_addressbook_visibility(self):
+        other = User.objects.create_user(username='other', password='other')
+        addressbook = AddressBook.objects.create(name='Test', owner=other)
+        url = reverse('addressbook', args=[addressbook.id, ])
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+        addressbook.shared_with.add(self.user)
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.user.shared_address_books_set.clear()
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+        addressbook.owner = self.user
+        addressbook.save()
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        addressbook.shared_with.add(self.user)
+        response = self.client.get(reverse('addressbooks'))
+        self.assertEquals(response.data['count'], 1)
+
 
 class GroupTests(APITestCase):
     def setUp(self):
@@ -193,6 +241,58 @@ class GroupTests(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertEquals(response.data['name'], 'Test1')
 
+    def test_group_duplicate_emails(self):
+        for codename in ('add_group', 'change_group'):
+            self.user.user_permissions.add(Permission.objects.get(
+                codename=codename, content_type__app_label='address_books'
+            ))
+        taken = Group.objects.create(name='Taken',
+                                     addressbook=self.parent_addressbook_2)
+        Address.objects.create(name='A', email='a@test.com').groups.add(taken)
+        address = Address.objects.create(name='A', email='A@test.com')
+        group = Group.objects.create(name='Test',
+                                     addressbook=self.parent_addressbook_1)
+        address.groups.add(group)
+        data = {'name': 'New', 'addressbook': self.parent_addressbook_2.id,
+                'addresses': [address.id]}
+        response = self.client.post(reverse('groups'), data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        data = {'name': 'Test', 'addressbook': self.parent_addressbook_2.id}
+        response = self.client.put(reverse('group', args=[group.id]), data,
+                                   format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(Group.objects.get(id=group.id).addressbook,
+                          self.parent_addressbook_1)
+        response = self.client.patch(reverse('group', args=[group.id]),
+                                     {'name': 'Renamed'}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_move_group_adding_duplicate(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='change_group', content_type__app_label='address_books'
+        ))
+        # The email is taken in the book the group leaves, not in the new one
+        taken = Group.objects.create(name='Taken',
+                                     addressbook=self.parent_addressbook_1)
+        Address.objects.create(name='A', email='a@test.com').groups.add(taken)
+        group = Group.objects.create(name='Test',
+                                     addressbook=self.parent_addressbook_1)
+        address = Address.objects.create(name='A', email='a@test.com')
+        address.groups.add(Group.objects.create(
+            name='Other', addressbook=self.parent_addressbook_2
+        ))
+        data = {'name': 'Test', 'addressbook': self.parent_addressbook_2.id,
+                'addresses': [address.id]}
+        response = self.client.put(reverse('group', args=[group.id]), data,
+                                   format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['addresses'], [address.id])
+        self.assertEquals(
+            list(AddressBookEmail.objects.filter(address_id=address.id)
+                 .values_list('addressbook_id', 'email')),
+            [(self.parent_addressbook_2.id, 'a@test.com')]
+        )
+
     def test_delete_group(self):
         id = Group.objects.create(name='Test',
                                   addressbook=self.parent_addressbook_1).id
@@ -250,6 +350,58 @@ class AddressesTests(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertEquals(response.data['count'], count)
 
+    def test_get_addresses_cursor_pagination(self):
+        for x in range(150):
+            address = Address.objects.create(name=str(x), email=str(x))
+            address.groups.add(self.parent_group_1, self.parent_group_2)
+        url = reverse('addresses') + '?pagination=cursor'
+        ids = []
+        while url is not None:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', response.data)
+            self.assertFalse(any(
+                'COUNT(' in query['sql'] for query in queries.captured_queries
+            ))
+            ids.extend(address['id'] for address in response.data['results'])
+            url = response.data['next']
+        self.assertEquals(ids, sorted(
+            Address.objects.values_list('id', flat=True)
+        ))
+
+    def test_cursor_pagination_of_search(self):
+        url = reverse('addresses') + '?pagination=cursor&q=alice'
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('pagination', response.data)
+
+    def test_search_addresses(self):
+        for name, email in [('Alice', 'alice@test.com'),
+                            ('Bob', 'bob@alice.org'),
+                            ('Malice', 'malice@test.com'),
+                            ('Carol', 'carol@test.com')]:
+            Address.objects.create(name=name, email=email).groups.add(
+                self.parent_group_1
+            )
+        other = User.objects.create_user(username='other', password='other')
+        other_group = Group.objects.create(
+            name='Other',
+            addressbook=AddressBook.objects.create(name='Other', owner=other)
+        )
+        address = Address.objects.create(name='Alice', email='alice@other.com')
+        address.groups.add(other_group)
+        url = reverse('addresses') + '?q=ALICE'
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(
+            [address['name'] for address in response.data['results']],
+            ['Alice', 'Bob', 'Malice']
+        )
+        url = reverse('addresses') + '?q=alice@test.com'
+        response = self.client.get(url)
+        self.assertEquals(response.data['results'][0]['name'], 'Alice')
+
     def test_get_addresses_by_group(self):
         count = 100
         for x in range(count):
@@ -312,6 +464,67 @@ class AddressesTests(APITestCase):
         response = self.client.post(url, data, format='json')
         self.assertEquals(response.status_code, status.HTTP_201_CREATED)
 
+    def test_add_duplicate_normalized_address(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            name='Can add address',
+            content_type__app_label='address_books'
+        ))
+        url = reverse('addresses')
+        data = {'name': 'Test', 'email': 'test@test.com',
+                'groups': [self.parent_group_1.id, ]}
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        data = {'name': 'Test', 'email': ' TEST@test.com',
+                'groups': [self.parent_group_2.id, ]}
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        address = Address.objects.create(name='Test', email='Test@Test.com')
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                address.groups.add(self.parent_group_2)
+        self.parent_group_1.delete()
+        address.groups.add(self.parent_group_2)
+        self.assertEquals(
+            list(AddressBookEmail.objects.values_list('address', 'email')),
+            [(address.id, 'test@test.com')]
+        )
+
+    def test_add_address_to_hidden_group(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            name='Can add address',
+            content_type__app_label='address_books'
+        ))
+        other = User.objects.create_user(username='other', password='other')
+        other_group = Group.objects.create(
+            name='Other',
+            addressbook=AddressBook.objects.create(name='Other', owner=other)
+        )
+        url = reverse('addresses')
+        data = {'name': 'Test', 'email': 'test@test.com',
+                'groups': [self.parent_group_1.id, other_group.id]}
+        response = self.client.post(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('groups', response.data)
+
+    def test_access_checks(self):
+        address = Address.objects.create(name='Test', email='test@test.com')
+        address.groups.add(self.parent_group_1)
+        hidden = Address.objects.create(name='Hidden', email='test@test.com')
+        with self.assertNumQueries(1):
+            self.assertEquals(
+                accessible_address_ids(self.user, [address.id, hidden.id]),
+                set([address.id])
+            )
+        other = User.objects.create_user(username='other', password='other')
+        self.assertEquals(
+            accessible_group_ids(other, [self.parent_group_1.id]), set()
+        )
+        self.parent_addressbook_1.shared_with.add(other)
+        self.assertEquals(
+            accessible_group_ids(other, [self.parent_group_1.id]),
+            set([self.parent_group_1.id])
+        )
+
     def test_update_address(self):
         address = Address.objects.create(name='Test', email='Test')
         address.groups.add(self.parent_group_1)
@@ -332,6 +545,59 @@ class AddressesTests(APITestCase):
         self.assertEquals(response.status_code, status.HTTP_200_OK)
         self.assertEquals(response.data['name'], 'Test1')
 
+    def test_partial_update_address(self):
+        address = Address.objects.create(name='Test', email='test@test.com')
+        address.groups.add(self.parent_group_1)
+        self.user.user_permissions.add(Permission.objects.get(
+            name='Can change address',
+            content_type__app_label='address_books'
+        ))
+        url = reverse('address', args=[address.id])
+        response = self.client.patch(url, {'name': 'Test1'}, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['name'], 'Test1')
+        Address.objects.create(name='Other', email='other@test.com') \
+            .groups.add(self.parent_group_2)
+        response = self.client.patch(url, {'email': 'Other@test.com'},
+                                     format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_move_address_changing_email(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            name='Can change address',
+            content_type__app_label='address_books'
+        ))
+        Address.objects.create(name='Other', email='y@y.com') \
+            .groups.add(self.parent_addressbook_2_group)
+        address = Address.objects.create(name='Test', email='y@y.com')
+        address.groups.add(self.parent_group_1)
+        data = {'name': 'Test', 'email': 'z@z.com',
+                'groups': [self.parent_addressbook_2_group.id]}
+        response = self.client.put(reverse('address', args=[address.id]),
+                                   data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['groups'],
+                          [self.parent_addressbook_2_group.id])
+        self.assertEquals(
+            list(AddressBookEmail.objects.filter(address_id=address.id)
+                 .values_list('addressbook_id', 'email')),
+            [(self.parent_addressbook_2.id, 'z@z.com')]
+        )
+
+    def test_update_address_groups(self):
+        address = Address.objects.create(name='Test', email='Test')
+        address.groups.add(self.parent_group_1)
+        self.user.user_permissions.add(Permission.objects.get(
+            name='Can change address',
+            content_type__app_label='address_books'
+        ))
+        url = reverse('address', args=[address.id, ])
+        data = {'name': 'Test', 'email': 'test@test.com',
+                'groups': [self.parent_group_2.id, ]}
+        response = self.client.put(url, data, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['groups'], [self.parent_group_2.id])
+
     def test_delete_address(self):
         address = Address.objects.create(name='Test', email='Test')
         address.groups.add(self.parent_group_1)
@@ -349,4 +615,1735 @@ class AddressesTests(APITestCase):
         response = self.client.delete(url)
         self.assertEquals(response.status_code, status.HTTP_204_NO_CONTENT)
         response = self.client.get(url)
-        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(RESPONSE_CACHE=None)
+class QueryCountTests(APITestCase):
+    """
+    Serializing a page must cost the same number of queries whatever the
+    number of rows on it.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.other = User.objects.create_user(username='other',
+                                              password='other')
+        authentication.get_user(token.key)
+
+    def create_data(self, count):
+        for x in range(count):
+            addressbook = AddressBook.objects.create(
+                name='%s-%s' % (count, x), owner=self.user
+            )
+            addressbook.shared_with.add(self.other)
+            group = Group.objects.create(name=str(x), addressbook=addressbook)
+            address = Address.objects.create(
+                name=str(x), email='%s-%s@test.com' % (count, x)
+            )
+            address.groups.add(group)
+
+    def assertQueryCount(self, url, expected):
+        for count in (1, 10):
+            self.create_data(count)
+            with self.assertNumQueries(expected):
+                response = self.client.get(url)
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_addressbooks_query_count(self):
+        self.assertQueryCount(reverse('addressbooks'), 5)
+
+    def test_groups_query_count(self):
+        self.assertQueryCount(reverse('groups'), 4)
+
+    def test_addresses_query_count(self):
+        self.assertQueryCount(reverse('addresses'), 4)
+
+    def test_addressbook_query_count(self):
+        self.create_data(1)
+        url = reverse('addressbook', args=[AddressBook.objects.get().id, ])
+        with self.assertNumQueries(4):
+            self.client.get(url)
+
+
+@override_settings(RESPONSE_CACHE=None)
+class ValuesListTests(APITestCase):
+    """
+    The values-based list path must return the same bytes as the
+    serializers.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        other = User.objects.create_user(username='other', password='other')
+        for x in range(3):
+            addressbook = AddressBook.objects.create(name=str(x),
+                                                     owner=self.user)
+            if x:
+                addressbook.shared_with.add(other)
+            groups = [
+                Group.objects.create(name=str(y), addressbook=addressbook)
+                for y in range(3)
+            ]
+            for y in range(4):
+                address = Address.objects.create(
+                    name='Name %s' % y, email='%s-%s@test.com' % (x, y)
+                )
+                address.groups.add(*groups[:y])
+        Group.objects.create(name='Empty', addressbook=addressbook)
+
+    def assertSameContent(self, url):
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        with mock.patch.object(ValuesListSerializer, 'supported', False):
+            expected = self.client.get(url)
+        self.assertEquals(response.content, expected.content)
+
+    def test_addressbooks(self):
+        self.assertSameContent(reverse('addressbooks'))
+
+    def test_groups(self):
+        self.assertSameContent(reverse('groups'))
+        self.assertSameContent(reverse('groups') + '?pagination=cursor')
+
+    def test_addresses(self):
+        self.assertSameContent(reverse('addresses'))
+        self.assertSameContent(reverse('addresses') + '?q=name 2')
+        self.assertSameContent(reverse('addresses') + '?pagination=cursor')
+
+    def test_cursor_pages(self):
+        url = reverse('addresses') + '?pagination=cursor'
+        ids = []
+        with mock.patch.object(IdCursorPagination, 'page_size', 5):
+            while url is not None:
+                response = self.client.get(url)
+                ids.extend(address['id'] for address in
+                           response.data['results'])
+                url = response.data['next']
+        self.assertEquals(ids, sorted(Address.objects.visible_to(self.user)
+                                      .values_list('id', flat=True)))
+
+
+@override_settings(RESPONSE_CACHE=None)
+class SparseFieldsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        address = Address.objects.create(name='Name', email='name@test.com')
+        address.groups.add(self.group)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response, [query['sql'] for query in queries]
+
+    def test_list_fields(self):
+        response, full = self.get(reverse('addresses'))
+        response, sparse = self.get(reverse('addresses') + '?fields=id,email')
+        self.assertEquals(list(response.data['results'][0]),
+                          ['id', 'email'])
+        self.assertEquals(len(sparse), len(full) - 1)
+        self.assertNotIn('"address_books_address"."name"', sparse[-1])
+
+    def test_detail_fields(self):
+        url = reverse('addressbook', args=[self.addressbook.id])
+        response, full = self.get(url)
+        response, sparse = self.get(url + '?fields=id,name')
+        self.assertEquals(response.data, {'id': self.addressbook.id,
+                                          'name': 'Book'})
+        self.assertEquals(len(sparse), len(full) - 2)
+        self.assertNotIn('owner_id', sparse[-1])
+
+    def test_user_fields(self):
+        url = reverse('users') + '?fields=id,username'
+        response, queries = self.get(url)
+        self.assertEquals(list(response.data['results'][0]),
+                          ['id', 'username'])
+        self.assertFalse(any('auth_permission' in query
+                             for query in queries))
+
+    def test_write_ignores_fields(self):
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='change_group',
+                                   content_type__app_label='address_books')
+        )
+        url = reverse('group', args=[self.group.id]) + '?fields=id'
+        response = self.client.put(url, {
+            'name': 'Changed', 'addressbook': self.addressbook.id
+        })
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['name'], 'Changed')
+
+
+class ExpandTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+
+    def create_data(self, count):
+        for x in range(count):
+            group = Group.objects.create(name='%s-%s' % (count, x),
+                                         addressbook=self.addressbook)
+            for y in range(count):
+                address = Address.objects.create(
+                    name=str(y), email='%s-%s-%s@test.com' % (count, x, y)
+                )
+                address.groups.add(group)
+
+    def test_expand_addressbook(self):
+        self.create_data(2)
+        url = reverse('addressbook', args=[self.addressbook.id])
+        response = self.client.get(url + '?expand=groups,groups.addresses')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        groups = response.data['groups']
+        self.assertEquals(
+            [group['name'] for group in groups], ['2-0', '2-1']
+        )
+        self.assertEquals(groups[0]['addressbook'], self.addressbook.id)
+        addresses = groups[0]['addresses']
+        self.assertEquals(
+            [address['email'] for address in addresses],
+            ['2-0-0@test.com', '2-0-1@test.com']
+        )
+        self.assertEquals(addresses[0]['groups'], [groups[0]['id']])
+
+    def test_expand_groups_only(self):
+        self.create_data(1)
+        url = reverse('addressbook', args=[self.addressbook.id])
+        response = self.client.get(url + '?expand=groups')
+        group = Group.objects.get()
+        self.assertEquals(response.data['groups'][0]['addresses'],
+                          [group.addresses.get().id])
+
+    def test_expand_group(self):
+        self.create_data(1)
+        group = Group.objects.get()
+        url = reverse('group', args=[group.id])
+        response = self.client.get(url + '?expand=addresses,unknown')
+        self.assertEquals(response.data['addresses'][0]['email'],
+                          '1-0-0@test.com')
+
+    def test_expand_query_count(self):
+        url = reverse('addressbook', args=[self.addressbook.id]) + \
+            '?expand=groups,groups.addresses'
+        for count in (1, 5):
+            self.create_data(count)
+            # Versions, book, shared_with, groups, addresses, their groups
+            with self.assertNumQueries(6):
+                self.client.get(url)
+
+    def test_writes_are_not_expanded(self):
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='change_addressbook'
+        ))
+        url = reverse('addressbook', args=[self.addressbook.id])
+        response = self.client.put(url + '?expand=groups', {
+            'name': 'Renamed', 'owner': self.user.id
+        }, format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['groups'], [])
+
+
+class ETagTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        self.address = Address.objects.create(name='Name',
+                                              email='name@test.com')
+        self.address.groups.add(self.group)
+        self.other_book = AddressBook.objects.create(name='Other',
+                                                     owner=self.user)
+
+    def assertChanges(self, url, change):
+        etag = self.client.get(url)['ETag']
+        # Only the versions are read, the token's user is cached
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['ETag'], etag)
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotEquals(response['ETag'], etag)
+
+    def test_addressbook_etag(self):
+        url = reverse('addressbook', args=[self.addressbook.id])
+        self.assertChanges(url, lambda: self.addressbook.shared_with.add(
+            User.objects.create_user(username='other', password='other')
+        ))
+
+    def test_deleted_user_etag(self):
+        other = User.objects.create_user(username='other', password='other')
+        self.addressbook.shared_with.add(other)
+        url = reverse('addressbook', args=[self.addressbook.id])
+        self.assertChanges(url, other.delete)
+
+    def test_groups_etag(self):
+        url = reverse('groups') + '?addressbook=%s' % self.addressbook.id
+        self.assertChanges(url, lambda: Group.objects.create(
+            name='New', addressbook=self.addressbook
+        ))
+
+    def test_addresses_etag(self):
+        url = reverse('addresses') + '?group=%s' % self.group.id
+        self.assertChanges(url, lambda: self.address.groups.clear())
+
+    def test_address_update_etag(self):
+        url = reverse('addresses') + '?group=%s' % self.group.id
+
+        def change():
+            self.address.name = 'Changed'
+            self.address.save()
+        self.assertChanges(url, change)
+
+    def test_address_etag(self):
+        url = reverse('address', args=[self.address.id])
+
+        def change():
+            self.address.name = 'Changed'
+            self.address.save()
+        self.assertChanges(url, change)
+        etag = self.client.get(url)['ETag']
+        Group.objects.create(name='New', addressbook=self.other_book)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+
+    def test_snapshot_load_etag(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        call_command('snapshot', 'dump', directory, stdout=io.StringIO())
+        self.group.name = 'Renamed'
+        self.group.save()
+        url = reverse('group', args=[self.group.id])
+        etag = self.client.get(url)['ETag']
+        call_command('snapshot', 'load', directory, truncate=True,
+                     stdout=io.StringIO())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['name'], 'Group')
+
+    def test_any_etag(self):
+        url = reverse('address', args=[self.address.id])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+        self.assertEquals(response.status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+        url = reverse('address', args=[self.address.id + 1])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+        url = reverse('addressbook', args=[self.addressbook.id + 2])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='*')
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stale_save_keeps_version(self):
+        stale = AddressBook.objects.get(id=self.addressbook.id)
+        Group.objects.create(name='New', addressbook=self.addressbook)
+        version = AddressBook.objects.get(id=self.addressbook.id).version
+        stale.name = 'Renamed'
+        stale.save()
+        self.assertEquals(
+            AddressBook.objects.get(id=self.addressbook.id).version,
+            version + 1
+        )
+
+    def test_other_addressbook_keeps_etag(self):
+        url = reverse('groups') + '?addressbook=%s' % self.addressbook.id
+        etag = self.client.get(url)['ETag']
+        Group.objects.create(name='New', addressbook=self.other_book)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+
+
+class RenderingTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        addressbook = AddressBook.objects.create(name='Book', owner=self.user)
+        group = Group.objects.create(name='Group', addressbook=addressbook)
+        for x in range(20):
+            address = Address.objects.create(name='Name %s' % x,
+                                             email='name%s@test.com' % x)
+            address.groups.add(group)
+        self.url = reverse('addresses')
+
+    def test_choose_encoding(self):
+        self.assertEquals(renderers.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEquals(renderers.choose_encoding('gzip;q=0, *'),
+                          'br' if renderers.brotli else None)
+        self.assertEquals(renderers.choose_encoding('identity'), None)
+        self.assertEquals(renderers.choose_encoding(''), None)
+
+    def test_gzip(self):
+        plain = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEquals(gzip.decompress(response.content), plain.content)
+        self.assertLess(len(response.content), len(plain.content))
+
+    def test_gzip_etag(self):
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip')
+        etag = response['ETag']
+        self.assertTrue(etag.endswith(';gzip"'))
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['ETag'], etag)
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_small_responses_are_not_compressed(self):
+        response = self.client.get(reverse('groups'),
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_streaming_gzip(self):
+        addressbook = AddressBook.objects.get()
+        url = reverse('addressbookexport', args=[addressbook.id])
+        plain = b''.join(self.client.get(url).streaming_content)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assertEquals(
+            gzip.decompress(b''.join(response.streaming_content)), plain
+        )
+
+    @unittest.skipIf(renderers.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        plain = self.client.get(self.url)
+        response = self.client.get(self.url,
+                                   HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEquals(response['Content-Encoding'], 'br')
+        self.assertEquals(renderers.brotli.decompress(response.content),
+                          plain.content)
+
+    @unittest.skipIf(renderers.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        plain = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_ACCEPT='application/msgpack')
+        self.assertEquals(response['Content-Type'], 'application/msgpack')
+        self.assertEquals(renderers.msgpack.unpackb(response.content),
+                          json.loads(plain.content.decode('utf-8')))
+
+
+class ResponseCacheTests(APITestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        self.other_book = AddressBook.objects.create(name='Other',
+                                                     owner=self.user)
+        self.other_group = Group.objects.create(name='Other',
+                                                addressbook=self.other_book)
+        self.url = reverse('groups') + '?addressbook=%s' % self.addressbook.id
+
+    def test_cached(self):
+        response = self.client.get(self.url)
+        # Only the versions are read
+        with self.assertNumQueries(1):
+            cached = self.client.get(self.url)
+        self.assertEquals(cached.status_code, status.HTTP_200_OK)
+        self.assertEquals(cached.content, response.content)
+        self.assertEquals(cached['Content-Type'], response['Content-Type'])
+        self.assertEquals(cached['ETag'], response['ETag'])
+
+    def test_per_host(self):
+        Group.objects.create(name='Second', addressbook=self.addressbook)
+        url = self.url + '&pagination=cursor'
+        with mock.patch.object(IdCursorPagination, 'page_size', 1):
+            for host in ('lithium.autrilla.com', 'addressbooks.favega.com'):
+                response = self.client.get(url, HTTP_HOST=host)
+                data = json.loads(response.content.decode('utf-8'))
+                self.assertTrue(data['next'].startswith('http://%s/' % host))
+
+    def test_invalidated_by_changes(self):
+        self.client.get(self.url)
+        self.group.name = 'Renamed'
+        self.group.save()
+        response = self.client.get(self.url)
+        self.assertEquals(response.data['results'][0]['name'], 'Renamed')
+
+    def test_other_books_stay_cached(self):
+        self.client.get(self.url)
+        Address.objects.create(name='Name', email='name@test.com') \
+            .groups.add(self.other_group)
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+
+    def test_per_user(self):
+        self.client.get(self.url)
+        other = User.objects.create_user(username='other', password='other')
+        self.addressbook.shared_with.add(other)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' +
+                                Token.objects.get(user=other).key)
+        response = self.client.get(reverse('groups'))
+        self.assertEquals([group['name'] for group in response.data['results']],
+                          ['Group'])
+
+    def test_browsable_api_not_cached(self):
+        for accept, cached in (('text/html', False),
+                               ('application/json', True)):
+            etag = self.client.get(self.url, HTTP_ACCEPT=accept)['ETag']
+            key = views.RESPONSE_CACHE_PREFIX + etag.strip('"')
+            self.assertEquals(caches['default'].get(key) is not None, cached)
+
+
+class AddressBatchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.user.user_permissions.add(*Permission.objects.filter(
+            codename__in=['add_address', 'change_address', 'delete_address']
+        ))
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group_1 = Group.objects.create(name='1',
+                                            addressbook=self.addressbook)
+        self.group_2 = Group.objects.create(name='2',
+                                            addressbook=self.addressbook)
+        self.addresses = []
+        for x in range(3):
+            address = Address.objects.create(name=str(x),
+                                             email='%s@test.com' % x)
+            address.groups.add(self.group_1)
+            self.addresses.append(address)
+        self.url = reverse('addressbatch')
+
+    def test_delete_ignores_groups(self):
+        response = self.client.post(self.url, [
+            {'op': 'delete', 'id': self.addresses[0].id, 'groups': 'abc'},
+            {'op': 'delete', 'id': self.addresses[1].id, 'groups': 5},
+            {'op': 'delete', 'id': self.addresses[2].id, 'groups': [{}]},
+        ], format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Address.objects.exists())
+
+    def test_batch(self):
+        deleted_id = self.addresses[2].id
+        response = self.client.post(self.url, [
+            {'op': 'create', 'name': 'New', 'email': 'new@test.com',
+             'groups': [self.group_1.id, self.group_2.id]},
+            {'op': 'update', 'id': self.addresses[0].id, 'name': 'Changed'},
+            {'op': 'update', 'id': self.addresses[1].id,
+             'groups': [self.group_2.id]},
+            {'op': 'delete', 'id': deleted_id},
+        ], format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        results = response.data['results']
+        self.assertEquals([result['status'] for result in results],
+                          [201, 200, 200, 204])
+        self.assertEquals(sorted(results[0]['data']['groups']),
+                          [self.group_1.id, self.group_2.id])
+        self.assertEquals(Address.objects.get(
+            id=self.addresses[0].id).name, 'Changed')
+        self.assertEquals(results[2]['data']['groups'], [self.group_2.id])
+        self.assertFalse(Address.objects.filter(id=deleted_id).exists())
+        self.assertFalse(AddressBookEmail.objects.filter(
+            address_id=deleted_id).exists())
+        self.assertTrue(AddressBookEmail.objects.filter(
+            address_id=results[0]['id'], email='new@test.com').exists())
+
+    def test_batch_query_count(self):
+        def operations(count):
+            return [
+                {'op': 'create', 'name': str(x), 'groups': [self.group_2.id],
+                 'email': '%s-%s@test.com' % (count, x)}
+                for x in range(count)
+            ] + [
+                {'op': 'update', 'id': address.id, 'name': 'Changed'}
+                for address in self.addresses[:count]
+            ]
+        counts = []
+        for count in (1, 3):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.url, operations(count),
+                                            format='json')
+            self.assertEquals(response.status_code, status.HTTP_200_OK)
+            counts.append(len(queries))
+        self.assertEquals(counts[0], counts[1])
+
+    def test_invalid_batch_writes_nothing(self):
+        response = self.client.post(self.url, [
+            {'op': 'update', 'id': self.addresses[0].id, 'name': 'Changed'},
+            {'op': 'create', 'name': 'New', 'email': '1@TEST.com',
+             'groups': [self.group_1.id]},
+            {'op': 'delete', 'id': 0},
+        ], format='json')
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+        self.assertEquals([error['index']
+                           for error in response.data['errors']], [1, 2])
+        self.assertEquals(Address.objects.get(
+            id=self.addresses[0].id).name, '0')
+
+    def test_duplicates_within_batch(self):
+        response = self.client.post(self.url, [
+            {'op': 'update', 'id': self.addresses[0].id,
+             'email': 'same@test.com'},
+            {'op': 'create', 'name': 'New', 'email': 'same@test.com',
+             'groups': [self.group_1.id]},
+        ], format='json')
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+
+    def test_swap_emails(self):
+        response = self.client.post(self.url, [
+            {'op': 'delete', 'id': self.addresses[0].id},
+            {'op': 'update', 'id': self.addresses[1].id,
+             'email': '0@test.com'},
+        ], format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_email_freed_by_moved_address(self):
+        other_book = AddressBook.objects.create(name='Other',
+                                                owner=self.user)
+        other_group = Group.objects.create(name='Other',
+                                           addressbook=other_book)
+        response = self.client.post(self.url, [
+            {'op': 'update', 'id': self.addresses[1].id,
+             'email': '0@test.com'},
+            {'op': 'update', 'id': self.addresses[0].id,
+             'groups': [other_group.id]},
+        ], format='json')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(
+            set(AddressBookEmail.objects.filter(email='0@test.com')
+                .values_list('addressbook_id', 'address_id')),
+            set([(self.addressbook.id, self.addresses[1].id),
+                 (other_book.id, self.addresses[0].id)])
+        )
+
+    def test_swap_emails_across_chunks(self):
+        first, second = self.addresses[:2]
+        Address.objects.filter(id=first.id).update(
+            normalized_email='1@test.com'
+        )
+        Address.objects.filter(id=second.id).update(
+            normalized_email='0@test.com'
+        )
+        sync_addressbook_emails([first.id, second.id], chunk_size=1)
+        self.assertEquals(
+            dict(AddressBookEmail.objects.filter(
+                address_id__in=[first.id, second.id]
+            ).values_list('address_id', 'email')),
+            {first.id: '1@test.com', second.id: '0@test.com'}
+        )
+
+    def test_permissions(self):
+        self.user.user_permissions.remove(
+            Permission.objects.get(codename='delete_address')
+        )
+        response = self.client.post(self.url, [
+            {'op': 'delete', 'id': self.addresses[0].id},
+        ], format='json')
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class GroupAddressesTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='change_group',
+                                   content_type__app_label='address_books')
+        )
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.source = Group.objects.create(name='Source',
+                                           addressbook=self.addressbook)
+        self.target = Group.objects.create(name='Target',
+                                           addressbook=self.addressbook)
+        self.addresses = []
+        for x in range(5):
+            address = Address.objects.create(name='Name %s' % x,
+                                             email='%s@test.com' % x)
+            address.groups.add(self.source)
+            self.addresses.append(address)
+
+    def post(self, group, action, data):
+        url = reverse('groupaddresses', args=[group.id, action])
+        return self.client.post(url, data, format='json')
+
+    def members(self, group):
+        return sorted(group.addresses.values_list('id', flat=True))
+
+    def test_add_by_id(self):
+        ids = [address.id for address in self.addresses[:3]]
+        response = self.post(self.target, 'add', {'addresses': ids})
+        self.assertEquals(response.data, {'added': 3})
+        self.assertEquals(self.members(self.target), ids)
+        response = self.post(self.target, 'add', {'addresses': ids})
+        self.assertEquals(response.data, {'added': 0})
+
+    def test_list_body(self):
+        response = self.post(self.source, 'add', [self.addresses[0].id])
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_add_by_filter(self):
+        response = self.post(self.target, 'add',
+                             {'group': self.source.id, 'q': 'name 1'})
+        self.assertEquals(response.data, {'added': 1})
+        self.assertEquals(self.members(self.target),
+                          [self.addresses[1].id])
+
+    def test_remove(self):
+        response = self.post(self.source, 'remove',
+                             {'addresses': [self.addresses[0].id]})
+        self.assertEquals(response.data, {'removed': 1})
+        self.assertEquals(len(self.members(self.source)), 4)
+
+    def test_move(self):
+        response = self.post(self.source, 'move',
+                             {'to': self.target.id, 'group': self.source.id})
+        self.assertEquals(response.data, {'moved': 5})
+        self.assertEquals(self.members(self.source), [])
+        self.assertEquals(len(self.members(self.target)), 5)
+
+    def test_duplicate_email(self):
+        other_book = AddressBook.objects.create(name='Other',
+                                                owner=self.user)
+        other = Group.objects.create(name='Other', addressbook=other_book)
+        Address.objects.create(name='Taken',
+                               email='0@TEST.com').groups.add(other)
+        response = self.post(other, 'add', {'group': self.source.id})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(response.data['duplicates'],
+                          [self.addresses[0].id])
+        self.assertEquals(len(self.members(other)), 1)
+
+    def test_hidden_addresses(self):
+        other = User.objects.create_user(username='other', password='other')
+        addressbook = AddressBook.objects.create(name='Other', owner=other)
+        group = Group.objects.create(name='Hidden', addressbook=addressbook)
+        address = Address.objects.create(name='Hidden',
+                                         email='hidden@test.com')
+        address.groups.add(group)
+        response = self.post(self.target, 'add', {'addresses': [address.id]})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+        response = self.post(group, 'add',
+                             {'addresses': [self.addresses[0].id]})
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_query_count(self):
+        counts = []
+        for count in (1, 4):
+            ids = [address.id for address in self.addresses[:count]]
+            with CaptureQueriesContext(connection) as queries:
+                self.post(self.target, 'add', {'addresses': ids})
+            counts.append(len(queries))
+        self.assertEquals(counts[0], counts[1])
+
+
+class AuthenticationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.url = reverse('addressbooks')
+
+    def test_cached_user(self):
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second:
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertLess(len(second), len(first))
+        self.assertFalse(any('authtoken_token' in query['sql']
+                             for query in second))
+
+    def test_permission_change(self):
+        data = {'name': 'Test', 'owner': self.user.id}
+        response = self.client.post(self.url, data)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.user.user_permissions.add(
+            Permission.objects.get(codename='add_addressbook')
+        )
+        response = self.client.post(self.url, data)
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+
+    def test_deleted_token(self):
+        self.client.get(self.url)
+        self.token.delete()
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertNotIn('WWW-Authenticate', response)
+
+    def test_inactive_user(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_revoked_in_other_process(self):
+        self.client.get(self.url)
+        # Another process keeps its own copy of the LRU entry
+        entry = authentication._users.get(self.token.key)
+        self.user.is_active = False
+        self.user.save()
+        authentication._users.set(self.token.key, entry)
+        response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_deleted_auth_group(self):
+        self.client.get(self.url)
+        entry = authentication._users.get(self.token.key)
+        AuthGroup.objects.create(name='Group')
+        with CaptureQueriesContext(connection) as queries:
+            AuthGroup.objects.all().delete()
+        self.assertFalse(any('authtoken_token' in query['sql']
+                             for query in queries))
+        authentication._users.set(self.token.key, entry)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(any('authtoken_token' in query['sql']
+                            for query in queries))
+
+
+class AddressImportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.user.user_permissions.add(Permission.objects.get(
+            codename='add_address', content_type__app_label='address_books'
+        ))
+        addressbook = AddressBook.objects.create(name='Test', owner=self.user)
+        self.group_1 = Group.objects.create(name='1', addressbook=addressbook)
+        self.group_2 = Group.objects.create(name='2', addressbook=addressbook)
+        other = User.objects.create_user(username='other', password='other')
+        self.other_group = Group.objects.create(
+            name='Other',
+            addressbook=AddressBook.objects.create(name='Other', owner=other)
+        )
+        Address.objects.create(name='Old', email='old@test.com').groups.add(
+            self.group_1
+        )
+
+    def upload(self, name, content, query=''):
+        url = reverse('addressimport') + query
+        upload = SimpleUploadedFile(name, content.encode('utf-8'))
+        return self.client.post(url, {'file': upload}, format='multipart')
+
+    def test_import_csv(self):
+        content = (
+            'name,email,groups\n'
+            'A,a@test.com,%(group)s\n'
+            'B,b@test.com,%(group)s;%(group_2)s\n'
+            'Old,old@test.com,%(group_2)s\n'
+            'A again,a@test.com,%(group)s\n'
+            'C,c@test.com,%(other)s\n'
+            ',d@test.com,%(group)s\n'
+        ) % {'group': self.group_1.id, 'group_2': self.group_2.id,
+             'other': self.other_group.id}
+        response = self.upload('addresses.csv', content)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['created'], 2)
+        self.assertEquals(
+            [error['row'] for error in response.data['errors']], [3, 4, 5, 6]
+        )
+        address = Address.objects.get(email='b@test.com')
+        self.assertEquals(
+            set(address.groups.all()), set([self.group_1, self.group_2])
+        )
+
+    def test_import_unreadable_file(self):
+        content = (
+            'name,email,groups\n'
+            'A,a@test.com,%(group)s\n'
+            'B,b\xe9@test.com,%(group)s\n'
+        ) % {'group': self.group_1.id}
+        upload = SimpleUploadedFile('addresses.csv',
+                                    content.encode('latin-1'))
+        response = self.client.post(reverse('addressimport'),
+                                    {'file': upload}, format='multipart')
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['created'], 1)
+        self.assertEquals(
+            [error['row'] for error in response.data['errors']], [2]
+        )
+        self.assertTrue(Address.objects.filter(email='a@test.com').exists())
+
+        response = self.upload('addresses.csv', (
+            'name,email,groups\n'
+            'C,c@test.com,%(group)s\n'
+            'D,"d@test.com\0",%(group)s\n'
+        ) % {'group': self.group_1.id})
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['created'], 1)
+        self.assertEquals(
+            [error['row'] for error in response.data['errors']], [2]
+        )
+
+    def test_import_ndjson_and_vcard(self):
+        content = (
+            '{"name": "A", "email": "a@test.com"}\n'
+            'not json\n'
+        )
+        query = '?group=%s' % self.group_2.id
+        response = self.upload('addresses.ndjson', content, query)
+        self.assertEquals(response.data['created'], 1)
+        self.assertEquals(response.data['errors'][0]['row'], 2)
+        content = (
+            'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:Vcard\r\n'
+            'EMAIL;TYPE=work:v@te\r\n st.com\r\nEND:VCARD\r\n'
+        )
+        response = self.upload('addresses.vcf', content, query)
+        self.assertEquals(response.data['created'], 1)
+        address = Address.objects.get(email='v@test.com')
+        self.assertEquals(address.name, 'Vcard')
+        self.assertEquals(list(address.groups.all()), [self.group_2])
+
+
+class AddressBookExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.addressbook = AddressBook.objects.create(name='Test',
+                                                      owner=self.user)
+        self.group_1 = Group.objects.create(name='1',
+                                            addressbook=self.addressbook)
+        self.group_2 = Group.objects.create(name='2',
+                                            addressbook=self.addressbook)
+        for x in range(5):
+            address = Address.objects.create(name=str(x),
+                                             email='%s@test.com' % x)
+            address.groups.add(self.group_1)
+            if x % 2:
+                address.groups.add(self.group_2)
+
+    def export(self, export_type):
+        url = reverse('addressbookexport', args=[self.addressbook.id, ])
+        response = self.client.get(url + '?type=' + export_type)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_csv(self):
+        lines = self.export('csv').splitlines()
+        self.assertEquals(lines[0], 'id,name,email,groups')
+        self.assertEquals(len(lines), 6)
+        self.assertTrue(lines[2].endswith(
+            '%s;%s' % (self.group_1.id, self.group_2.id)
+        ))
+
+    def test_export_ndjson(self):
+        lines = self.export('ndjson').splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEquals([row['type'] for row in rows],
+                          ['addressbook'] + ['group'] * 2 + ['address'] * 5)
+
+    def test_export_vcard(self):
+        content = self.export('vcard')
+        self.assertEquals(content.count('BEGIN:VCARD'), 5)
+        self.assertIn('CATEGORIES:1,2', content)
+
+    def test_export_hidden_addressbook(self):
+        other = User.objects.create_user(username='other', password='other')
+        addressbook = AddressBook.objects.create(name='Other', owner=other)
+        url = reverse('addressbookexport', args=[addressbook.id, ])
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CountTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        self.other = Group.objects.create(name='Other',
+                                          addressbook=self.addressbook)
+        self.addresses = [
+            Address.objects.create(name=str(x), email='%s@test.com' % x)
+            for x in range(3)
+        ]
+
+    def assertCounts(self, groups, other, addresses):
+        self.assertEquals(
+            Group.objects.get(id=self.group.id).address_count, groups
+        )
+        self.assertEquals(
+            Group.objects.get(id=self.other.id).address_count, other
+        )
+        addressbook = AddressBook.objects.get(id=self.addressbook.id)
+        self.assertEquals(addressbook.address_count, addresses)
+
+    def test_group_count(self):
+        self.assertEquals(
+            AddressBook.objects.get(id=self.addressbook.id).group_count, 2
+        )
+        self.other.delete()
+        self.assertEquals(
+            AddressBook.objects.get(id=self.addressbook.id).group_count, 1
+        )
+
+    def test_memberships(self):
+        self.group.addresses.add(*self.addresses)
+        self.addresses[0].groups.add(self.other)
+        self.assertCounts(3, 1, 3)
+        self.group.addresses.remove(self.addresses[0])
+        self.assertCounts(2, 1, 3)
+        self.addresses[0].groups.clear()
+        self.assertCounts(2, 0, 2)
+        self.group.addresses.clear()
+        self.assertCounts(0, 0, 0)
+
+    def test_deletes(self):
+        self.group.addresses.add(*self.addresses)
+        self.other.addresses.add(self.addresses[0])
+        self.addresses[0].delete()
+        self.assertCounts(2, 0, 2)
+        delete_addresses([self.addresses[1].id])
+        self.assertCounts(1, 0, 1)
+        self.group.delete()
+        addressbook = AddressBook.objects.get(id=self.addressbook.id)
+        self.assertEquals(addressbook.address_count, 0)
+        self.assertEquals(addressbook.group_count, 1)
+
+    def test_increments(self):
+        stale = Group.objects.get(id=self.group.id)
+        self.group.addresses.add(*self.addresses)
+        stale.name = 'Renamed'
+        stale.save()
+        self.assertCounts(3, 0, 3)
+        self.other.addresses.add(self.addresses[0])
+        self.group.addresses.remove(self.addresses[0])
+        self.other.addresses.remove(self.addresses[1])
+        self.assertCounts(2, 1, 3)
+        self.addresses[1].groups.clear()
+        self.assertCounts(1, 1, 2)
+
+    def test_move_group(self):
+        self.group.addresses.add(*self.addresses)
+        other_book = AddressBook.objects.create(name='Other',
+                                                owner=self.user)
+        self.group.addressbook = other_book
+        self.group.save()
+        self.assertCounts(3, 0, 0)
+        other_book = AddressBook.objects.get(id=other_book.id)
+        self.assertEquals(other_book.group_count, 1)
+        self.assertEquals(other_book.address_count, 3)
+
+    def test_serializers(self):
+        self.group.addresses.add(*self.addresses)
+        response = self.client.get(
+            reverse('addressbook', args=[self.addressbook.id])
+        )
+        self.assertEquals(response.data['group_count'], 2)
+        self.assertEquals(response.data['address_count'], 3)
+        response = self.client.get(reverse('groups'))
+        self.assertEquals(
+            [group['address_count'] for group in response.data['results']],
+            [3, 0]
+        )
+
+    def test_rebuild_counts(self):
+        self.group.addresses.add(*self.addresses)
+        Group.objects.update(address_count=7)
+        AddressBook.objects.update(group_count=7, address_count=7)
+        call_command('rebuild_counts', chunk_size=1, stdout=io.StringIO())
+        self.assertCounts(3, 0, 3)
+        self.assertEquals(
+            AddressBook.objects.get(id=self.addressbook.id).group_count, 2
+        )
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.factory = RequestFactory()
+        self.middleware = routers.ReplicaMiddleware()
+        self.router = routers.ReplicaRouter()
+
+    def request(self, method, token='token'):
+        """
+        Returns the database Address reads go to while handling a request.
+        """
+        request = getattr(self.factory, method)(
+            '/', HTTP_AUTHORIZATION='Token ' + token
+        )
+        self.middleware.process_request(request)
+        database = self.router.db_for_read(Address)
+        self.middleware.process_response(request, HttpResponse())
+        return database
+
+    def test_reads_go_to_replicas(self):
+        self.assertEquals(self.request('get'), 'replica')
+        self.assertEquals(self.request('head'), 'replica')
+        # Outside requests everything uses the primary
+        self.assertEquals(self.router.db_for_read(Address), 'default')
+
+    def test_writes_go_to_primary(self):
+        self.assertEquals(self.request('post'), 'default')
+        self.assertEquals(self.router.db_for_write(Address), 'default')
+
+    def test_pinned_after_write(self):
+        self.request('delete')
+        self.assertEquals(self.request('get'), 'default')
+        self.assertEquals(self.request('get', token='other'), 'replica')
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.request('put', token='other')
+        self.assertEquals(self.request('get', token='other'), 'replica')
+
+    def test_pinned_after_login(self):
+        session = SessionStore()
+        session.create()
+        request = self.factory.post('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'anonymous'
+        # The login replaced the session the request came with
+        request.session = session
+        self.middleware.process_request(request)
+        self.middleware.process_response(request, HttpResponse())
+        request = self.factory.get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.middleware.process_request(request)
+        self.assertEquals(self.router.db_for_read(Address), 'default')
+        self.middleware.process_response(request, HttpResponse())
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas(self):
+        self.assertEquals(self.request('get'), 'default')
+
+    def test_no_migrations_on_replicas(self):
+        self.assertTrue(self.router.allow_migrate('default', 'address_books'))
+        self.assertFalse(self.router.allow_migrate('replica', 'address_books'))
+
+
+class JobTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.user.user_permissions.add(*Permission.objects.filter(
+            codename__in=['add_address', 'delete_address'],
+            content_type__app_label='address_books'
+        ))
+        self.addressbook = AddressBook.objects.create(name='Test',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        self.addresses = [
+            Address.objects.create(name=str(x), email='%s@test.com' % x)
+            for x in range(3)
+        ]
+        self.group.addresses.add(*self.addresses)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        media = override_settings(MEDIA_ROOT=directory)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def queue(self, data, format='json', **kwargs):
+        response = self.client.post(reverse('jobs'), data, format=format,
+                                    **kwargs)
+        self.assertEquals(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEquals(response.data['status'], Job.PENDING)
+        return response.data['id']
+
+    def run_jobs(self):
+        # Closing the connection would end the test case's transaction
+        with mock.patch('address_books.management.commands.run_jobs.'
+                        'close_old_connections') as close:
+            call_command('run_jobs', once=True, stdout=io.StringIO())
+        return close
+
+    def get_job(self, job_id):
+        response = self.client.get(reverse('job', args=[job_id]))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_export(self):
+        job_id = self.queue({'kind': 'export',
+                             'addressbook': self.addressbook.id})
+        self.run_jobs()
+        job = self.get_job(job_id)
+        self.assertEquals(job['status'], Job.DONE)
+        self.assertEquals((job['progress'], job['total']), (3, 3))
+        response = self.client.get(job['output'])
+        self.assertEquals(response['Content-Type'], 'text/csv; charset=utf-8')
+        export = self.client.get(
+            reverse('addressbookexport', args=[self.addressbook.id])
+        )
+        self.assertEquals(b''.join(response.streaming_content),
+                          b''.join(export.streaming_content))
+
+    def test_import(self):
+        upload = SimpleUploadedFile('import.csv', (
+            'name,email,groups\n'
+            'A,a@test.com,%s\n'
+            'B,0@test.com,%s\n' % (self.group.id, self.group.id)
+        ).encode('utf-8'))
+        job_id = self.queue({'kind': 'import', 'file': upload},
+                            format='multipart')
+        self.run_jobs()
+        job = self.get_job(job_id)
+        self.assertEquals(job['status'], Job.DONE)
+        self.assertEquals(job['progress'], 2)
+        self.assertEquals(job['result']['created'], 1)
+        self.assertEquals(job['result']['errors'][0]['row'], 2)
+        self.assertTrue(Address.objects.filter(email='a@test.com').exists())
+
+    def test_import_not_utf8(self):
+        upload = SimpleUploadedFile('import.csv', (
+            'name,email,groups\n'
+            'A,a@test.com,%s\n'
+            'B,\xe9@test.com,%s\n' % (self.group.id, self.group.id)
+        ).encode('latin-1'))
+        job_id = self.queue({'kind': 'import', 'file': upload},
+                            format='multipart')
+        self.run_jobs()
+        job = self.get_job(job_id)
+        self.assertEquals(job['status'], Job.DONE)
+        self.assertEquals(job['result']['created'], 1)
+        self.assertEquals(job['result']['errors'][0]['errors'], {
+            'non_field_errors': ['The file is not UTF-8 encoded']
+        })
+
+    def test_export_progress(self):
+        job_id = self.queue({'kind': 'export', 'type': 'ndjson',
+                             'addressbook': self.addressbook.id})
+        with mock.patch.object(jobs, 'report', wraps=jobs.report) as report:
+            self.run_jobs()
+        # The book and group lines are not counted
+        self.assertEquals([call[0][1] for call in report.call_args_list],
+                          [0, 3, 3])
+        job = self.get_job(job_id)
+        self.assertEquals((job['progress'], job['total']), (3, 3))
+
+    def test_files_removed(self):
+        upload = SimpleUploadedFile('import.csv', (
+            'name,email,groups\nA,a@test.com,%s\n' % self.group.id
+        ).encode('utf-8'))
+        import_id = self.queue({'kind': 'import', 'file': upload},
+                               format='multipart')
+        export_id = self.queue({'kind': 'export',
+                                'addressbook': self.addressbook.id})
+        upload = Job.objects.get(id=import_id).input
+        self.assertTrue(upload.storage.exists(upload.name))
+        self.run_jobs()
+        self.assertFalse(upload.storage.exists(upload.name))
+        self.assertFalse(Job.objects.get(id=import_id).input)
+        output = Job.objects.get(id=export_id).output
+        self.assertTrue(output.storage.exists(output.name))
+        jobs.prune_jobs()
+        self.assertEquals(Job.objects.count(), 2)
+        with self.settings(JOB_RETENTION=-1):
+            jobs.prune_jobs()
+        self.assertFalse(Job.objects.exists())
+        self.assertFalse(output.storage.exists(output.name))
+
+    def test_delete(self):
+        job_id = self.queue({
+            'kind': 'delete',
+            'addresses': [address.id for address in self.addresses[:2]]
+        })
+        self.run_jobs()
+        job = self.get_job(job_id)
+        self.assertEquals(job['status'], Job.DONE)
+        self.assertEquals(job['result'], {'deleted': 2})
+        self.assertEquals(list(Address.objects.values_list('id', flat=True)),
+                          [self.addresses[2].id])
+
+    def test_failed(self):
+        job_id = self.queue({'kind': 'export',
+                             'addressbook': self.addressbook.id})
+        self.addressbook.delete()
+        with mock.patch.object(jobs.logger, 'exception') as log:
+            self.run_jobs()
+        self.assertTrue(log.called)
+        job = self.get_job(job_id)
+        self.assertEquals(job['status'], Job.FAILED)
+        self.assertTrue(job['error'])
+        self.assertEquals(
+            self.client.get(reverse('joboutput', args=[job_id])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+
+    def test_claimed_once(self):
+        job = jobs.enqueue(self.user, Job.DELETE, addresses=[])
+        self.assertEquals(jobs.claim().id, job.id)
+        self.assertIsNone(jobs.claim())
+
+    @mock.patch.object(jobs, 'logger')
+    def test_reclaimed(self, log):
+        job = jobs.enqueue(self.user, Job.DELETE, addresses=[])
+        stopped = jobs.claim()
+        jobs.report(stopped, 0)
+        self.assertIsNone(jobs.claim())
+        timeout = timedelta(seconds=jobs.timeout() + 1)
+        for attempt in range(2, jobs.MAX_ATTEMPTS + 1):
+            Job.objects.filter(id=job.id).update(
+                heartbeat=timezone.now() - timeout
+            )
+            claimed = jobs.claim()
+            self.assertEquals((claimed.id, claimed.attempts),
+                              (job.id, attempt))
+        # The stopped worker may not write to the job anymore
+        with self.assertRaises(jobs.Reclaimed):
+            jobs.report(stopped, 1)
+        jobs.run(stopped)
+        self.assertEquals(Job.objects.get(id=job.id).status, Job.RUNNING)
+        Job.objects.filter(id=job.id).update(
+            heartbeat=timezone.now() - timeout
+        )
+        self.assertIsNone(jobs.claim())
+        job.refresh_from_db()
+        self.assertEquals(job.status, Job.FAILED)
+        self.assertTrue(job.error)
+
+    def test_database_error(self):
+        job_id = self.queue({'kind': 'delete', 'addresses': []})
+        claim = jobs.claim
+        with mock.patch.object(jobs, 'claim', side_effect=[
+                OperationalError('server closed the connection'),
+                claim(), None]), \
+                mock.patch.object(jobs, 'run', side_effect=lambda job: job), \
+                mock.patch('address_books.management.commands.run_jobs.'
+                           'logger') as log, \
+                mock.patch('time.sleep'):
+            close = self.run_jobs()
+        self.assertTrue(log.exception.called)
+        self.assertEquals(close.call_count, 3)
+        self.assertEquals(Job.objects.get(id=job_id).status, Job.RUNNING)
+
+    def test_list_body(self):
+        response = self.client.post(reverse('jobs'), [{'kind': 'delete'}],
+                                    format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid(self):
+        response = self.client.post(reverse('jobs'), {'kind': 'other'},
+                                    format='json')
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(reverse('jobs'), {
+            'kind': 'export', 'addressbook': self.addressbook.id + 1
+        }, format='json')
+        self.assertEquals(response.data, {
+            'addressbook': ['Invalid address book']
+        })
+
+    def test_permissions(self):
+        self.user.user_permissions.clear()
+        response = self.client.post(reverse('jobs'), {
+            'kind': 'delete', 'addresses': [self.addresses[0].id]
+        }, format='json')
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        other = User.objects.create_user(username='other', password='other')
+        job = jobs.enqueue(other, Job.DELETE, addresses=[])
+        self.assertEquals(
+            self.client.get(reverse('job', args=[job.id])).status_code,
+            status.HTTP_404_NOT_FOUND
+        )
+        self.assertEquals(self.client.get(reverse('jobs')).data['count'], 0)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.other = User.objects.create_user(username='other',
+                                              password='other')
+        for owner in (self.user, self.other):
+            addressbook = AddressBook.objects.create(name=owner.username,
+                                                     owner=owner)
+            group = Group.objects.create(name='Group',
+                                         addressbook=addressbook)
+            for x in range(3):
+                Address.objects.create(
+                    name='Name, "%s"' % x if x else '',
+                    email='%s@%s.com' % (x, owner.username)
+                ).groups.add(group)
+        AddressBook.objects.get(owner=self.user).shared_with.add(self.other)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def snapshot(self, *args, **options):
+        call_command('snapshot', *args, stdout=io.StringIO(), **options)
+
+    def state(self):
+        return [
+            list(model.objects.order_by('pk').values_list(*[
+                field.attname for field in model._meta.concrete_fields
+                if field.attname != 'version'
+            ]))
+            for model in (AddressBook, AddressBook.shared_with.through,
+                          AddressBookAccess, Group, Address,
+                          Address.groups.through, AddressBookEmail)
+        ]
+
+    def indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master "
+                           "WHERE type = 'index' ORDER BY name")
+            return cursor.fetchall()
+
+    def test_dump_and_load(self):
+        state = self.state()
+        indexes = self.indexes()
+        self.snapshot('dump', self.directory)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.directory, 'address_books_address.csv')
+        ))
+        self.snapshot('load', self.directory, truncate=True)
+        self.assertEquals(self.state(), state)
+        self.assertEquals(self.indexes(), indexes)
+        # New rows get fresh ids and the derived data still works
+        address = Address.objects.create(name='New', email='new@test.com')
+        address.groups.add(Group.objects.first())
+        self.assertEquals(address.id, state[4][-1][0] + 1)
+
+    def test_owner(self):
+        self.snapshot('dump', self.directory, owner='test')
+        self.snapshot('load', self.directory, truncate=True)
+        self.assertEquals(
+            list(AddressBook.objects.values_list('name', flat=True)),
+            ['test']
+        )
+        self.assertEquals(Address.objects.count(), 3)
+        self.assertEquals(AddressBookAccess.objects.count(), 2)
+
+    def test_errors(self):
+        with self.assertRaises(CommandError):
+            self.snapshot('dump', self.directory, format='binary')
+        with self.assertRaises(CommandError):
+            self.snapshot('load', self.directory)
+        with self.assertRaises(CommandError):
+            self.snapshot('dump', self.directory, owner='nobody')
+
+
+class SyncTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.other = User.objects.create_user(username='other',
+                                              password='other')
+        self.addressbook = AddressBook.objects.create(name='Book',
+                                                      owner=self.user)
+        self.group = Group.objects.create(name='Group',
+                                          addressbook=self.addressbook)
+        self.addresses = []
+        for x in range(3):
+            address = Address.objects.create(name=str(x),
+                                             email='%s@test.com' % x)
+            address.groups.add(self.group)
+            self.addresses.append(address)
+
+    def sync(self, token=None, limit=None):
+        data = {}
+        if token is not None:
+            data['token'] = token
+        if limit is not None:
+            data['limit'] = limit
+        response = self.client.get(reverse('sync'), data)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def ids(self, objects):
+        return [obj['id'] for obj in objects]
+
+    def test_full_sync(self):
+        data = self.sync()
+        self.assertEquals(self.ids(data['addressbooks']),
+                          [self.addressbook.id])
+        self.assertEquals(self.ids(data['groups']), [self.group.id])
+        self.assertEquals(len(data['addresses']), 3)
+
+    def test_no_changes(self):
+        token = self.sync()['token']
+        data = self.sync(token)
+        self.assertEquals(data['addressbooks'], [])
+        self.assertEquals(data['groups'], [])
+        self.assertEquals(data['addresses'], [])
+        self.assertEquals(data['deleted'], {
+            'addressbooks': [], 'groups': [], 'addresses': []
+        })
+
+    def test_changes(self):
+        token = self.sync()['token']
+        self.addresses[0].name = 'Changed'
+        self.addresses[0].save()
+        deleted_id = self.addresses[1].id
+        self.addresses[1].delete()
+        data = self.sync(token)
+        self.assertEquals(self.ids(data['addresses']),
+                          [self.addresses[0].id])
+        self.assertEquals(data['addresses'][0]['name'], 'Changed')
+        self.assertEquals(self.ids(data['groups']), [self.group.id])
+        self.assertEquals(data['deleted']['addresses'], [deleted_id])
+        data = self.sync(data['token'])
+        self.assertEquals(data['addresses'], [])
+
+    def test_removed_from_group(self):
+        token = self.sync()['token']
+        self.addresses[2].groups.clear()
+        data = self.sync(token)
+        self.assertEquals(data['deleted']['addresses'],
+                          [self.addresses[2].id])
+
+    def test_other_users_changes(self):
+        token = self.sync()['token']
+        addressbook = AddressBook.objects.create(name='Other',
+                                                 owner=self.other)
+        Group.objects.create(name='Other', addressbook=addressbook)
+        data = self.sync(token)
+        self.assertEquals(data['addressbooks'], [])
+        self.assertEquals(data['groups'], [])
+
+    def test_gained_and_lost_access(self):
+        addressbook = AddressBook.objects.create(name='Other',
+                                                 owner=self.other)
+        group = Group.objects.create(name='Other', addressbook=addressbook)
+        address = Address.objects.create(name='Other',
+                                         email='other@test.com')
+        address.groups.add(group)
+        token = self.sync()['token']
+        addressbook.shared_with.add(self.user)
+        data = self.sync(token)
+        self.assertEquals(self.ids(data['addressbooks']), [addressbook.id])
+        self.assertEquals(self.ids(data['groups']), [group.id])
+        self.assertEquals(self.ids(data['addresses']), [address.id])
+        addressbook_id = addressbook.id
+        addressbook.delete()
+        data = self.sync(data['token'])
+        self.assertEquals(data['deleted']['addressbooks'], [addressbook_id])
+
+    def test_invalid_token(self):
+        response = self.client.get(reverse('sync'), {'token': 'invalid'})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+
+    def test_expired_token(self):
+        token = self.sync()['token']
+        with self.settings(SYNC_TOKEN_MAX_AGE=-1):
+            response = self.client.get(reverse('sync'), {'token': token})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+
+    def test_snapshot_load(self):
+        token = self.sync()['token']
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        call_command('snapshot', 'dump', directory, stdout=io.StringIO())
+        call_command('snapshot', 'load', directory, truncate=True,
+                     stdout=io.StringIO())
+        response = self.client.get(reverse('sync'), {'token': token})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(response.data, {'token': ['Expired sync token']})
+        data = self.sync()
+        self.assertEquals(len(data['addresses']), 3)
+        self.assertEquals(self.sync(data['token'])['addresses'], [])
+
+    def test_late_commit(self):
+        self.addresses[0].name = 'Changed'
+        self.addresses[0].save()
+        self.addresses[1].name = 'Changed'
+        self.addresses[1].save()
+        # The change of the first address is still uncommitted when the
+        # client syncs
+        late = list(Change.objects.filter(kind=Change.ADDRESS,
+                                          object_id=self.addresses[0].id)
+                    .order_by('-id')[:1].values())
+        Change.objects.filter(id=late[0]['id']).delete()
+        token = self.sync()['token']
+        data = self.sync(token)
+        self.assertEquals(data['addresses'], [])
+        Change.objects.create(**late[0])
+        data = self.sync(data['token'])
+        self.assertEquals(self.ids(data['addresses']),
+                          [self.addresses[0].id])
+        data = self.sync(data['token'])
+        self.assertEquals(data['addresses'], [])
+
+    def test_pages(self):
+        data = self.sync(limit=2)
+        self.assertTrue(data['more'])
+        self.assertEquals(self.ids(data['groups']), [self.group.id])
+        ids = self.ids(data['addresses'])
+        data = self.sync(data['token'], limit=2)
+        self.assertFalse(data['more'])
+        self.assertEquals(data['groups'], [])
+        ids.extend(self.ids(data['addresses']))
+        self.assertEquals(ids, [address.id for address in self.addresses])
+        token = data['token']
+        for address in self.addresses:
+            address.name = 'Changed'
+            address.save()
+        ids = []
+        while True:
+            data = self.sync(token, limit=2)
+            ids.extend(self.ids(data['addresses']))
+            token = data['token']
+            if not data['more']:
+                break
+        self.assertEquals(ids, [address.id for address in self.addresses])
+        response = self.client.get(reverse('sync'), {'limit': 0})
+        self.assertEquals(response.status_code,
+                          status.HTTP_400_BAD_REQUEST)
+
+    def test_prune_changes(self):
+        token = self.sync()['token']
+        self.addresses[0].name = 'Changed'
+        self.addresses[0].save()
+        Change.objects.exclude(object_id=self.addresses[0].id).update(
+            created=timezone.now() - timedelta(days=365)
+        )
+        call_command('prune_changes', stdout=io.StringIO())
+        self.assertEquals(
+            set(Change.objects.values_list('object_id', flat=True)),
+            set([self.addresses[0].id])
+        )
+        data = self.sync(token)
+        self.assertEquals(self.ids(data['addresses']),
+                          [self.addresses[0].id])
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        media = override_settings(MEDIA_ROOT=directory)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def test_scenarios(self):
+        counts = generator.generate(users=3, addressbooks=2, groups=2,
+                                    addresses=20)
+        self.assertEquals(counts['addresses'], 120)
+        self.assertEquals(AddressBookEmail.objects.count(), 120)
+        results = scenarios.run(iterations=1)
+        for name, result in results['scenarios'].items():
+            self.assertTrue(max(result['status']) < 300, name)
+        for name in ('metrics', 'group-addresses-remove',
+                     'group-addresses-move', 'jobs-create', 'job-output'):
+            self.assertIn(name, results['scenarios'])
+        self.assertTrue(
+            results['encoding']['addresses-json-gzip']['bytes'] <
+            results['encoding']['addresses-json-identity']['bytes']
+        )
+
+
+@override_settings(RESPONSE_CACHE=None)
+class MetricsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        self.user.is_staff = True
+        self.user.save()
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+        metrics.reset()
+
+    def test_metrics(self):
+        addressbook = AddressBook.objects.create(name='Test', owner=self.user)
+        for x in range(2):
+            self.client.get(reverse('addressbook', args=[addressbook.id, ]))
+        response = self.client.get(reverse('metrics'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('addressbooks_request_duration_seconds_count'
+                      '{url_name="addressbook"} 2', lines)
+        self.assertIn('addressbooks_sql_queries_total'
+                      '{url_name="addressbook"} 8', lines)
+        self.assertTrue(any(
+            line.startswith('addressbooks_serializer_duration_seconds_total'
+                            '{url_name="addressbook"}')
+            for line in lines
+        ))
+
+    def test_metrics_access(self):
+        self.client.credentials()
+        response = self.client.get(reverse('metrics'))
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        User.objects.create_user(username='other', password='other')
+        self.client.login(username='other', password='other')
+        response = self.client.get(reverse('metrics'))
+        self.assertEquals(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.logout()
+        with self.settings(METRICS_ALLOWED_IPS=['127.0.0.1']):
+            response = self.client.get(reverse('metrics'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+
+    def test_queries_not_logged(self):
+        addressbook = AddressBook.objects.create(name='Test', owner=self.user)
+        for connection in connections.all():
+            connection.queries_log.clear()
+        self.client.get(reverse('addressbook', args=[addressbook.id, ]))
+        self.assertFalse(any(
+            connection.queries_log for connection in connections.all()
+        ))
+
+
+class UserTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test', password='test')
+        token = Token.objects.get(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        authentication.get_user(token.key)
+
+    def get_users_query_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('users'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_get_users_permissions(self):
+        permission = Permission.objects.get(
+            codename='add_address', content_type__app_label='address_books'
+        )
+        self.user.user_permissions.add(permission)
+        response = self.client.get(reverse('users'))
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        data = response.data['results'][0]
+        self.assertTrue(data['can_add_address'])
+        self.assertFalse(data['can_delete_address'])
+
+    def test_get_users_query_count(self):
+        count = self.get_users_query_count()
+        for x in range(20):
+            user = User.objects.create_user(username=str(x), password='test')
+            user.user_permissions.add(*Permission.objects.filter(
+                content_type__app_label='address_books'
+            ))
+        self.assertEquals(self.get_users_query_count(), count)
+
@@ -1,138 +1,635 @@
+import hashlib
+import json
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import Q
-from rest_framework import generics
-from rest_framework.authentication import SessionAuthentication, \
-    BasicAuthentication, TokenAuthentication
+from django.core.cache import caches
+from django.db.models import Prefetch
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import generics, status
 from rest_framework.permissions import IsAuthenticated, DjangoModelPermissions
 from rest_framework.response import Response
-from rest_framework.decorators import api_view
-from address_books.models import Group, AddressBook, Address
-from address_books.serializers import AddressSerializer, AddressBookSerializer, \
-    GroupSerializer, UserSerializer
-
-
-class AddressBookListView(generics.ListCreateAPIView):
+from rest_framework.decorators import api_view, permission_classes
+from address_books.batch import AddressBatch
+from address_books.exporters import EXPORTERS, CONTENT_TYPES, EXTENSIONS
+from address_books.importers import import_addresses
+from address_books import jobs, membership, metrics
+from address_books.models import Group, AddressBook, Address, Job
+from address_books.pagination import OptionalCursorPagination
+from address_books.serializers import AddressSerializer, \
+    AddressBookSerializer, GroupSerializer, UserSerializer, JobSerializer, \
+    PermissionField, PERMISSIONS_PREFETCH, ValuesListSerializer, \
+    requested_fields, serializer_columns, related_fields
+from address_books.sync import sync, page_size as sync_page_size
+
+
+def related_prefetches(model, serializer, names, prefix=''):
+    """
+    Returns the prefetches of the relations among names that serializer
+    outputs. Related objects are ordered, so lists of related ids come out
+    the same every time, and the relations of expanded ones are prefetched
+    in turn.
+    """
+    prefetches = []
+    for name in names:
+        if name not in serializer.fields:
+            continue
+        related_model = model._meta.get_field(name).related_model
+        prefetches.append(Prefetch(
+            prefix + name, queryset=related_model.objects.order_by('pk')
+        ))
+        child = getattr(serializer.fields[name], 'child', None)
+        if child is not None:
+            prefetches.extend(related_prefetches(
+                related_model, child, related_fields(child),
+                prefix + name + '__'
+            ))
+    return prefetches
+
+
+class PrefetchMixin(object):
+    """
+    Prefetches the relations named in `prefetch_fields`, so serializing a
+    page costs a fixed number of queries whatever its size. Expanded
+    relations cost one more query per level.
+    """
+    prefetch_fields = ()
+
+    def filter_queryset(self, queryset):
+        queryset = super(PrefetchMixin, self).filter_queryset(queryset)
+        serializer = self.get_serializer()
+        if requested_fields(self.request) is not None:
+            queryset = queryset.only(*serializer_columns(serializer))
+        return queryset.prefetch_related(*related_prefetches(
+            queryset.model, serializer, self.prefetch_fields
+        ))
+
+    def perform_update(self, serializer):
+        super(PrefetchMixin, self).perform_update(serializer)
+        # The response must not be rendered from the relations prefetched
+        # before the update
+        serializer.instance._prefetched_objects_cache = {}
+
+
+class ValuesListMixin(object):
+    """
+    Lists through ValuesListSerializer when the serializer's fields allow
+    it, which returns the same data without building model instances.
+    """
+
+    def list(self, request, *args, **kwargs):
+        serializer = ValuesListSerializer(self.get_serializer())
+        if not serializer.supported:
+            return super(ValuesListMixin, self).list(request, *args,
+                                                     **kwargs)
+        rows = serializer.values(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.data(page))
+        return Response(serializer.data(list(rows)))
+
+
+RESPONSE_CACHE_PREFIX = 'address_books.response.'
+
+
+def response_cache():
+    alias = getattr(settings, 'RESPONSE_CACHE', None)
+    return caches[alias] if alias else None
+
+
+class VersionETagMixin(object):
+    """
+    Tags GET responses with the versions of the address books they are built
+    from, and answers a matching If-None-Match with 304 Not Modified after
+    reading only those versions.
+
+    Rendered responses are also kept under their ETag in the cache named by
+    RESPONSE_CACHE. The signal handlers increase the versions of the books a
+    change touches, which changes the ETag, so only the responses built from
+    those books are no longer found and everything else stays cached.
+    """
+    # The browsable API is left out, its pages embed forms and CSRF tokens
+    cached_formats = ('json', 'msgpack')
+
+    def get_etag_addressbooks(self):
+        """
+        Returns the address books the response depends on. Narrowed by the
+        views so changes to other books keep the ETag.
+        """
+        return AddressBook.objects.visible_to(self.request.user)
+
+    def resource_exists(self):
+        """
+        Tells whether If-None-Match: * matches. Lists always exist, detail
+        views only while their object does.
+        """
+        lookup = self.lookup_url_kwarg or self.lookup_field
+        if lookup not in self.kwargs:
+            return True
+        return self.get_queryset().filter(
+            **{self.lookup_field: self.kwargs[lookup]}
+        ).exists()
+
+    def get_etag(self):
+        versions = list(
+            self.get_etag_addressbooks().order_by('id')
+            .values_list('id', 'version')
+        )
+        # Pages link to the next ones with the scheme and host they were
+        # requested with
+        key = repr((self.request.user.id, self.request.build_absolute_uri(),
+                    self.request.accepted_media_type, versions))
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def get(self, request, *args, **kwargs):
+        etag = self.get_etag()
+        # Compressed responses have the coding appended to their ETag
+        if_none_match = [
+            tag.split(';')[0] for tag in
+            parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+        ]
+        cache = response_cache()
+        if request.accepted_renderer.format not in self.cached_formats:
+            cache = None
+        key = RESPONSE_CACHE_PREFIX + etag
+        if etag in if_none_match or \
+                '*' in if_none_match and self.resource_exists():
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+            else:
+                response = super(VersionETagMixin, self).get(request, *args,
+                                                             **kwargs)
+                if cache is not None and \
+                        response.status_code == status.HTTP_200_OK:
+                    # Stored once rendered, by finalize_response
+                    self.response_cache_key = key
+        if response.status_code in (status.HTTP_200_OK,
+                                    status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = quote_etag(etag)
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(VersionETagMixin, self).finalize_response(
+            request, response, *args, **kwargs
+        )
+        key = getattr(self, 'response_cache_key', None)
+        if key is not None:
+            response.render()
+            response_cache().set(
+                key, (response.content, response['Content-Type']),
+                getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300)
+            )
+        return response
+
+
+class AddressBookListView(VersionETagMixin, ValuesListMixin, PrefetchMixin,
+                          generics.ListCreateAPIView):
     serializer_class = AddressBookSerializer
 
+    prefetch_fields = ('groups', 'shared_with')
+
     model = AddressBook
 
-    authentication_classes = (
-        SessionAuthentication, BasicAuthentication, TokenAuthentication)
+    pagination_class = OptionalCursorPagination
+
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        return AddressBook.objects.filter(
-            Q(owner=user) | Q(shared_with=user)
-        ).distinct()
+        return AddressBook.objects.visible_to(user)
 
 
-class AddressBookDetailView(generics.RetrieveUpdateDestroyAPIView):
+class AddressBookDetailView(VersionETagMixin, PrefetchMixin,
+                            generics.RetrieveUpdateDestroyAPIView):
     serializer_class = AddressBookSerializer
 
+    prefetch_fields = ('groups', 'shared_with')
+
     model = AddressBook
 
-    authentication_classes = (
-        SessionAuthentication, BasicAuthentication, TokenAuthentication)
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        return AddressBook.objects.filter(
-            Q(owner=user) | Q(shared_with=user)
-        ).distinct()
+        return AddressBook.objects.visible_to(user)
+
+    def get_etag_addressbooks(self):
+        return super(AddressBookDetailView, self).get_etag_addressbooks() \
+            .filter(id=self.kwargs['pk'])
+
+
+class AddressBookExportView(generics.GenericAPIView):
+    """
+    Streams every group and address of an address book as CSV, vCard or
+    NDJSON, chosen with the `type` query parameter.
+    """
+    model = AddressBook
 
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
-class GroupListView(generics.ListCreateAPIView):
+    def get_queryset(self):
+        user = self.get_serializer_context()['request'].user
+        return AddressBook.objects.visible_to(user)
+
+    def get(self, request, *args, **kwargs):
+        export_type = request.query_params.get('type', 'csv')
+        if export_type not in EXPORTERS:
+            return Response({'type': ['Unsupported export format']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        addressbook = self.get_object()
+        response = StreamingHttpResponse(
+            EXPORTERS[export_type](addressbook),
+            content_type=CONTENT_TYPES[export_type]
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            addressbook.id, EXTENSIONS[export_type]
+        )
+        return response
+
+
+class GroupListView(VersionETagMixin, ValuesListMixin, PrefetchMixin,
+                    generics.ListCreateAPIView):
     serializer_class = GroupSerializer
 
+    prefetch_fields = ('addresses',)
+
     model = Group
 
-    authentication_classes = (
-        SessionAuthentication, BasicAuthentication, TokenAuthentication)
+    pagination_class = OptionalCursorPagination
+
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        queryset = Group.objects.filter(
-            (Q(addressbook__owner=user)
-             | Q(addressbook__shared_with=user))
-        ).distinct()
+        queryset = Group.objects.visible_to(user)
         addressbook = self.request.QUERY_PARAMS.get('addressbook', None)
         if addressbook is not None:
             queryset = queryset.filter(addressbook=addressbook)
         return queryset
 
+    def get_etag_addressbooks(self):
+        queryset = super(GroupListView, self).get_etag_addressbooks()
+        addressbook = self.request.query_params.get('addressbook', None)
+        if addressbook is not None:
+            queryset = queryset.filter(id=addressbook)
+        return queryset
+
 
-class GroupDetailView(generics.RetrieveUpdateDestroyAPIView):
+class GroupDetailView(VersionETagMixin, PrefetchMixin,
+                      generics.RetrieveUpdateDestroyAPIView):
     serializer_class = GroupSerializer
 
+    prefetch_fields = ('addresses',)
+
     model = Group
 
-    authentication_classes = (SessionAuthentication, BasicAuthentication,
-                              TokenAuthentication)
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        return Group.objects.filter(
-            Q(addressbook__owner=user) | Q(addressbook__shared_with=user)
-        ).distinct()
+        return Group.objects.visible_to(user)
+
+    def get_etag_addressbooks(self):
+        return super(GroupDetailView, self).get_etag_addressbooks() \
+            .filter(groups__id=self.kwargs['pk'])
 
 
-class AddressListView(generics.ListCreateAPIView):
+class GroupAddressesView(generics.GenericAPIView):
+    """
+    Adds addresses to the group, removes them from it, or moves them to the
+    group given as `to`. The addresses are listed by id in `addresses`, or
+    selected with the `group` and `q` filters of the address list.
+    """
+    model = Group
+
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        user = self.get_serializer_context()['request'].user
+        return Group.objects.visible_to(user)
+
+    def post(self, request, *args, **kwargs):
+        if not request.user.has_perm('address_books.change_group'):
+            self.permission_denied(request)
+        group = self.get_object()
+        if not isinstance(request.data, dict):
+            return Response(
+                {'non_field_errors': ['Expected an object.']},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        action = kwargs['action']
+        target = None
+        if action == 'move':
+            try:
+                target = self.get_queryset().get(id=request.data.get('to'))
+            except (Group.DoesNotExist, TypeError, ValueError):
+                return Response({'to': ['Invalid group']},
+                                status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = membership.select_addresses(request.user, request.data)
+        except ValueError as e:
+            field, message = e.args
+            return Response({field: [message]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if action == 'remove':
+            return Response({
+                'removed': membership.remove_addresses(group, ids)
+            })
+        if action == 'move':
+            ids = membership.in_group(group, ids)
+        duplicates = membership.duplicate_emails(
+            (target or group).addressbook_id, ids
+        )
+        if duplicates:
+            return Response({
+                'addresses': ['Duplicate email address'],
+                'duplicates': sorted(duplicates),
+            }, status=status.HTTP_400_BAD_REQUEST)
+        if action == 'move':
+            return Response({
+                'moved': membership.move_addresses(group, target, ids)
+            })
+        return Response({'added': membership.add_addresses(group, ids)})
+
+
+class AddressListView(VersionETagMixin, ValuesListMixin, PrefetchMixin,
+                      generics.ListCreateAPIView):
     serializer_class = AddressSerializer
 
+    prefetch_fields = ('groups',)
+
     model = Address
 
-    authentication_classes = (SessionAuthentication, BasicAuthentication,
-                              TokenAuthentication)
+    pagination_class = OptionalCursorPagination
+
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        queryset = Address.objects.filter(
-            (Q(groups__addressbook__owner=user)
-             | Q(groups__addressbook__shared_with=user))
-        ).distinct()
+        queryset = Address.objects.visible_to(user)
         group = self.request.QUERY_PARAMS.get('group', None)
+        if group is not None:
+            queryset = queryset.filter(groups__id=group)
+        query = self.request.QUERY_PARAMS.get('q', None)
+        if query:
+            queryset = queryset.search(query)
+        return queryset
+
+    def get_etag_addressbooks(self):
+        queryset = super(AddressListView, self).get_etag_addressbooks()
+        group = self.request.query_params.get('group', None)
         if group is not None:
             queryset = queryset.filter(groups__id=group)
         return queryset
 
 
-class AddressDetailView(generics.RetrieveUpdateDestroyAPIView):
+class AddressDetailView(VersionETagMixin, PrefetchMixin,
+                        generics.RetrieveUpdateDestroyAPIView):
     serializer_class = AddressSerializer
 
+    prefetch_fields = ('groups',)
+
     model = Address
 
-    authentication_classes = (SessionAuthentication, BasicAuthentication,
-                              TokenAuthentication)
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     def get_queryset(self):
         user = self.get_serializer_context()['request'].user
-        return Address.objects.filter(
-            (Q(groups__addressbook__owner=user)
-             | Q(groups__addressbook__shared_with=user))
-        ).distinct()
+        return Address.objects.visible_to(user)
 
+    def get_etag_addressbooks(self):
+        return super(AddressDetailView, self).get_etag_addressbooks() \
+            .filter(groups__addresses__id=self.kwargs['pk']).distinct()
 
-class UserListView(generics.ListCreateAPIView):
+
+class AddressImportView(generics.GenericAPIView):
+    """
+    Imports the addresses of an uploaded CSV, vCard or NDJSON file. The
+    format is taken from the `type` field or the file name and content type.
+    Every row is added to the groups it lists plus any `group` query
+    parameters.
+    """
+    model = Address
+
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'file': ['No file was submitted.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            report = import_addresses(
+                request.user, upload, format=request.data.get('type'),
+                default_groups=request.query_params.getlist('group')
+            )
+        except ValueError as e:
+            return Response({'file': [str(e)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(report)
+
+
+class SyncView(generics.GenericAPIView):
+    """
+    Returns the address books, groups and addresses that changed since the
+    `token` query parameter, or all of them without one, along with the
+    token to pass next time. At most `limit` addresses or changes are
+    handled at once; `more` tells whether to sync again right away.
+    """
+    model = AddressBook
+
+    permission_classes = (IsAuthenticated, DjangoModelPermissions)
+
+    def get(self, request, *args, **kwargs):
+        limit = request.query_params.get('limit')
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= sync_page_size():
+                return Response({'limit': [
+                    'Expected a number from 1 to %s.' % sync_page_size()
+                ]}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            data = sync(request.user, request.query_params.get('token'),
+                        context=self.get_serializer_context(), limit=limit)
+        except ValueError as e:
+            return Response({'token': [str(e)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(data)
+
+
+class AddressBatchView(generics.GenericAPIView):
+    """
+    Applies a list of address creates, updates and deletes in one
+    transaction. Nothing is written unless every operation is valid, and
+    the errors are returned by operation index otherwise.
+    """
+    serializer_class = AddressSerializer
+
+    model = Address
+
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response(
+                {'non_field_errors': ['Expected a list of operations.']},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        batch = AddressBatch(request.user, request.data)
+        if not request.user.has_perms(batch.required_permissions()):
+            self.permission_denied(request)
+        if not batch.validate():
+            return Response({'errors': [
+                dict(errors, index=index)
+                for index, errors in sorted(batch.errors.items(),
+                                            key=lambda item: item[0] or 0)
+            ]}, status=status.HTTP_400_BAD_REQUEST)
+        operations = batch.apply()
+        addresses = Address.objects.prefetch_related('groups').in_bulk([
+            operation['address'].id for operation in operations
+            if 'address' in operation
+        ])
+        results = []
+        for operation in operations:
+            if operation['op'] == 'delete':
+                results.append({'op': 'delete', 'id': operation['id'],
+                                'status': status.HTTP_204_NO_CONTENT})
+                continue
+            address = addresses[operation['address'].id]
+            results.append({
+                'op': operation['op'],
+                'id': address.id,
+                'status': status.HTTP_201_CREATED
+                if operation['op'] == 'create' else status.HTTP_200_OK,
+                'data': self.get_serializer(address).data,
+            })
+        return Response({'results': results})
+
+
+class JobListView(generics.ListAPIView):
+    """
+    Lists the jobs of the user, newest first, and queues new ones to be run
+    by the run_jobs command. The `kind` of a job is one of:
+
+    - import: an uploaded `file` and its `type`, added to the `group` query
+      parameters as with addresses/import
+    - export: the `addressbook` and `type` as with addressbooks/<id>/export
+    - delete: the `addresses` listed by id, or selected with the `group` and
+      `q` filters of the address list
+    """
+    serializer_class = JobSerializer
+
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return Job.objects.filter(user=self.request.user).order_by('-id') \
+            .defer('input', 'output')
+
+    def post(self, request, *args, **kwargs):
+        if not isinstance(request.data, dict):
+            return Response(
+                {'non_field_errors': ['Expected an object.']},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        kind = request.data.get('kind')
+        if kind not in jobs.PERMISSIONS:
+            return Response({'kind': ['Must be import, export or delete.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        permission = jobs.PERMISSIONS[kind]
+        if permission is not None and not request.user.has_perm(permission):
+            self.permission_denied(request)
+        try:
+            if kind == Job.IMPORT:
+                upload = request.FILES.get('file')
+                if upload is None:
+                    raise ValueError('file', 'No file was submitted.')
+                job = jobs.queue_import(
+                    request.user, upload, format=request.data.get('type'),
+                    groups=request.query_params.getlist('group')
+                )
+            elif kind == Job.EXPORT:
+                job = jobs.queue_export(
+                    request.user, request.data.get('addressbook'),
+                    request.data.get('type', 'csv')
+                )
+            else:
+                job = jobs.queue_delete(request.user, request.data)
+        except ValueError as e:
+            field, message = e.args
+            return Response({field: [message]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(job).data,
+                        status=status.HTTP_202_ACCEPTED)
+
+
+class JobDetailView(generics.RetrieveAPIView):
+    serializer_class = JobSerializer
+
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return Job.objects.filter(user=self.request.user)
+
+
+class JobOutputView(generics.GenericAPIView):
+    """
+    Downloads the file written by a finished export job.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return Job.objects.filter(user=self.request.user, kind=Job.EXPORT,
+                                  status=Job.DONE)
+
+    def get(self, request, *args, **kwargs):
+        job = self.get_object()
+        format = json.loads(job.arguments)['format']
+        response = FileResponse(
+            job.output.storage.open(job.output.name, 'rb'),
+            content_type=CONTENT_TYPES[format]
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s.%s"' % (
+            job.id, EXTENSIONS[format]
+        )
+        return response
+
+
+class UserQuerySetMixin(object):
+    """
+    Reads only the columns and permissions the serializer's fields need.
+    """
+
+    def get_queryset(self):
+        queryset = super(UserQuerySetMixin, self).get_queryset()
+        serializer = self.get_serializer()
+        if requested_fields(self.request) is not None:
+            queryset = queryset.only(*serializer_columns(serializer))
+        if any(isinstance(field, PermissionField)
+               for field in serializer.fields.values()):
+            queryset = queryset.prefetch_related(PERMISSIONS_PREFETCH)
+        return queryset
+
+
+class UserListView(UserQuerySetMixin, generics.ListCreateAPIView):
     serializer_class = UserSerializer
 
-    authentication_classes = (SessionAuthentication, BasicAuthentication,
-                              TokenAuthentication)
     permission_classes = (IsAuthenticated, DjangoModelPermissions)
 
     queryset = User.objects.all()
 
 
-class UserDetailView(generics.RetrieveUpdateDestroyAPIView):
+class UserDetailView(UserQuerySetMixin,
+                     generics.RetrieveUpdateDestroyAPIView):
     serializer_class = UserSerializer
 
-    authentication_classes = (SessionAuthentication, BasicAuthentication,
-                              TokenAuthentication)
     permission_classes = (IsAuthenticated,)
 
     queryset = User.objects.all()
@@ -143,3 +640,10 @@ def get_current_user(request):
     print('Reached get_current_user')
     serializer = UserSerializer(request.user)
     return Response(serializer.data)
+
+
+@api_view(['GET'])
+@permission_classes((metrics.CanReadMetrics,))
+def metrics_view(request):
+    return HttpResponse(metrics.render(),
+                        content_type='text/plain; version=0.0.4')